@@ -0,0 +1,176 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# per client: ADMISSION_RATE requests a second on average, bursts of ADMISSION_BURST, and up to
+# ADMISSION_QUEUE more waiting at most ADMISSION_MAX_WAIT seconds for a token before being turned away
+ADMISSION_RATE = float(os.environ.get("ADMISSION_RATE", "0.5"))
+ADMISSION_BURST = int(os.environ.get("ADMISSION_BURST", "5"))
+ADMISSION_QUEUE = int(os.environ.get("ADMISSION_QUEUE", "2"))
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "5"))
+ADMISSION_CLIENTS = int(os.environ.get("ADMISSION_CLIENTS", "10000"))
+# false lets every request through, singleflight still applies
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "true").lower() == "true"
+
+
+class Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # concurrent calls with the same key share one execution: the first runs it, the others wait for its result
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._calls = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args)
+            return call.result
+        except BaseException as e:
+            # anything that ends the leader, followers would otherwise take the missing result for None
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def ado(self, key, fn, *args):
+        # the asyncio flavour, for coroutines on one event loop
+        future = self._futures.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+
+        future = self._futures[key] = asyncio.get_running_loop().create_future()
+        self.calls += 1
+        try:
+            result = await fn(*args)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            # the followers are cancelled with the leader instead of waiting on a future nobody resolves
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # retrieved here so a flight without followers doesn't log "exception was never retrieved"
+            future.exception()
+            raise
+        finally:
+            del self._futures[key]
+
+    def stats(self):
+        return {'calls': self.calls, 'shared': self.shared, 'in_flight': len(self._calls) + len(self._futures)}
+
+
+class Bucket:
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class Admission:
+    # a token bucket per client, reservation style: a request takes a token even when none is left, and the
+    # bucket going negative is the queue of requests waiting for their token; beyond ADMISSION_QUEUE
+    # waiting requests or ADMISSION_MAX_WAIT seconds the request is rejected at once, without waiting
+
+    def __init__(self, rate=ADMISSION_RATE, burst=ADMISSION_BURST, queue=ADMISSION_QUEUE, max_wait=ADMISSION_MAX_WAIT,
+                 max_clients=ADMISSION_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.queue = queue
+        self.max_wait = max_wait
+        self.max_clients = max_clients
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def reserve(self, client):
+        # (True, seconds to wait before going ahead) or (False, seconds until a retry can be admitted)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = self._buckets[client] = Bucket(self.burst, now)
+                while len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            self._buckets.move_to_end(client)
+
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                self.admitted += 1
+                return True, 0.0
+
+            # a fraction of a token below zero is still a request waiting for its token
+            wait = (1 - bucket.tokens) / self.rate
+            if math.ceil(-bucket.tokens) >= self.queue or wait > self.max_wait:
+                self.rejected += 1
+                # until the bucket refills past both limits
+                threshold = max(1 - self.queue, 1 - self.rate * self.max_wait)
+                return False, max(0.0, (threshold - bucket.tokens) / self.rate)
+            bucket.tokens -= 1
+            self.admitted += 1
+            self.queued += 1
+            return True, wait
+
+    def admit(self, client):
+        admitted, wait = self.reserve(client)
+        if admitted and wait:
+            time.sleep(wait)
+        return admitted, wait
+
+    async def aadmit(self, client):
+        admitted, wait = self.reserve(client)
+        if admitted and wait:
+            await asyncio.sleep(wait)
+        return admitted, wait
+
+    def stats(self):
+        with self._lock:
+            return {'admitted': self.admitted, 'queued': self.queued, 'rejected': self.rejected,
+                    'clients': len(self._buckets)}
+
+
+def retry_after(seconds):
+    return str(max(1, math.ceil(seconds)))
+
+
+flights = SingleFlight()
+admission = Admission()
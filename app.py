@@ -1,12 +1,25 @@
+import admission
 import chatter4
+import engines
+import history_export
+import history_index
 import logging
-from flask import Flask, render_template, request
+import logging_setup
+import metrics
+import os
+import persistence
+import resilience
+import response_cache
+import session_memory
+import streaming
+import weather_cache
+from flask import Flask, Response, abort, g, render_template, request, stream_with_context
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 import datetime
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///db.sqlite'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///db.sqlite')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 CORS(app)
@@ -15,15 +28,11 @@ CORS(app)
 CORS(app, origins=["https://www.travelbestbets.com", "https://travelbestbets.com"])
 app.static_folder = 'static'
 
-# Configure logging
-logging.basicConfig(
-    filename='app.log',
-    level=logging.DEBUG,
-    format='%(asctime)s %(levelname)s %(message)s'
+# records are queued on the request thread and written, rotated and JSON encoded by a listener thread
+logging_setup.setup()
 
-)
-
-logger = logging.getLogger(__name__)
+# question and answer records, the high-volume ones, LOG_SAMPLE=app.conversation=0.1 keeps a tenth of the requests
+conversation_logger = logging.getLogger('app.conversation')
 
 
 class Conversation(db.Model):
@@ -31,6 +40,7 @@ class Conversation(db.Model):
     date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     question = db.Column(db.String(256))
     answer = db.Column(db.String(1000))
+    metrics = db.Column(db.Text)
 
     def to_dict(self):
         return {
@@ -41,29 +51,205 @@ class Conversation(db.Model):
         }
 
 
+with app.app_context():
+    persistence.enable_wal(db.engine)
+    db.create_all()
+    persistence.add_missing_columns(db.engine, Conversation.__table__)
+    history_index.init_index(db.session)
+    conversation_writer = persistence.BatchWriter(db.engine, Conversation.__table__)
+
+# answers cached before a data/ reload can quote deals that are no longer in the knowledge base
+if 'chatter4' in engines.configured():
+    chatter4.components.get('knowledge').on_reload.append(lambda snapshot: response_cache.invalidate())
+
+
+@app.before_request
+def bind_request_id():
+    request_id = request.headers.get('X-Request-ID', '')
+    g.request_id = request_id if logging_setup.valid_request_id(request_id) else logging_setup.new_request_id()
+    logging_setup.request_id.set(g.request_id)
+
+
+@app.before_request
+def bind_session():
+    session_id = request.cookies.get(session_memory.SESSION_COOKIE)
+    if not session_memory.valid_session_id(session_id):
+        session_id = session_memory.new_session_id()
+    g.session_id = session_id
+    session_memory.current_session.set(session_id)
+
+
+@app.after_request
+def set_session_cookie(response):
+    # refreshed on every response so the cookie expires with the idle session, not after the first request
+    if 'session_id' in g:
+        response.set_cookie(session_memory.SESSION_COOKIE, g.session_id, max_age=session_memory.SESSION_TTL,
+                            httponly=True, samesite='Lax')
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+
 @app.route("/")
 def home():
     return render_template("index.html")
 
 
+@app.before_request
+def admit_chat():
+    # one client can't take every worker thread: over its rate it waits briefly or gets a 429 straight away
+    if request.path not in ('/chat', '/chat/stream') or not admission.ADMISSION_ENABLED:
+        return None
+    admitted, wait = admission.admission.admit(request.remote_addr)
+    if not admitted:
+        return Response('Too many requests, please try again in a moment.', status=429,
+                        headers={'Retry-After': admission.retry_after(wait)})
+    return None
+
+
+def coalesced_response(userText, engine):
+    # identical questions asked at the same time run the agent once and all get its answer
+    return admission.flights.do(engines.flight_key(engine, userText, g.session_id), engines.answer, engine, userText)
+
+
 @app.route("/chat")
 def get_bot_response():
-    logger.debug(f'Request IP: {request.remote_addr}')
     userText = request.args.get('message')
 
-    logger.debug("Conversation Customer:" + userText)
+    conversation_logger.debug('Conversation Customer:%s', userText, extra={'ip': request.remote_addr})
+
+    # CHAT_ENGINE answers, unless the session is in a CHAT_AB share
+    engine, role = engines.choose(g.session_id)
+    with metrics.trace() as trace:
+        response = coalesced_response(userText, engine)
 
-    response = chatter4.get_response(userText)
+    save_conversation(userText, response, engines.record(engine.name, role, trace, response))
+    if role == engines.PRIMARY:
+        engines.shadow(userText, response, g.session_id)
 
-    logger.debug("Conversation Chatbot: " + response)
+    return response
 
-    conversation = Conversation(question=userText,
-                                answer=response)
 
-    db.session.add(conversation)
-    db.session.commit()
+@app.route("/chat/stream")
+def stream_bot_response():
+    userText = request.args.get('message')
 
-    return response
+    conversation_logger.debug('Conversation Customer:%s', userText, extra={'ip': request.remote_addr})
+
+    engine, role = engines.choose(g.session_id)
+    session_id = g.session_id
+
+    def generate():
+        with metrics.trace() as trace:
+            response = response_cache.cache.get(userText) if engines.cacheable(engine) else None
+            if response is None:
+                for event, data in streaming.stream_response(engine.get_response, userText):
+                    if event == 'done':
+                        response = data
+                    else:
+                        yield streaming.sse(event, data)
+                if engines.cacheable(engine):
+                    response_cache.cache.set(userText, response)
+
+        save_conversation(userText, response, engines.record(engine.name, role, trace, response))
+        if role == engines.PRIMARY:
+            engines.shadow(userText, response, session_id)
+        yield streaming.sse('done', response)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def save_conversation(question, answer, trace=None):
+    conversation_logger.debug('Conversation Chatbot: %s', answer)
+
+    conversation_writer.submit(date=datetime.datetime.utcnow(),
+                               question=question,
+                               answer=answer,
+                               metrics=trace)
+
+
+@app.route('/healthz')
+def healthz():
+    # liveness: the worker is up and serving, nothing is loaded or called
+    return {'status': 'ok', 'pid': os.getpid()}
+
+
+@app.route('/readyz')
+def readyz():
+    # readiness: the models, chains and knowledge base are built, a warm worker answers without cold starts
+    if not engines.ready():
+        return {'status': 'warming', 'pid': os.getpid()}, 503
+    status = {'status': 'ready', 'pid': os.getpid(), 'engines': engines.configured()}
+    if 'chatter4' in engines.configured():
+        status['knowledge_version'] = chatter4.components.get('knowledge').snapshot.version
+        status['components_ms'] = chatter4.components.report()
+    return status
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    cache_stats = response_cache.cache.stats()
+    gauges = [
+        ('chat_response_cache_hits_total', (), cache_stats['hits']),
+        ('chat_response_cache_misses_total', (), cache_stats['misses']),
+        ('chat_response_cache_entries', (), cache_stats['size']),
+        ('chat_conversation_writes_pending', (), conversation_writer.pending()),
+        ('chat_conversation_writes_dropped_total', (), conversation_writer.dropped),
+    ]
+    for name in ('serper_search', 'google_search'):
+        if chatter4.components.loaded(name):
+            client = chatter4.components.get(name)
+            gauges.append(('chat_search_requests_total', (('client', name),), client.requests))
+            gauges.append(('chat_search_cache_hits_total', (('client', name),), client.hits))
+    admission_stats = admission.admission.stats()
+    gauges.append(('chat_admission_admitted_total', (), admission_stats['admitted']))
+    gauges.append(('chat_admission_queued_total', (), admission_stats['queued']))
+    gauges.append(('chat_admission_rejected_total', (), admission_stats['rejected']))
+    gauges.append(('chat_admission_clients', (), admission_stats['clients']))
+    flight_stats = admission.flights.stats()
+    gauges.append(('chat_singleflight_calls_total', (), flight_stats['calls']))
+    gauges.append(('chat_singleflight_shared_total', (), flight_stats['shared']))
+    gauges.append(('chat_weather_cache_entries', (), weather_cache.cache.stats()['size']))
+    for backend, state in resilience.states().items():
+        gauges.append(('chat_breaker_state', (('backend', backend),), state))
+    sampling = logging_setup.sampling_filter()
+    if sampling is not None:
+        gauges.append(('chat_log_records_sampled_out_total', (), sampling.dropped))
+    return Response(metrics.registry.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+def check_admin_token():
+    token = os.environ.get("ADMIN_TOKEN")
+    if not token or request.headers.get('X-Admin-Token') != token:
+        abort(403)
+
+
+@app.route('/api/cache')
+def cache_stats():
+    check_admin_token()
+    return response_cache.cache.stats()
+
+
+@app.route('/api/cache/invalidate', methods=['POST'])
+def invalidate_cache():
+    check_admin_token()
+    response_cache.invalidate(request.args.get('message'))
+    return response_cache.cache.stats()
+
+
+@app.route('/admin/index')
+def index_status():
+    check_admin_token()
+    return chatter4.components.get('knowledge').status()
+
+
+@app.route('/admin/index/reload', methods=['POST'])
+def reload_index():
+    check_admin_token()
+    knowledge_base = chatter4.components.get('knowledge')
+    knowledge_base.refresh(force=request.args.get('force') == 'true')
+    return knowledge_base.status()
 
 
 @app.route('/history')
@@ -75,43 +261,93 @@ def history():
 def data():
     query = Conversation.query
 
-    # search filter
+    # search filter, served from the conversation_fts full-text index
     search = request.args.get('search')
-    if search:
-        query = query.filter(db.or_(
-            Conversation.question.like(f'%{search}%'),
-            Conversation.answer.like(f'%{search}%')
-        ))
-    total = query.count()
+    match = history_index.match_expression(search) if search else ''
+    if match:
+        query = query.filter(db.text(history_index.MATCH_FILTER)).params(match=match)
+        total = history_index.totals.get(match, query.count)
+    elif search:
+        query = query.filter(db.false())
+        total = 0
+    else:
+        # ids are never reused, so the highest one is a cheap stand-in for count()
+        total = history_index.totals.get('', lambda: db.session.query(db.func.max(Conversation.id)).scalar() or 0)
 
     # sorting
     sort = request.args.get('sort')
+    order = []
     if sort:
-        order = []
         for s in sort.split(','):
             direction = s[0]
             name = s[1:]
             if name not in ['date', 'question', 'answer']:
                 name = 'date'
-            col = getattr(Conversation, name)
-            if direction == '-':
-                col = col.desc()
-            order.append(col)
-        if order:
-            query = query.order_by(*order)
-
-    # pagination
-    start = request.args.get('start', type=int, default=-1)
-    length = request.args.get('length', type=int, default=-1)
-    if start != -1 and length != -1:
+            order.append((name, direction == '-'))
+
+    # keyset pagination is possible when rows are ordered by date (or id) alone
+    keyset = len(order) <= 1 and all(name == 'date' for name, _ in order)
+    descending = order[0][1] if order else False
+    columns = [getattr(Conversation, name) for name, _ in order] + [Conversation.id]
+    directions = [desc for _, desc in order] + [descending]
+    query = query.order_by(*[col.desc() if desc else col for col, desc in zip(columns, directions)])
+
+    # pagination, a page is never larger than HISTORY_MAX_PAGE rows
+    start = max(request.args.get('start', type=int, default=0), 0)
+    length = request.args.get('length', type=int, default=history_index.HISTORY_MAX_PAGE)
+    length = min(length, history_index.HISTORY_MAX_PAGE) if length > 0 else history_index.HISTORY_MAX_PAGE
+    after = request.args.get('after')
+    if after and keyset:
+        try:
+            key = history_index.decode_cursor(after, len(columns))
+            if order:
+                key[0] = datetime.datetime.fromisoformat(key[0])
+            key[-1] = int(key[-1])
+        except ValueError:
+            return {'error': 'after must be a cursor returned as next'}, 400
+        position = db.tuple_(*columns)
+        query = query.filter(position < db.tuple_(*key) if descending else position > db.tuple_(*key))
+        query = query.limit(length)
+    else:
         query = query.offset(start).limit(length)
 
+    conversations = query.all()
+
+    next_cursor = None
+    if keyset and len(conversations) == length:
+        last = conversations[-1]
+        next_cursor = history_index.encode_cursor(
+            ([last.date.isoformat()] if order else []) + [last.id])
+
     # response
     return {
-        'data': [conversation.to_dict() for conversation in query],
+        'data': [conversation.to_dict() for conversation in conversations],
         'total': total,
+        'next': next_cursor,
     }
 
 
+@app.route('/api/export')
+def export():
+    # the whole history, or a date range of it, streamed in chunks for analysis
+    check_admin_token()
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in history_export.FORMATS:
+        return {'error': f'format must be one of {", ".join(history_export.FORMATS)}'}, 400
+    if export_format == 'parquet' and not history_export.parquet_available():
+        return {'error': 'the parquet export needs pyarrow installed'}, 501
+    try:
+        since, until = [datetime.datetime.fromisoformat(request.args[name]) if request.args.get(name) else None
+                        for name in ('since', 'until')]
+    except ValueError:
+        return {'error': 'since and until must be ISO dates'}, 400
+    columns = history_export.COLUMNS + (['metrics'] if request.args.get('metrics') == 'true' else [])
+
+    body = history_export.export(db.engine, Conversation.__table__, export_format, since, until, columns)
+    return Response(body, mimetype=history_export.FORMATS[export_format],
+                    headers={'Content-Disposition': f'attachment; filename=conversations.{export_format}',
+                             'X-Accel-Buffering': 'no'})
+
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,87 @@
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+import admission
+import engines
+import logging_setup
+import metrics
+import search_client
+import session_memory
+from app import app, conversation_logger, save_conversation
+
+wsgi_application = WsgiToAsgi(app)
+
+
+def session_id_from(scope):
+    cookie = SimpleCookie()
+    for name, value in scope['headers']:
+        if name == b'cookie':
+            cookie.load(value.decode('latin-1'))
+    morsel = cookie.get(session_memory.SESSION_COOKIE)
+    if morsel is not None and session_memory.valid_session_id(morsel.value):
+        return morsel.value
+    return session_memory.new_session_id()
+
+
+async def chat(scope, receive, send):
+    params = parse_qs(scope['query_string'].decode())
+    user_text = params.get('message', [''])[0]
+    session_id = session_id_from(scope)
+    session_memory.current_session.set(session_id)
+    request_id = logging_setup.new_request_id()
+    logging_setup.request_id.set(request_id)
+
+    client = scope.get('client')
+    if admission.ADMISSION_ENABLED:
+        admitted, wait = await admission.admission.aadmit(client[0] if client else None)
+        if not admitted:
+            await send({'type': 'http.response.start', 'status': 429,
+                        'headers': [(b'retry-after', admission.retry_after(wait).encode()),
+                                    (b'content-type', b'text/plain; charset=utf-8')]})
+            await send({'type': 'http.response.body', 'body': b'Too many requests, please try again in a moment.'})
+            return
+
+    conversation_logger.debug('Conversation Customer:%s', user_text, extra={'ip': client[0] if client else None})
+
+    engine, role = engines.choose(session_id)
+    with metrics.trace() as trace:
+        response = await admission.flights.ado(engines.flight_key(engine, user_text, session_id),
+                                               engines.aanswer, engine, user_text)
+
+    save_conversation(user_text, response, engines.record(engine.name, role, trace, response))
+    if role == engines.PRIMARY:
+        engines.shadow(user_text, response, session_id)
+
+    body = response.encode('utf-8')
+    headers = [
+        (b'content-type', b'text/html; charset=utf-8'),
+        (b'access-control-allow-origin', b'*'),
+        (b'content-length', str(len(body)).encode()),
+        (b'set-cookie', f'{session_memory.SESSION_COOKIE}={session_id}; Max-Age={session_memory.SESSION_TTL}; '
+                        f'Path=/; HttpOnly; SameSite=Lax'.encode()),
+        (b'x-request-id', request_id.encode()),
+    ]
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await search_client.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(scope, receive, send)
+    elif scope['type'] == 'http' and scope['path'] == '/chat':
+        await chat(scope, receive, send)
+    else:
+        await wsgi_application(scope, receive, send)
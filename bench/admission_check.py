@@ -0,0 +1,157 @@
+"""Concurrency check of /chat coalescing and per-client admission control, against stubbed LLM and search backends.
+
+    python -m bench.admission_check
+    python -m bench.admission_check --clients 100 --llm-latency 0.5
+
+1. --clients visitors ask the same question at once (different spelling, different IPs): the agent runs once.
+2. one IP fires --burst-requests different questions at once: ADMISSION_BURST go straight through,
+   ADMISSION_QUEUE wait for a token, the rest get a 429 with Retry-After without waiting, while another
+   IP is still served.
+3. the asyncio singleflight used by asgi.py shares one coroutine the same way.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("RESPONSE_CACHE_DB", "")
+os.environ.setdefault("KNOWLEDGE_POLL_INTERVAL", "0")
+
+from bench.loadtest import install_stubs, percentile  # noqa: E402 (sets the stub API keys first)
+
+import admission  # noqa: E402
+
+SPELLINGS = ['Any cruise deals to the Mediterranean?', 'any cruise deals to the mediterranean',
+             'ANY CRUISE DEALS TO THE MEDITERRANEAN!!', 'Any  cruise deals to the Mediterranean']
+
+
+def concurrently(count, request):
+    results = [None] * count
+    barrier = threading.Barrier(count)
+
+    def run(number):
+        barrier.wait()
+        start = time.perf_counter()
+        response = request(number)
+        results[number] = (response, time.perf_counter() - start)
+
+    threads = [threading.Thread(target=run, args=(number,)) for number in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=40)
+    parser.add_argument('--burst-requests', type=int, default=20)
+    parser.add_argument('--llm-latency', type=float, default=0.2)
+    parser.add_argument('--search-latency', type=float, default=0.05)
+    args = parser.parse_args()
+
+    # the stub conversations and log records go to a scratch directory, instance/ and app.log are left alone
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ.update({
+            'DATABASE_URL': f'sqlite:///{os.path.join(directory, "db.sqlite")}',
+            'EMBEDDING_CACHE_DB': os.path.join(directory, 'embedding_cache.sqlite'),
+            'DEAL_CATALOG_DB': os.path.join(directory, 'deal_catalog.sqlite'),
+            'URL_INDEX_PATH': os.path.join(directory, 'url_index'),
+            'LOG_FILE': os.path.join(directory, 'app.log'),
+        })
+        failures = check(args)
+
+    for failure in failures:
+        print(f'FAIL {failure}')
+    print('OK' if not failures else f'{len(failures)} failures')
+    raise SystemExit(1 if failures else 0)
+
+
+def check(args):
+    chatter4 = install_stubs(args.llm_latency, args.search_latency)
+    from app import app
+    import response_cache
+
+    runs = []
+    get_response = chatter4.get_response
+
+    def counted(query):
+        runs.append(query)
+        return get_response(query)
+
+    chatter4.get_response = counted
+    client = app.test_client()
+    failures = []
+
+    # 1. coalescing
+    admission.admission = admission.Admission(rate=100, burst=args.clients)
+    results = concurrently(args.clients, lambda number: client.get(
+        '/chat', query_string={'message': SPELLINGS[number % len(SPELLINGS)]},
+        environ_base={'REMOTE_ADDR': f'10.0.{number // 250}.{number % 250}'}))
+    answers = {response.get_data(as_text=True) for response, _ in results}
+    latencies = [elapsed for _, elapsed in results]
+    print(f'coalescing: {args.clients} concurrent requests, {len(runs)} agent run(s), {len(answers)} distinct answer(s), '
+          f'p50 {percentile(latencies, 50) * 1000:.0f} ms, p99 {percentile(latencies, 99) * 1000:.0f} ms, '
+          f'{admission.flights.stats()}')
+    if len(runs) != 1 or len(answers) != 1 or any(response.status_code != 200 for response, _ in results):
+        failures.append('identical concurrent questions were not coalesced into one agent run')
+
+    # 2. admission control
+    response_cache.cache.invalidate()
+    limits = admission.Admission(rate=2, burst=5, queue=2, max_wait=5)
+    admission.admission = limits
+    other = {}
+
+    def burst(number):
+        if number == args.burst_requests:
+            time.sleep(0.05)
+            response = client.get('/chat', query_string={'message': 'what is the cheapest package to london'},
+                                  environ_base={'REMOTE_ADDR': '192.0.2.2'})
+            other['status'] = response.status_code
+            return response
+        return client.get('/chat', query_string={'message': f'how much for a trip to Las Vegas #{number}'},
+                          environ_base={'REMOTE_ADDR': '192.0.2.1'})
+
+    results = concurrently(args.burst_requests + 1, burst)[:args.burst_requests]
+    served = [elapsed for response, elapsed in results if response.status_code == 200]
+    rejected = [(response, elapsed) for response, elapsed in results if response.status_code == 429]
+    expected = limits.burst + limits.queue
+    print(f'admission: {args.burst_requests} concurrent requests from one IP, {len(served)} served '
+          f'(max {max(served) * 1000:.0f} ms), {len(rejected)} rejected with 429 '
+          f'(max {max(elapsed for _, elapsed in rejected) * 1000 if rejected else 0:.1f} ms, '
+          f'Retry-After {rejected[0][0].headers.get("Retry-After") if rejected else None}), '
+          f'other IP {other.get("status")}, {limits.stats()}')
+    if len(served) != expected or len(rejected) != args.burst_requests - expected:
+        failures.append(f'expected {expected} served and {args.burst_requests - expected} rejected')
+    if rejected and max(elapsed for _, elapsed in rejected) > 0.05:
+        failures.append('429 responses were not immediate')
+    if any('Retry-After' not in response.headers for response, _ in rejected):
+        failures.append('429 without Retry-After')
+    if other.get('status') != 200:
+        failures.append('a second client was starved by the first')
+
+    # 3. asyncio singleflight
+    async def coalesce():
+        calls = []
+
+        async def slow(question):
+            calls.append(question)
+            await asyncio.sleep(args.llm_latency)
+            return question.upper()
+
+        flights = admission.SingleFlight()
+        answers = await asyncio.gather(*(flights.ado('same', slow, 'answer') for _ in range(args.clients)))
+        return calls, set(answers)
+
+    calls, answers = asyncio.run(coalesce())
+    print(f'async coalescing: {args.clients} concurrent coroutines, {len(calls)} run(s), {len(answers)} answer(s)')
+    if len(calls) != 1 or len(answers) != 1:
+        failures.append('asyncio singleflight ran more than once')
+    return failures
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Run one question set through every chat engine and compare latency, LLM calls, tokens, cost and answers.
+
+    python -m bench.compare_engines --mode record --sources qa_bank --limit 50    # once, with live API keys
+    python -m bench.compare_engines --sources qa_bank --limit 50 --json compare.json
+    python -m bench.compare_engines --mode stub --engines chatter3,chatter4
+
+Backends go through replay.py as in replay_bench, so a recorded run compares the engines on the same
+OpenAI, Serper, Google and OpenWeatherMap answers. Every question gets a fresh session, nothing one
+engine remembers leaks into the next question. Agreement is engines.agreement between two engines'
+answers to the same question: the mean, and the share of questions at or above AGREEMENT_THRESHOLD.
+An engine that can't be built here (no Pinecone index, no local vector store) is reported and skipped.
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("RESPONSE_CACHE_DB", "")
+os.environ.setdefault("KNOWLEDGE_POLL_INTERVAL", "0")
+# chatter.py reads these without defaults
+os.environ.setdefault("RETURN_DOCS_COUNT_CORE", "4")
+os.environ.setdefault("RETURN_DOCS_COUNT_TBB", "4")
+os.environ.setdefault("CHAT_HISTORY_COUNT", "2")
+
+from bench.replay_bench import SOURCES, load_questions, percentile  # noqa: E402 (sets the replay API keys first)
+
+import engines  # noqa: E402
+import metrics  # noqa: E402
+import replay  # noqa: E402
+import session_memory  # noqa: E402
+
+
+def ask(engine, number, question):
+    session_memory.current_session.set(f'compare-{engine.name}-{number}')
+    with metrics.trace() as request_trace:
+        answer = engine.get_response(question)
+    return answer, request_trace.to_dict()
+
+
+def run(engine, questions, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(lambda item: ask(engine, *item), enumerate(questions)))
+
+
+def summarize(results):
+    latencies = [trace['total_ms'] for _, trace in results]
+    count = len(results)
+    return {
+        'questions': count,
+        'failures': sum(1 for answer, _ in results if answer.startswith('Unable to complete request')),
+        'request_ms': {'p50': percentile(latencies, 50), 'p90': percentile(latencies, 90),
+                       'p99': percentile(latencies, 99), 'mean': round(statistics.mean(latencies), 1)},
+        'llm_calls': round(sum(len(trace['llm_calls']) for _, trace in results) / count, 2),
+        'prompt_tokens': round(sum(trace['prompt_tokens'] for _, trace in results) / count, 1),
+        'completion_tokens': round(sum(trace['completion_tokens'] for _, trace in results) / count, 1),
+        'cost_usd': round(sum(trace['cost_usd'] for _, trace in results) / count, 6),
+        'total_cost_usd': round(sum(trace['cost_usd'] for _, trace in results), 4),
+    }
+
+
+def agreements(answers):
+    pairs = {}
+    for first, second in itertools.combinations(answers, 2):
+        scores = [engines.agreement(a, b) for a, b in zip(answers[first], answers[second])]
+        pairs[f'{first}/{second}'] = {
+            'mean': round(statistics.mean(scores), 3),
+            'agree': round(sum(1 for score in scores if score >= engines.AGREEMENT_THRESHOLD) / len(scores), 3),
+        }
+    return pairs
+
+
+def report(summaries, pairs, skipped):
+    print(f'{"engine":<10}{"fail":>6}{"p50 ms":>9}{"p90 ms":>9}{"p99 ms":>9}{"LLM calls":>11}'
+          f'{"prompt tok":>12}{"compl tok":>11}{"$/question":>12}{"$ total":>10}')
+    for name, row in summaries.items():
+        request_ms = row['request_ms']
+        print(f'{name:<10}{row["failures"]:>6}{request_ms["p50"]:>9.0f}{request_ms["p90"]:>9.0f}'
+              f'{request_ms["p99"]:>9.0f}{row["llm_calls"]:>11.2f}{row["prompt_tokens"]:>12.0f}'
+              f'{row["completion_tokens"]:>11.0f}{row["cost_usd"]:>12.5f}{row["total_cost_usd"]:>10.4f}')
+    for pair, row in pairs.items():
+        print(f'agreement {pair:<20} mean {row["mean"]:.2f}, {row["agree"]:.0%} of answers agree')
+    for name, error in skipped.items():
+        print(f'{name}: skipped, {error}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engines', default=','.join(engines.ENGINES))
+    parser.add_argument('--mode', choices=replay.MODES, default=replay.REPLAY_MODE)
+    parser.add_argument('--cassette', default=replay.REPLAY_CASSETTE)
+    parser.add_argument('--sources', default='qa_bank', help=f'comma separated, any of {",".join(SOURCES)}')
+    parser.add_argument('--limit', type=int, help='only the first N questions')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--llm-latency', type=float, default=0.5)
+    parser.add_argument('--search-latency', type=float, default=0.2)
+    parser.add_argument('--recorded-latency', action='store_true', help='sleep as long as each recorded call took')
+    parser.add_argument('--json', help='write the summaries, agreement and every answer to this file')
+    parser.add_argument('--verbose', action='store_true', help='keep the pipelines\' own output')
+    args = parser.parse_args()
+
+    sources = [source for source in args.sources.split(',') if source]
+    questions = load_questions(sources, args.limit)
+    if not questions:
+        parser.error(f'no questions found in {sources}')
+
+    latency = {} if args.recorded_latency else {
+        'chat': args.llm_latency,
+        'embedding': args.llm_latency / 10,
+        'serper': args.search_latency,
+        'google': args.search_latency,
+        'weather': args.search_latency,
+    }
+    replay.install(args.mode, args.cassette, latency)
+
+    summaries, answers, skipped = {}, {}, {}
+    for name in [name for name in args.engines.split(',') if name]:
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        try:
+            with output:
+                start = time.perf_counter()
+                engine = engines.get(name)
+                engine.warmup()
+                loaded = time.perf_counter() - start
+                results = run(engine, questions, args.concurrency)
+        except Exception as e:
+            skipped[name] = repr(e)
+            continue
+        summaries[name] = dict(summarize(results), load_s=round(loaded, 2))
+        answers[name] = [answer for answer, _ in results]
+    replay.uninstall()
+
+    pairs = agreements(answers)
+    print(f'{len(questions)} questions')
+    report(summaries, pairs, skipped)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'summaries': summaries, 'agreement': pairs, 'skipped': skipped,
+                       'answers': [dict(question=question, **{name: answers[name][number] for name in answers})
+                                   for number, question in enumerate(questions)]}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
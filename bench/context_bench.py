@@ -0,0 +1,146 @@
+"""Prompt tokens saved by context_budget and what the trimmed context still holds, on the replayed question set.
+
+    python -m bench.context_bench                                  # recorded Serper results from the cassette
+    python -m bench.context_bench --budgets 200,400,800,1500
+    python -m bench.context_bench --live --limit 20                # also ask chain_tbb_deal with both contexts
+
+Contexts come from the Serper responses recorded in the replay cassette (bench.replay_bench --mode record);
+questions without a recording get a synthetic Serper page: the deal's own snippets with prices, the same
+snippet repeated by other sites, and snippets of other destinations. Fact recall is the share of the prices,
+durations and dates of the raw context that survive trimming. --live needs real API keys and compares the
+answers given with the raw and the trimmed context.
+"""
+import argparse
+import os
+import random
+import re
+import statistics
+
+from langchain.utilities import GoogleSerperAPIWrapper
+
+import context_budget
+import deal_catalog
+import metrics
+import replay
+import search_client
+import url_index
+from bench.replay_bench import SOURCES, load_questions
+
+MODEL = 'gpt-4-0613'
+FACT = re.compile(r'\$\s?[\d,]+(?:\.\d+)?|\b\d+\s*(?:nights?|days?)\b|\b(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)'
+                  r'[a-z]*\.?\s+\d{1,2}\b', re.IGNORECASE)
+# search results for other destinations, reviews and guides that share words with the question but not the deal
+OTHER_SNIPPETS = [
+    '{name} vacation ideas, reviews and travel tips from thousands of travellers.',
+    'Read about the best time to visit {name}, where to stay and what to pack for your trip.',
+    'Top 10 things to do in {name} this year, from beaches to museums and local food markets.',
+    'Cheap flights to {name} from ${price} return, compare airlines and book online today.',
+    '{name} all inclusive resorts ranked by families, couples and solo travellers.',
+    'Is {name} safe to visit? Travel advisories, entry requirements and health information.',
+]
+
+
+def facts(text):
+    return {' '.join(match.lower().split()) for match in FACT.findall(text)}
+
+
+def recorded_contexts(cassette_path):
+    # question -> Serper snippet text, from the recordings of search_serper_with_source and search_google
+    if not os.path.exists(cassette_path):
+        return {}
+    # parses only, the key is never sent
+    parser = search_client.SerperClient(GoogleSerperAPIWrapper(serper_api_key='unused'))
+    contexts = {}
+    for entry in replay.Cassette(cassette_path).entries.values():
+        if entry['kind'] == 'serper':
+            question = entry['request']['q'].split(' + ', 1)[-1]
+            contexts[question.lower()] = parser._parse(entry['response']).text
+    return contexts
+
+
+def synthetic_context(question, pairs, rng):
+    # what a Serper page for "<deal url> + <question>" looks like: the deal, echoes of it, and everything else
+    pair = max(pairs, key=lambda p: len(set(url_index.tokenize(p['question'])) & set(url_index.tokenize(question))))
+    place = ' '.join(pair['url'].rstrip('/').rsplit('/', 1)[-1].replace('-', ' ').split()).title() or 'Mexico'
+    nights, price = rng.choice([5, 7, 10, 14]), rng.randrange(899, 4999, 10)
+    deal = [f'{place}: {nights} nights from ${price:,} per person, flights and transfers included.',
+            f'Departures on Nov {rng.randint(1, 28)} and Jan {rng.randint(1, 28)}, book by the end of the month.',
+            f'Travel Best Bets has hand picked {place} packages for {question.lower().rstrip("?")}.']
+    echoes = [f'{deal[0]} Call 1-877-523-7823.', deal[0].upper(), f'Best Bets: {deal[0]}']
+    others = []
+    for other in rng.sample(pairs, min(8, len(pairs))):
+        if other is pair:
+            continue
+        name = ' '.join(other['url'].rstrip('/').rsplit('/', 1)[-1].replace('-', ' ').split()).title()
+        others.append(rng.choice(OTHER_SNIPPETS).format(name=name, price=rng.randrange(499, 2999, 10)))
+    snippets = deal + echoes + others
+    rng.shuffle(snippets)
+    return ' '.join(snippets), facts(' '.join(deal))
+
+
+def answer_agreement(first, second):
+    a, b = url_index.tokenize(first), url_index.tokenize(second)
+    common = sum(min(a.count(token), b.count(token)) for token in set(a))
+    if not a or not b or not common:
+        return 0.0
+    precision, recall = common / len(b), common / len(a)
+    return 2 * precision * recall / (precision + recall)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sources', default='qa_bank,db,log', help=f'comma separated, any of {",".join(SOURCES)}')
+    parser.add_argument('--cassette', default=replay.REPLAY_CASSETTE)
+    parser.add_argument('--budgets', default=f'100,150,250,{context_budget.CONTEXT_BUDGET}')
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--live', action='store_true', help='ask chain_tbb_deal with the raw and the trimmed context')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    questions = load_questions(args.sources.split(','), args.limit)
+    text, _ = url_index.read_qa_bank()
+    pairs = url_index.parse_qa_bank(text)
+    recorded = recorded_contexts(args.cassette)
+
+    cases = []
+    for question in questions:
+        context = recorded.get(question.lower())
+        if context is not None:
+            cases.append((question, context, facts(context)))
+        else:
+            cases.append((question, *synthetic_context(question, pairs, rng)))
+    print(f'{len(cases)} questions, {sum(1 for q in questions if q.lower() in recorded)} with recorded Serper results, '
+          f'tokens counted for {MODEL}')
+
+    raw_tokens = [metrics.count_tokens(MODEL, context) for _, context, _ in cases]
+    print(f'raw context: mean {statistics.mean(raw_tokens):.0f} tokens, max {max(raw_tokens)}')
+
+    chain = None
+    if args.live:
+        import chatter4
+        chain = chatter4.components.get('chain_tbb_deal')
+
+    for budget in [int(b) for b in args.budgets.split(',')]:
+        kept_tokens, recall, agreement = [], [], []
+        for (question, context, expected), before in zip(cases, raw_tokens):
+            trimmed = context_budget.fit_text(context, question, 'bench', MODEL, budget=budget,
+                                              boost=deal_catalog.DETAIL_PATTERN)
+            kept_tokens.append(metrics.count_tokens(MODEL, trimmed))
+            if expected:
+                recall.append(len(expected & facts(trimmed)) / len(expected))
+            if chain is not None:
+                full = chain({'context': context, 'question': question})['text']
+                short = chain({'context': trimmed, 'question': question})['text']
+                agreement.append(answer_agreement(full, short))
+
+        saved = 1 - sum(kept_tokens) / sum(raw_tokens)
+        line = (f'budget {budget:>5}: mean {statistics.mean(kept_tokens):6.0f} tokens kept, {saved:6.1%} saved, '
+                f'fact recall {statistics.mean(recall) if recall else 1.0:6.1%}')
+        if agreement:
+            line += f', answer agreement {statistics.mean(agreement):.2f}'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Crawl a local fixture copy of the deal pages into a scratch catalog and check extraction, conditional GETs,
+freshness and lookup latency, with no network access.
+
+    python -m bench.deal_catalog_check
+    python -m bench.deal_catalog_check --pages 200 --lookups 50000
+"""
+import argparse
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import deal_catalog
+import url_index
+
+
+def fixture_page(path, number):
+    # real deal pages wrap a short itinerary in navigation, scripts and a footer that must not reach the prompt
+    return f"""<html><head><title>Deal {number} | Travel Best Bets</title><script>var tracking = {number};</script></head>
+<body><header><nav><a href="/deals/">Deals</a> <a href="/contact/">Contact</a></nav></header>
+<main><h1>Deal {number}</h1>
+<p>Sail away on an unforgettable trip with friends.</p>
+<p>7 nights from ${999 + number} per person, includes flights and transfers.</p>
+<ul><li>Day 1: Depart Toronto</li><li>Day 2: Arrive at {path}</li></ul>
+</main><footer>Copyright Travel Best Bets, all rights reserved.</footer></body></html>""".encode('utf-8')
+
+
+def fixture_site(paths):
+    pages = {path: fixture_page(path, number) for number, path in enumerate(paths)}
+    links = ''.join(f'<a href="{path}">{path}</a>' for path in paths if path.startswith('/deals/'))
+    pages['/deals'] = f'<html><body><main>{links}<a href="/deals/#top">top</a></main></body></html>'.encode('utf-8')
+    return pages
+
+
+def serve(pages, requests_seen):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = urlsplit(self.path).path.rstrip('/') or '/'
+            body = pages.get(path)
+            requests_seen.append(path)
+            if body is None:
+                self.send_error(404)
+                return
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=50, help='extra section pages beyond the QA_Bank deal URLs')
+    parser.add_argument('--lookups', type=int, default=10000)
+    args = parser.parse_args()
+
+    text, _ = url_index.read_qa_bank()
+    qa_urls = list(dict.fromkeys(pair['url'] for pair in url_index.parse_qa_bank(text)))
+    paths = [urlsplit(url if '://' in url else f'https://{url}').path.rstrip('/') or '/' for url in qa_urls]
+    paths = list(dict.fromkeys(paths + [f'/deals/fixture-{number}' for number in range(args.pages)]))
+    pages = fixture_site(paths)
+
+    requests_seen = []
+    server = serve(pages, requests_seen)
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    failures = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        catalog = deal_catalog.DealCatalog(db_path=os.path.join(directory, 'deals.sqlite'))
+        crawler = deal_catalog.Crawler(catalog, base_url=base_url)
+        urls = crawler.seed_urls(sections=['https://travelbestbets.com/deals/'])
+
+        first = crawler.crawl(urls)
+        requests_seen.clear()
+        second = crawler.crawl(urls)
+        if second.get('unchanged', 0) != first.get('updated', 0):
+            failures.append(f'recrawl was not conditional: {second}')
+
+        for url in qa_urls:
+            deal = catalog.lookup(url)
+            if deal is None:
+                failures.append(f'missing {url}')
+            elif '$' not in deal.text or 'Copyright' in deal.text or 'tracking' in deal.text:
+                failures.append(f'bad extraction for {url}: {deal.text[:120]}')
+        for variant in ('https://www.travelbestbets.com/deals/fixture-0/', 'travelbestbets.com/deals/fixture-0'):
+            if catalog.lookup(variant) is None:
+                failures.append(f'URL variant not matched: {variant}')
+
+        catalog.max_age = 0
+        time.sleep(0.01)
+        if catalog.lookup(qa_urls[0]) is not None:
+            failures.append('stale page served instead of falling back to live search')
+        catalog.max_age = deal_catalog.DEAL_CATALOG_MAX_AGE
+
+        start = time.perf_counter()
+        for number in range(args.lookups):
+            catalog.lookup(qa_urls[number % len(qa_urls)])
+        per_lookup = (time.perf_counter() - start) / args.lookups
+
+        sample = catalog.get(qa_urls[0])
+        print(f'\n{len(urls)} pages crawled from {base_url}, first {first}, recrawl {second}')
+        print(f'sample {sample.url}: {sample.title}\n  {sample.text[:200]}')
+        print(f'lookup {per_lookup * 1e6:.1f} us per deal, {catalog.stats()}')
+
+    server.shutdown()
+    for failure in failures:
+        print(f'FAIL {failure}')
+    print('OK' if not failures else f'{len(failures)} failures')
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
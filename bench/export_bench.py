@@ -0,0 +1,125 @@
+"""Peak memory of the /api/export history export against the table size, next to the unbounded /api/data it replaces.
+
+    python -m bench.export_bench
+    python -m bench.export_bench --rows 1000,100000,1000000,10000000 --formats ndjson,csv,parquet,legacy
+
+Every export runs in a fresh process against a seeded SQLite copy of the conversation table. The peak RSS
+counter is reset once the app is imported (/proc/self/clear_refs), so the peak is what the export itself
+added. "legacy" is the old /api/data without start and length: every row loaded as an ORM object and sent as
+one JSON document. Parquet needs pyarrow.
+"""
+import argparse
+import gc
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.history_bench import SCHEMA, seed
+
+STUB_KEYS = ('OPENAI_API_KEY', 'SERPER_API_KEY', 'GOOGLE_API_KEY', 'GOOGLE_CSE_ID', 'OPENWEATHERMAP_API_KEY')
+
+
+def status(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def reset_peak():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def child(export_format, directory):
+    import replay
+
+    replay.install(replay.STUB, cassette=os.path.join(directory, 'cassette.json'))
+    from app import Conversation, app
+
+    client = app.test_client()
+    gc.collect()
+    reset = reset_peak()
+    baseline = status('VmRSS')
+    start = time.perf_counter()
+    size = 0
+    if export_format == 'legacy':
+        with app.app_context():
+            size = len(json.dumps({'data': [c.to_dict() for c in Conversation.query.all()]}, default=str))
+    else:
+        response = client.get(f'/api/export?format={export_format}', headers={'X-Admin-Token': 'bench'},
+                              buffered=False)
+        if response.status_code != 200:
+            raise SystemExit(f'{export_format}: status {response.status_code} {response.get_data(as_text=True)}')
+        for part in response.iter_encoded():
+            size += len(part)
+        response.close()
+    elapsed = time.perf_counter() - start
+    print(json.dumps({'baseline_mb': baseline, 'peak_mb': status('VmHWM'), 'reset': reset, 'bytes': size,
+                      'seconds': elapsed}))
+
+
+def run(export_format, directory, database):
+    env = dict(os.environ)
+    env.update({key: 'stub' for key in STUB_KEYS})
+    env.update({
+        'CHATGPT_MODEL': env.get('CHATGPT_MODEL', 'gpt-3.5-turbo'),
+        'DATABASE_URL': f'sqlite:///{database}',
+        'ADMIN_TOKEN': 'bench',
+        'RESPONSE_CACHE_DB': '',
+        'EMBEDDING_CACHE_DB': os.path.join(directory, 'embedding_cache.sqlite'),
+        'DEAL_CATALOG_DB': os.path.join(directory, 'deal_catalog.sqlite'),
+        'URL_INDEX_PATH': os.path.join(directory, 'url_index'),
+        'LOG_FILE': os.path.join(directory, 'app.log'),
+        'LOG_LEVEL': 'INFO',
+        'KNOWLEDGE_POLL_INTERVAL': '0',
+    })
+    output = subprocess.run([sys.executable, '-m', 'bench.export_bench', '--child', export_format,
+                             '--directory', directory], env=env, capture_output=True, text=True)
+    if output.returncode != 0:
+        raise RuntimeError(output.stderr.strip().splitlines()[-1] if output.stderr.strip() else output.stdout)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', default='1000,100000,1000000')
+    parser.add_argument('--formats', default='ndjson,csv,parquet,legacy')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--directory', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.directory)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in [int(n) for n in args.rows.split(',')]:
+            database = os.path.join(directory, f'export-{rows}.sqlite')
+            connection = sqlite3.connect(database)
+            connection.execute(SCHEMA)
+            seed(connection, rows)
+            connection.close()
+            for export_format in args.formats.split(','):
+                try:
+                    result = run(export_format, directory, database)
+                except RuntimeError as e:
+                    print(f'{rows:>9} rows {export_format:>8}: failed, {e}')
+                    continue
+                print(f'{rows:>9} rows {export_format:>8}: peak {result["peak_mb"]:7.1f} MB, '
+                      f'+{result["peak_mb"] - result["baseline_mb"]:6.1f} MB over the idle app, '
+                      f'{result["bytes"] / 1e6:8.1f} MB in {result["seconds"]:5.1f}s'
+                      f'{"" if result["reset"] else " (peak counter not reset, includes startup)"}')
+
+
+if __name__ == '__main__':
+    main()
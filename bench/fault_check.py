@@ -0,0 +1,253 @@
+"""Deadlines, retries, hedging and circuit breakers of chatter4 against fault-injecting stub backends.
+
+    python -m bench.fault_check
+    python -m bench.fault_check --requests 400 --concurrency 40
+
+The TravelBestBets path is run end to end with its GPT-4 chain, the CHATGPT_MODEL backup and Serper
+replaced by stubs that add latency, hang or fail on demand:
+
+1. tail latency: 5% of GPT-4 calls take 2s; p99 with and without hedging, sync and asyncio. (A tail as
+   common as 10% would be the p90 itself, hedging at p90 is for rarer stragglers.)
+2. GPT-4 outage: every call fails with 503; answers come from the backup, the breaker stops calling
+   GPT-4 after BREAKER_FAILURES failures and closes again once GPT-4 recovers.
+3. flaky Serper: 30% of searches fail with 503; retries with jittered backoff hide them.
+4. hung Serper: searches never answer; requests give up after SEARCH_TIMEOUT per attempt, and fail in
+   microseconds once the breaker is open.
+5. deadline: every backend takes 5s; the request answers "Unable to complete request." at REQUEST_DEADLINE.
+"""
+import argparse
+import asyncio
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+os.environ.setdefault("REQUEST_DEADLINE", "3")
+os.environ.setdefault("LLM_TIMEOUT", "4")
+os.environ.setdefault("SEARCH_TIMEOUT", "0.3")
+os.environ.setdefault("RETRY_BASE", "0.02")
+os.environ.setdefault("RETRY_CAP", "0.1")
+os.environ.setdefault("BREAKER_RESET", "1")
+os.environ.setdefault("RESPONSE_CACHE_DB", "")
+os.environ.setdefault("KNOWLEDGE_POLL_INTERVAL", "0")
+
+import openai  # noqa: E402
+import requests  # noqa: E402
+from langchain.utilities import GoogleSerperAPIWrapper  # noqa: E402
+
+from bench.loadtest import QUESTIONS, StubChain, install_stubs, percentile  # noqa: E402
+
+import resilience  # noqa: E402
+import router  # noqa: E402
+import search_client  # noqa: E402
+
+ANSWER = 'Puerto Vallarta 7 nights from $1,299 <a href="https://travelbestbets.com/deals/" target="_blank">source</a>'
+
+
+def service_unavailable():
+    return openai.error.ServiceUnavailableError('The server is overloaded or not ready yet.', http_status=503)
+
+
+def serper_unavailable():
+    response = requests.Response()
+    response.status_code = 503
+    return requests.HTTPError('503 Server Error', response=response)
+
+
+class Faults:
+    # what a stub does on its next call: sleep for latency(), then raise error() with probability failure
+
+    def __init__(self, latency=0.05, failure=0.0, error=service_unavailable, seed=0):
+        self.latency = latency
+        self.failure = failure
+        self.error = error
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency(self._rng) if callable(self.latency) else self.latency
+            failed = self._rng.random() < self.failure
+        return delay, failed
+
+
+class FaultyChain(StubChain):
+
+    def __init__(self, faults, output=ANSWER):
+        super().__init__(0, output)
+        self.faults = faults
+
+    def __call__(self, inputs, return_only_outputs=False, **kwargs):
+        delay, failed = self.faults.next()
+        time.sleep(delay)
+        if failed:
+            raise self.faults.error()
+        return {'text': self.output, 'output_text': self.output}
+
+    async def acall(self, inputs, return_only_outputs=False, **kwargs):
+        delay, failed = self.faults.next()
+        await asyncio.sleep(delay)
+        if failed:
+            raise self.faults.error()
+        return {'text': self.output, 'output_text': self.output}
+
+
+class FaultySerper(GoogleSerperAPIWrapper):
+    faults: Any
+
+    def results(self, query, **kwargs):
+        delay, failed = self.faults.next()
+        time.sleep(delay)
+        if failed:
+            raise self.faults.error()
+        return {'organic': [{'link': 'https://travelbestbets.com/deals/puerto-vallarta-mexico/',
+                             'snippet': f'7 nights all-inclusive from $1,299 for {query}'}]}
+
+    async def aresults(self, query, **kwargs):
+        delay, failed = self.faults.next()
+        await asyncio.sleep(delay)
+        if failed:
+            raise self.faults.error()
+        return {'organic': [{'link': 'https://travelbestbets.com/deals/puerto-vallarta-mexico/',
+                             'snippet': f'7 nights all-inclusive from $1,299 for {query}'}]}
+
+
+def tail(rng):
+    # spread out like a real model: with every normal call at exactly 0.1s the p90 is the median too, and
+    # scheduling jitter alone would send a third of the requests past the hedge delay
+    return 2.0 if rng.random() < 0.05 else rng.uniform(0.06, 0.14)
+
+
+def install(chatter4, primary=None, backup=None, serper=None):
+    # fresh breakers and latency windows, and the stubs for this scenario
+    resilience.breakers.clear()
+    resilience.latencies.clear()
+    primary, backup, serper = primary or Faults(), backup or Faults(), serper or Faults(latency=0.02)
+    chatter4.components.override('chain_tbb_deal', FaultyChain(primary))
+    chatter4.components.override('chain_tbb_deal_fast', FaultyChain(backup))
+    chatter4.components.override('serper_search', search_client.SerperClient(FaultySerper(faults=serper), ttl=0))
+    return primary, backup, serper
+
+
+def run(chatter4, requests_count, concurrency):
+    def one(number):
+        start = time.perf_counter()
+        answer = chatter4.get_response(f'{QUESTIONS[number % len(QUESTIONS)]} #{number}')
+        return time.perf_counter() - start, answer
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(one, range(requests_count)))
+
+
+async def arun(chatter4, requests_count, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(number):
+        async with semaphore:
+            start = time.perf_counter()
+            answer = await chatter4.aget_response(f'{QUESTIONS[number % len(QUESTIONS)]} #{number}')
+            return time.perf_counter() - start, answer
+
+    return await asyncio.gather(*(one(number) for number in range(requests_count)))
+
+
+def summary(results):
+    latencies = [elapsed for elapsed, _ in results]
+    failed = sum(1 for _, answer in results if answer == 'Unable to complete request.')
+    return (f'p50 {percentile(latencies, 50) * 1000:6.0f} ms, p99 {percentile(latencies, 99) * 1000:6.0f} ms, '
+            f'max {max(latencies) * 1000:6.0f} ms, {failed}/{len(results)} failed')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    args = parser.parse_args()
+
+    chatter4 = install_stubs(0.01, 0.01)
+    chatter4.components.override('chain_lookup', StubChain(0.01, 'travelbestbets.com/deals/puerto-vallarta-mexico/'))
+    # every question takes the TravelBestBets path, the router is not under test
+    chatter4.route = lambda query: chatter4.direct_routes[router.DEAL]
+    failures = []
+
+    # 1. tail latency
+    for label, runner in (('sync', lambda: run(chatter4, args.requests, args.concurrency)),
+                          ('async', lambda: asyncio.run(arun(chatter4, args.requests, args.concurrency)))):
+        primary, backup, _ = install(chatter4, primary=Faults(latency=tail), backup=Faults(latency=0.15))
+        resilience.HEDGE_ENABLED = False
+        unhedged = runner()
+        resilience.HEDGE_ENABLED = True
+        before = backup.calls
+        hedged = runner()
+        share = (backup.calls - before) / args.requests
+        print(f'tail latency ({label}), no hedging: {summary(unhedged)}')
+        print(f'tail latency ({label}),    hedging: {summary(hedged)}, backup asked for {share:.0%} of requests, '
+              f'hedge after {resilience.hedge_delay("chain_tbb_deal") * 1000:.0f} ms')
+        if percentile([e for e, _ in hedged], 99) > 0.6 * percentile([e for e, _ in unhedged], 99):
+            failures.append(f'{label}: hedging did not cut p99')
+        if share > 0.3:
+            failures.append(f'{label}: hedging asked the backup for {share:.0%} of requests')
+        # abandoned sync primaries still finish and report their latency, not into the next scenario's window
+        time.sleep(2.1)
+
+    # 2. GPT-4 outage and recovery
+    primary, backup, _ = install(chatter4, primary=Faults(failure=1.0), backup=Faults(latency=0.15))
+    outage = run(chatter4, args.requests // 2, args.concurrency)
+    state = resilience.breakers[chatter4.llm_backend(chatter4.TBB_DEAL_MODEL)].state
+    print(f'GPT-4 outage: {summary(outage)}, GPT-4 called {primary.calls} times for {len(outage)} requests, '
+          f'breaker {state}')
+    if primary.calls > resilience.BREAKER_FAILURES + args.concurrency or state != 'open':
+        failures.append('the breaker did not stop calls to the failing model')
+    if any(answer != ANSWER for _, answer in outage):
+        failures.append('requests failed during the GPT-4 outage')
+    primary.failure = 0.0
+    time.sleep(resilience.BREAKER_RESET + 0.1)
+    run(chatter4, 5, 1)
+    state = resilience.breakers[chatter4.llm_backend(chatter4.TBB_DEAL_MODEL)].state
+    print(f'GPT-4 recovered: breaker {state}')
+    if state != 'closed':
+        failures.append('the breaker did not close after recovery')
+
+    # 3. flaky Serper
+    for retries in (0, resilience.CALL_RETRIES):
+        install(chatter4, serper=Faults(latency=0.02, failure=0.3, error=serper_unavailable))
+        saved, resilience.CALL_RETRIES = resilience.CALL_RETRIES, retries
+        flaky = run(chatter4, args.requests, args.concurrency)
+        resilience.CALL_RETRIES = saved
+        ok = sum(1 for _, answer in flaky if answer == ANSWER) / len(flaky)
+        print(f'flaky Serper, {retries} retries: {summary(flaky)}, {ok:.1%} answered')
+        if retries and ok < 0.95:
+            failures.append('retries did not hide a 30% Serper error rate')
+
+    # 4. hung Serper
+    _, _, serper = install(chatter4, serper=Faults(latency=5.0))
+    hung = run(chatter4, 20, 4)
+    first = [elapsed for elapsed, _ in hung[:4]]
+    print(f'hung Serper: {summary(hung)}, first requests {max(first) * 1000:.0f} ms, Serper called {serper.calls} '
+          f'times, breaker {resilience.breakers["serper"].state}')
+    if max(elapsed for elapsed, _ in hung) > (resilience.SEARCH_TIMEOUT + resilience.RETRY_CAP) * 3 + 0.5:
+        failures.append('a hung search held the request past its timeouts')
+    if resilience.breakers['serper'].state != 'open':
+        failures.append('the serper breaker did not open')
+
+    # 5. request deadline
+    install(chatter4, primary=Faults(latency=5.0), backup=Faults(latency=5.0))
+    slow = run(chatter4, 4, 4)
+    print(f'deadline {resilience.REQUEST_DEADLINE}s, every model taking 5s: {summary(slow)}')
+    if max(elapsed for elapsed, _ in slow) > resilience.REQUEST_DEADLINE + 0.5:
+        failures.append('a request outlived its deadline')
+    if any(answer != 'Unable to complete request.' for _, answer in slow):
+        failures.append('a request past its deadline did not answer "Unable to complete request."')
+
+    for failure in failures:
+        print(f'FAIL {failure}')
+    print('OK' if not failures else f'{len(failures)} failures')
+    os._exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Query latency of the /api/data history endpoint before and after the FTS5 index and keyset pagination.
+
+    python -m bench.history_bench --rows 1000000
+"""
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import history_index
+
+DESTINATIONS = ["Mexico", "Cancun", "Riviera Maya", "Las Vegas", "Hawaii", "Bali", "Italy", "Greece", "Danube",
+                "Japan", "Peru", "Costa Rica", "London", "Ireland", "Kelowna", "Anaheim", "Alaska", "Aspen"]
+TOPICS = ["all-inclusive", "cruise", "guided tour", "family package", "ski resort", "longstay", "river cruise"]
+
+SCHEMA = """CREATE TABLE conversation (
+    id INTEGER NOT NULL,
+    date DATETIME,
+    question VARCHAR(256),
+    answer VARCHAR(1000),
+    PRIMARY KEY (id)
+)"""
+
+
+def seed(connection, rows, batch=50000):
+    start = datetime.datetime(2023, 5, 27)
+    rng = random.Random(42)
+    for offset in range(0, rows, batch):
+        values = []
+        for i in range(offset, min(offset + batch, rows)):
+            destination, topic = rng.choice(DESTINATIONS), rng.choice(TOPICS)
+            if i % 10000 == 0:
+                topic = 'honeymoon'
+            values.append((
+                (start + datetime.timedelta(seconds=i * 30)).isoformat(' '),
+                f'Do you have a {topic} deal to {destination}?',
+                f'Our best {topic} to {destination} starts at ${rng.randint(499, 4999)} per person. '
+                f'<a href="https://travelbestbets.com/deals/{destination.lower().replace(" ", "-")}/">source</a>',
+            ))
+        connection.executemany("INSERT INTO conversation (date, question, answer) VALUES (?, ?, ?)", values)
+        connection.commit()
+
+
+def timed(connection, sql, params=(), repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        connection.execute(sql, params).fetchall()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--search', default='cancun', help='a common term')
+    parser.add_argument('--rare', default='honeymoon', help='a term found in one row out of 10000')
+    parser.add_argument('--page', type=int, default=20)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'history_bench.sqlite')
+    connection = sqlite3.connect(path)
+    connection.execute(SCHEMA)
+
+    start = time.perf_counter()
+    seed(connection, args.rows)
+    print(f'seeded {args.rows} conversations in {time.perf_counter() - start:.1f}s ({path})')
+
+    like, rare_like = f'%{args.search}%', f'%{args.rare}%'
+    like_filter = "question LIKE ? OR answer LIKE ?"
+    deep = args.rows - args.rows // 10
+    before = {
+        'search': timed(connection, f"SELECT * FROM conversation WHERE {like_filter} ORDER BY id LIMIT ?",
+                        (like, like, args.page)),
+        'search count': timed(connection, f"SELECT count(*) FROM conversation WHERE {like_filter}", (like, like)),
+        'rare search': timed(connection, f"SELECT * FROM conversation WHERE {like_filter} ORDER BY id LIMIT ?",
+                             (rare_like, rare_like, args.page)),
+        'rare count': timed(connection, f"SELECT count(*) FROM conversation WHERE {like_filter}",
+                            (rare_like, rare_like)),
+        'total count': timed(connection, "SELECT count(*) FROM conversation"),
+        'sort by date': timed(connection, "SELECT * FROM conversation ORDER BY date DESC LIMIT ?", (args.page,)),
+        'deep page': timed(connection, "SELECT * FROM conversation ORDER BY id LIMIT ? OFFSET ?", (args.page, deep)),
+    }
+
+    start = time.perf_counter()
+    for statement in history_index.setup_statements():
+        connection.execute(statement)
+    connection.execute(history_index.FTS_REBUILD)
+    connection.commit()
+    print(f'built FTS5 and date indexes in {time.perf_counter() - start:.1f}s')
+
+    match, rare_match = history_index.match_expression(args.search), history_index.match_expression(args.rare)
+    after_id = connection.execute("SELECT id FROM conversation ORDER BY id LIMIT 1 OFFSET ?", (deep - 1,)).fetchone()[0]
+    match_filter = history_index.MATCH_FILTER.replace(':match', '?')
+    after = {
+        'search': timed(connection, f"SELECT * FROM conversation WHERE {match_filter} ORDER BY id LIMIT ?",
+                        (match, args.page)),
+        'search count': timed(connection, f"SELECT count(*) FROM conversation WHERE {match_filter}", (match,)),
+        'rare search': timed(connection, f"SELECT * FROM conversation WHERE {match_filter} ORDER BY id LIMIT ?",
+                             (rare_match, args.page)),
+        'rare count': timed(connection, f"SELECT count(*) FROM conversation WHERE {match_filter}", (rare_match,)),
+        'total count': timed(connection, "SELECT max(id) FROM conversation"),
+        'sort by date': timed(connection, "SELECT * FROM conversation ORDER BY date DESC, id DESC LIMIT ?",
+                              (args.page,)),
+        'deep page': timed(connection, "SELECT * FROM conversation WHERE id > ? ORDER BY id LIMIT ?",
+                           (after_id, args.page)),
+    }
+
+    print(f'{"query":<14}{"before ms":>12}{"after ms":>12}{"speedup":>10}')
+    for name in before:
+        print(f'{name:<14}{before[name]:>12.2f}{after[name]:>12.2f}{before[name] / max(after[name], 1e-6):>9.0f}x')
+
+
+if __name__ == "__main__":
+    main()
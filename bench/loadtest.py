@@ -0,0 +1,188 @@
+"""Concurrent load test for the chat pipeline with stubbed LLM and search backends.
+
+    python -m bench.loadtest --users 50 --requests 4
+    python -m bench.loadtest --mode sync --threads 4
+    ADMISSION_ENABLED=false gunicorn -c gunicorn.conf.py wsgi:application &
+    python -m bench.loadtest --url http://127.0.0.1:8000/chat
+
+Every --url request comes from one address, a server with admission on answers most of them 429 at
+ADMISSION_RATE. Those are counted apart and left out of the latencies.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain.utilities import GoogleSerperAPIWrapper
+
+os.environ.setdefault("OPENAI_API_KEY", "stub")
+os.environ.setdefault("SERPER_API_KEY", "stub")
+os.environ.setdefault("GOOGLE_API_KEY", "stub")
+os.environ.setdefault("GOOGLE_CSE_ID", "stub")
+os.environ.setdefault("OPENWEATHERMAP_API_KEY", "stub")
+os.environ.setdefault("CHATGPT_MODEL", "gpt-3.5-turbo")
+
+QUESTIONS = [
+    "I'm looking for a cheap all-inclusive to Mexico",
+    "do you have a cruise to the Mediterranean with air included",
+    "What is a good package for families to Anaheim",
+    "how much for a trip to Las Vegas with air & hotel",
+    "I'm looking for a river cruise on the Danube",
+    "what is the cheapest package to london",
+]
+
+
+class StubChain:
+
+    def __init__(self, latency, output):
+        self.latency = latency
+        self.output = output
+
+    def __call__(self, inputs, return_only_outputs=False, **kwargs):
+        time.sleep(self.latency)
+        return {'text': self.output, 'output_text': self.output}
+
+    async def acall(self, inputs, return_only_outputs=False, **kwargs):
+        await asyncio.sleep(self.latency)
+        return {'text': self.output, 'output_text': self.output}
+
+
+class StubSerper(GoogleSerperAPIWrapper):
+    # the wrapper's request replaced, its snippet parsing kept
+    latency: float = 0.0
+
+    def _results(self, query):
+        return {'organic': [{'link': 'https://travelbestbets.com/deals/puerto-vallarta-mexico/',
+                             'snippet': f'7 nights all-inclusive from $1,299 for {query}'}]}
+
+    def results(self, query, **kwargs):
+        time.sleep(self.latency)
+        return self._results(query)
+
+    async def aresults(self, query, **kwargs):
+        await asyncio.sleep(self.latency)
+        return self._results(query)
+
+
+class StubAgent:
+    # stands in for the routing LLM call, then hands over to the real TravelBestBets tool
+
+    def __init__(self, chatter, latency):
+        self.chatter = chatter
+        self.latency = latency
+
+    def run(self, query):
+        time.sleep(self.latency)
+        return self.chatter.search_tbb(query)
+
+    async def arun(self, query):
+        await asyncio.sleep(self.latency)
+        return await self.chatter.asearch_tbb(query)
+
+
+def install_stubs(llm_latency, search_latency):
+    import chatter4
+    import search_client
+
+    answer = 'Puerto Vallarta 7 nights from $1,299 <a href="https://travelbestbets.com/deals/" target="_blank">source</a>'
+    components = chatter4.components
+    components.override('chain_lookup', StubChain(llm_latency, 'travelbestbets.com/deals/puerto-vallarta-mexico/'))
+    components.override('chain_tbb_deal', StubChain(llm_latency, answer))
+    components.override('chain_search_google', StubChain(llm_latency, answer))
+    components.override('serper_search', search_client.SerperClient(StubSerper(latency=search_latency), ttl=0))
+    components.override('agent', StubAgent(chatter4, llm_latency))
+    return chatter4
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def report(label, latencies, elapsed):
+    print(f'{label}: {len(latencies)} requests in {elapsed:.2f}s ({len(latencies) / elapsed:.1f} req/s)')
+    print(f'  p50 {percentile(latencies, 50) * 1000:.0f} ms  '
+          f'p90 {percentile(latencies, 90) * 1000:.0f} ms  '
+          f'p99 {percentile(latencies, 99) * 1000:.0f} ms  '
+          f'mean {statistics.mean(latencies) * 1000:.0f} ms')
+
+
+async def run_async(chatter, users, requests_per_user):
+    latencies = []
+
+    async def user():
+        for _ in range(requests_per_user):
+            start = time.perf_counter()
+            await chatter.aget_response(random.choice(QUESTIONS))
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(users)))
+    return latencies, time.perf_counter() - start
+
+
+def run_sync(chatter, users, requests_per_user, threads):
+    def one(_):
+        start = time.perf_counter()
+        chatter.get_response(random.choice(QUESTIONS))
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        latencies = list(executor.map(one, range(users * requests_per_user)))
+    return latencies, time.perf_counter() - start
+
+
+async def run_http(url, users, requests_per_user):
+    import httpx
+
+    latencies, throttled = [], 0
+    async with httpx.AsyncClient(timeout=None) as client:
+        async def user():
+            nonlocal throttled
+            for _ in range(requests_per_user):
+                start = time.perf_counter()
+                response = await client.get(url, params={'message': random.choice(QUESTIONS)})
+                if response.status_code == 429:
+                    throttled += 1
+                    continue
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(users)))
+    return latencies, time.perf_counter() - start, throttled
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['async', 'sync'], default='async')
+    parser.add_argument('--url', help='drive a running server over HTTP instead of the in-process pipeline')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=4, help='requests per user')
+    parser.add_argument('--threads', type=int, default=4, help='worker threads for --mode sync')
+    parser.add_argument('--llm-latency', type=float, default=0.4)
+    parser.add_argument('--search-latency', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.url:
+        latencies, elapsed, throttled = asyncio.run(run_http(args.url, args.users, args.requests))
+        if throttled:
+            print(f'{throttled} requests throttled (429), run the server with ADMISSION_ENABLED=false')
+        if latencies:
+            report(f'http {args.users} users', latencies, elapsed)
+        return
+
+    chatter = install_stubs(args.llm_latency, args.search_latency)
+    if args.mode == 'async':
+        latencies, elapsed = asyncio.run(run_async(chatter, args.users, args.requests))
+    else:
+        latencies, elapsed = run_sync(chatter, args.users, args.requests, args.threads)
+    report(f'{args.mode} {args.users} users', latencies, elapsed)
+
+
+if __name__ == "__main__":
+    main()
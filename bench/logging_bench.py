@@ -0,0 +1,107 @@
+"""Logging cost on the request thread: the old synchronous basicConfig file handler versus the
+logging_setup queue pipeline, with and without sampling, for the records one /chat request writes.
+
+    python -m bench.logging_bench
+    python -m bench.logging_bench --requests 20000 --threads 8 --wait-ms 0
+
+A real request spends its time waiting on the LLM and search APIs, which is when the listener thread writes;
+--wait-ms sleeps that long between requests, 0 measures a tight loop where the listener competes for the GIL.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import logging_setup
+
+ANSWER = ('Here are a few Mediterranean cruise deals: 7 nights from $1,299 per person including flights, '
+          '<a href="https://travelbestbets.com/deals/oceania-mediterranean-2/" target="_blank">source</a>. ') * 8
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def old_request(logger, number):
+    # what app.py logged per request before logging_setup
+    logger.debug(f'Request IP: 127.0.0.{number % 250}')
+    logger.debug("Conversation Customer:" + f'any cruise deals to the mediterranean for {number % 12} people?')
+    logger.debug("Conversation Chatbot: " + ANSWER)
+
+
+def new_request(logger, number):
+    logging_setup.request_id.set(logging_setup.new_request_id())
+    logger.debug('Conversation Customer:%s', f'any cruise deals to the mediterranean for {number % 12} people?',
+                 extra={'ip': f'127.0.0.{number % 250}'})
+    logger.debug('Conversation Chatbot: %s', ANSWER)
+
+
+def run(request, logger, requests, threads, wait):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(offset):
+        local = []
+        for number in range(offset, requests, threads):
+            start = time.perf_counter()
+            request(logger, number)
+            local.append(time.perf_counter() - start)
+            if wait:
+                time.sleep(wait)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=worker, args=(offset,)) for offset in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return latencies
+
+
+def scenario(name, directory, requests, threads, wait, **setup):
+    path = os.path.join(directory, f'{name}.log')
+    root = logging.getLogger()
+    if name == 'basicConfig':
+        handler = logging.FileHandler(path)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        root.addHandler(handler)
+        root.setLevel(logging.DEBUG)
+        latencies = run(old_request, logging.getLogger('app'), requests, threads, wait)
+        root.removeHandler(handler)
+        handler.close()
+    else:
+        logging_setup.setup(path=path, level='DEBUG', levels='', stderr=False, **setup)
+        latencies = run(new_request, logging.getLogger('app.conversation'), requests, threads, wait)
+        # the file is complete only once the listener has drained the queue
+        logging_setup.shutdown()
+
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    print(f'{name:<22} mean {sum(latencies) / len(latencies) * 1e6:7.1f} us  '
+          f'p50 {percentile(latencies, 50) * 1e6:7.1f} us  p99 {percentile(latencies, 99) * 1e6:7.1f} us  '
+          f'{size / 1024:8.0f} KiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--wait-ms', type=float, default=2.0)
+    args = parser.parse_args()
+
+    print(f'{args.requests} requests on {args.threads} threads, {args.wait_ms} ms between requests, '
+          f'logging time per request on the request thread')
+    wait = args.wait_ms / 1000
+    with tempfile.TemporaryDirectory() as directory:
+        scenario('basicConfig', directory, args.requests, args.threads, wait)
+        scenario('queue json', directory, args.requests, args.threads, wait, fmt='json', sample='')
+        scenario('queue text', directory, args.requests, args.threads, wait, fmt='text', sample='')
+        scenario('queue json sample 0.1', directory, args.requests, args.threads, wait, fmt='json',
+                 sample='app.conversation=0.1')
+
+
+if __name__ == '__main__':
+    main()
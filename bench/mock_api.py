@@ -0,0 +1,289 @@
+"""Local stand-in for the OpenAI, Serper, Google Custom Search and OpenWeatherMap APIs, for load tests without quota.
+
+    python -m bench.mock_api --port 8600
+    python -m bench.mock_api --latency chat=lognormal:1.2:0.6,serper=uniform:0.1:0.8 --errors chat=0.02,serper=0.05
+    python -m bench.mock_api --token-latency 0.03 --error-status 429
+
+The app is pointed at it through the clients' base URLs:
+
+    OPENAI_API_BASE=http://127.0.0.1:8600/v1 SERPER_API_BASE=http://127.0.0.1:8600 \\
+    GOOGLE_API_BASE=http://127.0.0.1:8600 OPENWEATHERMAP_API_BASE=http://127.0.0.1:8600 gunicorn ...
+
+It speaks enough of each wire format for ChatOpenAI, OpenAIEmbeddings, SerperClient, GoogleSearchAPIWrapper
+and pyowm:
+
+    POST /v1/chat/completions   a completion, or one server-sent chunk per token with "stream": true
+    POST /v1/embeddings         also under /v1/engines/<engine>/, as OpenAIEmbeddings sends them
+    POST /search                Serper, the query in the URL as the clients send it, or in a JSON body
+    GET  /customsearch/v1       Google Custom Search
+    GET  /data/2.5/weather      OpenWeatherMap current weather
+    GET  /stats                 calls, injected errors and mean latency per backend
+
+Answers are scripted from data/QA_Bank.txt: a search returns the deal pages of the closest QA bank
+questions, the agent is walked through one tool call (the step replay.py stubs), and answers quote the
+closest deal page. Every call waits for a latency drawn from its backend's distribution, in seconds:
+fixed:S, uniform:LOW:HIGH, normal:MEAN:SD or lognormal:MEDIAN:SIGMA. A streamed completion waits for the
+first token, then --token-latency per token.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import uuid
+from collections import defaultdict
+
+from aiohttp import web
+
+import replay
+import response_cache
+import router
+import url_index
+
+BACKENDS = ('chat', 'embedding', 'serper', 'google', 'weather')
+DEFAULT_LATENCY = 'chat=lognormal:0.8:0.5,embedding=fixed:0.05,serper=lognormal:0.3:0.4,' \
+                  'google=lognormal:0.3:0.4,weather=fixed:0.1'
+
+ERROR_BODIES = {
+    'chat': {'error': {'message': 'The server is overloaded or not ready yet.', 'type': 'server_error',
+                       'param': None, 'code': None}},
+    'embedding': {'error': {'message': 'The server is overloaded or not ready yet.', 'type': 'server_error',
+                            'param': None, 'code': None}},
+    'serper': {'message': 'Service temporarily unavailable', 'statusCode': 503},
+    'google': {'error': {'code': 503, 'message': 'The service is currently unavailable.', 'status': 'UNAVAILABLE'}},
+    'weather': {'cod': 503, 'message': 'Service temporarily unavailable'},
+}
+QUESTION = re.compile(r'^(?:Question|Human):\s*(.+)$', re.MULTILINE)
+
+
+def parse_distribution(text):
+    kind, *values = text.split(':')
+    values = [float(value) for value in values]
+    shapes = {
+        'fixed': lambda rng: values[0],
+        'uniform': lambda rng: rng.uniform(values[0], values[1]),
+        'normal': lambda rng: max(0.0, rng.gauss(values[0], values[1])),
+        'lognormal': lambda rng: rng.lognormvariate(0, values[1]) * values[0],
+    }
+    if kind not in shapes:
+        raise ValueError(f'unknown latency distribution {text!r}, one of {", ".join(shapes)}')
+    return shapes[kind]
+
+
+def parse_backends(text, convert):
+    pairs = {}
+    for item in text.split(','):
+        if '=' in item:
+            name, value = item.split('=', 1)
+            if name.strip() not in BACKENDS:
+                raise ValueError(f'unknown backend {name!r}, one of {", ".join(BACKENDS)}')
+            pairs[name.strip()] = convert(value.strip())
+    return pairs
+
+
+class Script:
+    # the scripted side of the APIs: deal pages, snippets, answers and weather from the QA bank
+
+    def __init__(self, path=url_index.QA_BANK_PATH):
+        text, _ = url_index.read_qa_bank(path)
+        self.pairs = url_index.parse_qa_bank(text)
+        self.words = [set(response_cache.normalize_query(pair['question']).split()) for pair in self.pairs]
+
+    def closest(self, text, k=1):
+        words = set(response_cache.normalize_query(text).split())
+        ranked = sorted(range(len(self.pairs)), key=lambda i: -len(words & self.words[i]))
+        return [self.pairs[i] for i in ranked[:k]]
+
+    @staticmethod
+    def title(url):
+        slug = url.rstrip('/').rsplit('/', 1)[-1]
+        return ' '.join(word.capitalize() for word in slug.split('-') if not word.isdigit())
+
+    def snippet(self, url):
+        seed = int.from_bytes(hashlib.sha256(url.encode('utf-8')).digest()[:4], 'big')
+        return (f'{self.title(url)}: {3 + seed % 11} nights from ${499 + seed % 40 * 50:,} per person, '
+                f'flights and hotel included.')
+
+    def results(self, query, k):
+        return [{'title': f'{self.title(pair["url"])} | Travel Best Bets', 'link': pair['url'],
+                 'snippet': self.snippet(pair['url'])} for pair in self.closest(query, k)]
+
+    def answer(self, messages):
+        content = '\n'.join(message.get('content') or '' for message in messages)
+        if 'action_input' in (messages[0].get('content') or ''):
+            return replay.stub_agent_step(messages[-1]['content'])
+        questions = QUESTION.findall(content)
+        question = questions[-1].strip() if questions else messages[-1].get('content', '')
+        url = self.closest(question)[0]['url']
+        if 'Provide url' in content:
+            return url
+        intent, _ = router.route(question)
+        if intent in (router.GREETING, router.CONTACT):
+            return ('Hi, I am TravelBot from Travel Best Bets. Call us at 1-877-523-7823 or write to '
+                    'info@travelbestbets.com, or ask me about a destination.')
+        return f'{self.snippet(url)}<br> <a href="{url}" target="_blank">{self.title(url)}</a>'
+
+    def weather(self, city):
+        seed = int.from_bytes(hashlib.sha256(city.lower().encode('utf-8')).digest()[:4], 'big')
+        now = int(time.time())
+        temp = 273.15 + 5 + seed % 25
+        return {
+            'coord': {'lon': -86.85, 'lat': 21.17},
+            'weather': [{'id': 800, 'main': 'Clear', 'description': 'clear sky', 'icon': '01d'}],
+            'base': 'stations',
+            'main': {'temp': temp, 'feels_like': temp, 'temp_min': temp - 3, 'temp_max': temp + 3,
+                     'pressure': 1013, 'humidity': 40 + seed % 50},
+            'visibility': 10000,
+            'wind': {'speed': 1 + seed % 9, 'deg': seed % 360},
+            'clouds': {'all': seed % 100},
+            'dt': now,
+            'sys': {'country': 'MX', 'sunrise': now - 6 * 3600, 'sunset': now + 6 * 3600},
+            'timezone': 0,
+            'id': seed % 1000000,
+            'name': city.split(',')[0].strip().title(),
+            'cod': 200,
+        }
+
+
+class MockAPI:
+
+    def __init__(self, script, latency, errors, error_status=503, token_latency=0.01, seed=None):
+        self.script = script
+        self.latency = latency
+        self.errors = errors
+        self.error_status = error_status
+        self.token_latency = token_latency
+        self.rng = random.Random(seed)
+        self.calls = defaultdict(int)
+        self.failed = defaultdict(int)
+        self.streamed = 0
+        self.waited = defaultdict(float)
+
+    async def wait(self, backend):
+        # the backend's latency, then None, or the error response this call gets instead of an answer
+        delay = self.latency[backend](self.rng) if backend in self.latency else 0.0
+        self.calls[backend] += 1
+        self.waited[backend] += delay
+        await asyncio.sleep(delay)
+        if self.rng.random() < self.errors.get(backend, 0.0):
+            self.failed[backend] += 1
+            return web.json_response(ERROR_BODIES[backend], status=self.error_status)
+        return None
+
+    async def chat(self, request):
+        body = await request.json()
+        error = await self.wait('chat')
+        if error is not None:
+            return error
+        content = self.script.answer(body['messages'])
+        completion_id = f'chatcmpl-{uuid.uuid4().hex[:24]}'
+        if not body.get('stream'):
+            return web.json_response({
+                'id': completion_id,
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': body.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                             'finish_reason': 'stop'}],
+                'usage': replay.estimate_usage(body, content),
+            })
+
+        self.streamed += 1
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        for chunk in replay.chat_chunks({'message': {'role': 'assistant', 'content': content}}):
+            if chunk['choices'][0]['delta'].get('content'):
+                await asyncio.sleep(self.token_latency)
+            chunk.update({'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                          'model': body.get('model')})
+            await response.write(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+    async def embeddings(self, request):
+        body = await request.json()
+        error = await self.wait('embedding')
+        if error is not None:
+            return error
+        response = replay.stub_embedding(body)
+        response['model'] = body.get('model') or request.match_info.get('engine')
+        return web.json_response(response)
+
+    async def serper(self, request):
+        params = dict(request.query)
+        if request.can_read_body:
+            params.update(await request.json())
+        error = await self.wait('serper')
+        if error is not None:
+            return error
+        results = self.script.results(params.get('q', ''), int(params.get('num') or 10))
+        return web.json_response({
+            'searchParameters': {**params, 'type': request.match_info['type']},
+            'organic': [dict(result, position=position) for position, result in enumerate(results, 1)],
+        })
+
+    async def google(self, request):
+        error = await self.wait('google')
+        if error is not None:
+            return error
+        results = self.script.results(request.query.get('q', ''), int(request.query.get('num') or 10))
+        return web.json_response({
+            'kind': 'customsearch#search',
+            'items': [dict(result, kind='customsearch#result', displayLink='travelbestbets.com')
+                      for result in results],
+        })
+
+    async def weather(self, request):
+        error = await self.wait('weather')
+        if error is not None:
+            return error
+        return web.json_response(self.script.weather(request.query.get('q', 'Cancun')))
+
+    async def stats(self, request):
+        return web.json_response({
+            backend: {'calls': self.calls[backend], 'errors': self.failed[backend],
+                      'mean_latency_ms': round(self.waited[backend] / self.calls[backend] * 1000, 1)
+                      if self.calls[backend] else 0.0}
+            for backend in BACKENDS
+        } | {'streamed': self.streamed})
+
+    def app(self):
+        application = web.Application()
+        application.add_routes([
+            web.post('/v1/chat/completions', self.chat),
+            web.post('/v1/embeddings', self.embeddings),
+            # the deprecated engine-scoped paths, which OpenAIEmbeddings still uses
+            web.post('/v1/engines/{engine}/chat/completions', self.chat),
+            web.post('/v1/engines/{engine}/embeddings', self.embeddings),
+            web.post('/{type:search|news|images|places}', self.serper),
+            web.get('/customsearch/v1', self.google),
+            web.get('/data/2.5/weather', self.weather),
+            web.get('/stats', self.stats),
+        ])
+        return application
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8600)
+    parser.add_argument('--latency', default='', help=f'per backend, over the defaults {DEFAULT_LATENCY}')
+    parser.add_argument('--errors', default='', help='share of calls that fail per backend, chat=0.02,serper=0.05')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--token-latency', type=float, default=0.01, help='seconds between streamed tokens')
+    parser.add_argument('--qa-bank', default=url_index.QA_BANK_PATH)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    latency = parse_backends(DEFAULT_LATENCY, parse_distribution)
+    latency.update(parse_backends(args.latency, parse_distribution))
+    mock = MockAPI(Script(args.qa_bank), latency, parse_backends(args.errors, float), args.error_status,
+                   args.token_latency, args.seed)
+    web.run_app(mock.app(), host=args.host, port=args.port, print=lambda message: print(message, flush=True))
+
+
+if __name__ == '__main__':
+    main()
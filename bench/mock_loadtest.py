@@ -0,0 +1,254 @@
+"""Load test of /chat under gunicorn, with every backend served by bench/mock_api.py: no API keys, no quota.
+
+    python -m bench.mock_loadtest
+    python -m bench.mock_loadtest --connections 64 --duration 60 --workers 4
+    python -m bench.mock_loadtest --rate 20 --duration 60 --errors chat=0.02,serper=0.05
+    python -m bench.mock_loadtest --latency chat=lognormal:2:0.8 --json mock_load.json
+
+The mock and gunicorn are started here, the app reaching the mock through OPENAI_API_BASE, SERPER_API_BASE,
+GOOGLE_API_BASE and OPENWEATHERMAP_API_BASE, so the run goes through the real clients, timeouts, retries
+and breakers. --latency, --errors and --token-latency are handed to the mock as they are.
+
+Closed loop by default: --connections clients each ask the next question as soon as the last is answered.
+With --rate the questions are sent on a fixed schedule instead, and latency counts from when a question was
+due, so a slow server shows up in the tail instead of slowing the load down. Every question is made unique,
+a response cache hit would measure nothing. Failed answers are the ones the app gives when a request could
+not complete. Writes go to a scratch directory, instance/ is left alone.
+"""
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from bench.serve_bench import STUB_KEYS, free_port, get, percentile, wait_ready
+
+import response_cache
+import url_index
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def wait_mock(process, port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'mock_api exited with {process.returncode}')
+        try:
+            status, _ = get(port, '/stats', timeout=2)
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'mock_api not up after {timeout}s')
+
+
+def mock_stats(port):
+    _, body = get(port, '/stats')
+    return json.loads(body)
+
+
+class Results:
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.failed = 0
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def add(self, latency, status, body):
+        with self._lock:
+            self.statuses[status] += 1
+            if status == 200:
+                self.latencies.append(latency)
+                if body.decode('utf-8', 'replace').strip() in response_cache.UNCACHEABLE_RESPONSES:
+                    self.failed += 1
+
+    def error(self, e):
+        with self._lock:
+            self.statuses['error'] += 1
+            self.errors.append(str(e))
+
+
+def ask(connection, question):
+    connection.request('GET', f'/chat?message={quote(question)}')
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+def closed_loop(port, questions, connections, duration, results):
+    deadline = time.monotonic() + duration
+
+    def client(number):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        sent = 0
+        while time.monotonic() < deadline:
+            question = f'{questions[(number + sent) % len(questions)]} #{number}-{sent}'
+            sent += 1
+            start = time.perf_counter()
+            try:
+                status, body = ask(connection, question)
+                results.add(time.perf_counter() - start, status, body)
+            except (OSError, http.client.HTTPException) as e:
+                results.error(e)
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        connection.close()
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def open_loop(port, questions, rate, connections, duration, results):
+    local = threading.local()
+
+    def send(number, due):
+        if not hasattr(local, 'connection'):
+            local.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        try:
+            status, body = ask(local.connection, f'{questions[number % len(questions)]} #{number}')
+            results.add(time.perf_counter() - due, status, body)
+        except (OSError, http.client.HTTPException) as e:
+            results.error(e)
+            local.connection.close()
+            del local.connection
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        for number in range(int(rate * duration)):
+            due = start + number / rate
+            time.sleep(max(0.0, due - time.perf_counter()))
+            executor.submit(send, number, due)
+
+
+def summarize(results, elapsed, before, after):
+    latencies = results.latencies
+    return {
+        'requests': sum(results.statuses.values()),
+        'answered': len(latencies),
+        'failed_answers': results.failed,
+        'statuses': {str(status): count for status, count in sorted(results.statuses.items(), key=str)},
+        'rps': round(len(latencies) / elapsed, 2),
+        'latency_ms': dict({f'p{pct:g}': round(percentile(latencies, pct) * 1000, 1) for pct in PERCENTILES},
+                           max=round(max(latencies, default=0.0) * 1000, 1)),
+        'backends': {name: {'calls': row['calls'] - before.get(name, {}).get('calls', 0),
+                            'errors': row['errors'] - before.get(name, {}).get('errors', 0),
+                            'mean_latency_ms': row['mean_latency_ms']}
+                     for name, row in after.items() if isinstance(row, dict)},
+        'first_error': results.errors[0] if results.errors else None,
+    }
+
+
+def report(summary, args):
+    mode = f'{args.rate} req/s open loop' if args.rate else f'{args.connections} connections closed loop'
+    print(f'{mode}, {args.workers} workers x {args.threads} threads, {args.duration:g}s')
+    print(f'{summary["requests"]} requests, {summary["answered"]} answered ({summary["failed_answers"]} failed '
+          f'answers), {summary["rps"]} req/s, statuses {summary["statuses"]}')
+    print('latency ms: ' + ', '.join(f'{name} {value:.0f}' for name, value in summary['latency_ms'].items()))
+    for name, row in summary['backends'].items():
+        print(f'  {name:<10}{row["calls"]:>7} calls{row["errors"]:>6} injected errors'
+              f'{row["mean_latency_ms"]:>9.0f} ms mean')
+    if summary['first_error']:
+        print(f'first error: {summary["first_error"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--connections', type=int, default=16, help='clients, or the most requests in flight with --rate')
+    parser.add_argument('--rate', type=float, help='requests per second, open loop')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--latency', help='per backend latency distributions, passed to mock_api')
+    parser.add_argument('--errors', help='per backend error rates, passed to mock_api')
+    parser.add_argument('--token-latency', type=float, help='seconds per streamed token, passed to mock_api')
+    parser.add_argument('--engine', default=os.environ.get('CHAT_ENGINE', 'chatter4'))
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for the workers to be ready')
+    parser.add_argument('--json', help='write the summary to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the mock\'s and gunicorn\'s output')
+    args = parser.parse_args()
+
+    text, _ = url_index.read_qa_bank()
+    questions = [pair['question'] for pair in url_index.parse_qa_bank(text)]
+    output = None if args.verbose else subprocess.DEVNULL
+
+    mock_port, port = free_port(), free_port()
+    mock_command = [sys.executable, '-m', 'bench.mock_api', '--host', '127.0.0.1', '--port', str(mock_port)]
+    for flag, value in (('--latency', args.latency), ('--errors', args.errors),
+                        ('--token-latency', args.token_latency)):
+        if value is not None:
+            mock_command += [flag, str(value)]
+    base = f'http://127.0.0.1:{mock_port}'
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ)
+        env.update({key: 'mock' for key in STUB_KEYS})
+        env.update({
+            'OPENAI_API_BASE': f'{base}/v1',
+            'SERPER_API_BASE': base,
+            'GOOGLE_API_BASE': base,
+            'OPENWEATHERMAP_API_BASE': base,
+            'CHATGPT_MODEL': env.get('CHATGPT_MODEL', 'gpt-3.5-turbo'),
+            'CHAT_ENGINE': args.engine,
+            # every question comes from this one address
+            'ADMISSION_ENABLED': 'false',
+            'GUNICORN_BIND': f'127.0.0.1:{port}',
+            'WEB_CONCURRENCY': str(args.workers),
+            'GUNICORN_THREADS': str(args.threads),
+            'DATABASE_URL': f'sqlite:///{os.path.join(directory, "db.sqlite")}',
+            'RESPONSE_CACHE_DB': '',
+            'EMBEDDING_CACHE_DB': os.path.join(directory, 'embedding_cache.sqlite'),
+            'DEAL_CATALOG_DB': os.path.join(directory, 'deal_catalog.sqlite'),
+            'URL_INDEX_PATH': os.path.join(directory, 'url_index'),
+            'LOG_FILE': os.path.join(directory, 'app.log'),
+            'LOG_LEVEL': 'INFO',
+        })
+
+        mock = subprocess.Popen(mock_command, env=env, stdout=output, stderr=output)
+        server = None
+        try:
+            wait_mock(mock, mock_port, 30)
+            server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:application'],
+                                      env=env, stdout=output, stderr=output)
+            wait_ready(server, port, args.workers, args.timeout)
+            before = mock_stats(mock_port)
+            results = Results()
+            start = time.perf_counter()
+            if args.rate:
+                open_loop(port, questions, args.rate, args.connections, args.duration, results)
+            else:
+                closed_loop(port, questions, args.connections, args.duration, results)
+            elapsed = time.perf_counter() - start
+            summary = summarize(results, elapsed, before, mock_stats(mock_port))
+        finally:
+            for process in (server, mock):
+                if process is None:
+                    continue
+                process.terminate()
+                try:
+                    process.wait(30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+    report(summary, args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(summary, mode='open' if args.rate else 'closed', rate=args.rate,
+                           connections=args.connections, workers=args.workers, threads=args.threads,
+                           duration=args.duration), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""Replay real question sets through chatter4.get_response against recorded backends.
+
+    python -m bench.replay_bench --mode record --sources qa_bank          # once, with live API keys
+    python -m bench.replay_bench --sources qa_bank,db,log --json run.json
+    python -m bench.replay_bench --mode stub --baseline baseline.json    # CI, fails on a regression
+
+Every OpenAI, Serper, Google and OpenWeatherMap call goes through replay.py, so runs are offline
+and repeatable. Simulated backend latency is fixed per kind, or --recorded-latency replays the
+latency measured while recording.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import re
+import sqlite3
+import statistics
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("CHATGPT_MODEL", "gpt-3.5-turbo")
+os.environ.setdefault("OPENAI_API_KEY", "replay")
+os.environ.setdefault("SERPER_API_KEY", "replay")
+os.environ.setdefault("GOOGLE_API_KEY", "replay")
+os.environ.setdefault("GOOGLE_CSE_ID", "replay")
+os.environ.setdefault("OPENWEATHERMAP_API_KEY", "replay")
+
+import metrics
+import replay
+import url_index
+
+SOURCES = ('qa_bank', 'db', 'log')
+CUSTOMER_LINE = re.compile(r'DEBUG Conversation Customer:(.*)$')
+
+
+def questions_from_qa_bank(path=url_index.QA_BANK_PATH):
+    text, _ = url_index.read_qa_bank(path)
+    return [pair['question'] for pair in url_index.parse_qa_bank(text)]
+
+
+def questions_from_db(path='./instance/db.sqlite'):
+    if not os.path.exists(path):
+        return []
+    with contextlib.closing(sqlite3.connect(path)) as connection:
+        return [row[0] for row in connection.execute("SELECT question FROM conversation ORDER BY id")]
+
+
+def questions_from_log(path='./app.log'):
+    if not os.path.exists(path):
+        return []
+    questions = []
+    with open(path, encoding='utf-8', errors='ignore') as f:
+        for line in f:
+            if line.startswith('{'):
+                # JSON lines written by logging_setup
+                try:
+                    line = json.loads(line).get('msg', '')
+                except ValueError:
+                    continue
+                line = f'DEBUG {line}'
+            match = CUSTOMER_LINE.search(line.rstrip('\n'))
+            if match:
+                questions.append(match.group(1))
+    return questions
+
+
+def load_questions(sources, limit=None):
+    loaders = {'qa_bank': questions_from_qa_bank, 'db': questions_from_db, 'log': questions_from_log}
+    questions, seen = [], set()
+    for source in sources:
+        for question in loaders[source]():
+            question = question.strip()
+            if question and question.lower() not in seen:
+                seen.add(question.lower())
+                questions.append(question)
+    return questions[:limit] if limit else questions
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def ask(chatter, question):
+    with metrics.trace() as request_trace:
+        answer = chatter.get_response(question)
+    return answer, request_trace.to_dict()
+
+
+async def aask(chatter, question, semaphore):
+    async with semaphore:
+        with metrics.trace() as request_trace:
+            answer = await chatter.aget_response(question)
+    return answer, request_trace.to_dict()
+
+
+async def run_async(chatter, questions, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*(aask(chatter, question, semaphore) for question in questions))
+
+
+def run(questions, concurrency, use_async):
+    import chatter4
+
+    start = time.perf_counter()
+    if use_async:
+        results = asyncio.run(run_async(chatter4, questions, concurrency))
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda question: ask(chatter4, question), questions))
+    return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed, recorder):
+    requests = [trace['total_ms'] for _, trace in results]
+    stages = defaultdict(list)
+    for _, trace in results:
+        for span in trace['spans']:
+            stages[span['stage']].append(span['ms'])
+
+    return {
+        'questions': len(results),
+        'errors': sum(1 for answer, _ in results if answer == "Unable to complete request."),
+        'elapsed_s': round(elapsed, 3),
+        'throughput': round(len(results) / elapsed, 2),
+        'request_ms': {'p50': percentile(requests, 50), 'p90': percentile(requests, 90),
+                       'p99': percentile(requests, 99), 'mean': round(statistics.mean(requests), 1)},
+        'stages': {stage: {'count': len(values), 'p50': percentile(values, 50), 'p90': percentile(values, 90),
+                           'mean': round(statistics.mean(values), 1)} for stage, values in sorted(stages.items())},
+        'backend_calls': recorder.stats()['calls'],
+        'cassette_misses': recorder.stats()['misses'],
+    }
+
+
+def report(summary):
+    print(f'{summary["questions"]} questions in {summary["elapsed_s"]:.2f}s '
+          f'({summary["throughput"]:.1f} q/s), {summary["errors"]} errors')
+    request_ms = summary['request_ms']
+    print(f'request  p50 {request_ms["p50"]:.0f} ms  p90 {request_ms["p90"]:.0f} ms  '
+          f'p99 {request_ms["p99"]:.0f} ms  mean {request_ms["mean"]:.0f} ms')
+    print(f'{"stage":<24}{"count":>8}{"p50 ms":>10}{"p90 ms":>10}{"mean ms":>10}')
+    for stage, row in summary['stages'].items():
+        print(f'{stage:<24}{row["count"]:>8}{row["p50"]:>10.1f}{row["p90"]:>10.1f}{row["mean"]:>10.1f}')
+    print(f'backend calls {summary["backend_calls"]}  cassette misses {summary["cassette_misses"]}')
+
+
+def regressions(summary, baseline, tolerance):
+    found = []
+    if summary['throughput'] < baseline['throughput'] * (1 - tolerance):
+        found.append(f'throughput {summary["throughput"]} q/s < baseline {baseline["throughput"]} q/s')
+    for stage, row in summary['stages'].items():
+        before = baseline['stages'].get(stage)
+        if before and row['p50'] > before['p50'] * (1 + tolerance) + 1:
+            found.append(f'{stage} p50 {row["p50"]} ms > baseline {before["p50"]} ms')
+    for kind, calls in summary['backend_calls'].items():
+        if calls > baseline['backend_calls'].get(kind, 0):
+            found.append(f'{kind} calls {calls} > baseline {baseline["backend_calls"].get(kind, 0)}')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=replay.MODES, default=replay.REPLAY_MODE)
+    parser.add_argument('--cassette', default=replay.REPLAY_CASSETTE)
+    parser.add_argument('--sources', default='qa_bank,db,log', help=f'comma separated, any of {",".join(SOURCES)}')
+    parser.add_argument('--limit', type=int, help='replay only the first N questions')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--async', dest='use_async', action='store_true', help='replay through aget_response')
+    parser.add_argument('--llm-latency', type=float, default=0.5)
+    parser.add_argument('--search-latency', type=float, default=0.2)
+    parser.add_argument('--weather-latency', type=float, default=0.1)
+    parser.add_argument('--embedding-latency', type=float, default=0.05)
+    parser.add_argument('--recorded-latency', action='store_true', help='sleep as long as each recorded call took')
+    parser.add_argument('--json', help='write the summary to this file')
+    parser.add_argument('--baseline', help='summary from an earlier run, exit 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--verbose', action='store_true', help='keep the pipeline\'s own output')
+    args = parser.parse_args()
+
+    sources = [source for source in args.sources.split(',') if source]
+    questions = load_questions(sources, args.limit)
+    if not questions:
+        parser.error(f'no questions found in {sources}')
+
+    latency = {} if args.recorded_latency else {
+        'chat': args.llm_latency,
+        'embedding': args.embedding_latency,
+        'serper': args.search_latency,
+        'google': args.search_latency,
+        'weather': args.weather_latency,
+    }
+    recorder = replay.install(args.mode, args.cassette, latency)
+
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        results, elapsed = run(questions, args.concurrency, args.use_async)
+    replay.uninstall()
+
+    summary = summarize(results, elapsed, recorder)
+    report(summary)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            found = regressions(summary, json.load(f), args.tolerance)
+        for regression in found:
+            print(f'REGRESSION {regression}')
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Accuracy and latency of the local intent router against a held-out labeled question set.
+
+    python -m bench.router_eval [bench/router_labels.tsv]
+
+The router is trained on router.SEED_EXAMPLES and the QA bank questions. A labeled question that repeats
+one of them, or contains one word for word, is left out and listed: accuracy on training text says
+nothing. The false-route rate is the share of questions routed past the agent to the wrong intent.
+The questions in NOT_CONTACT must not get the canned contact answer, the run fails if one does.
+"""
+import csv
+import os
+import sys
+import time
+from collections import Counter
+
+import response_cache
+import router
+
+LABELS_PATH = os.path.join(os.path.dirname(__file__), 'router_labels.tsv')
+
+# once answered with the canned contact text because they mention a contact word
+NOT_CONTACT = [
+    "Do you have cruise deals that include a phone plan?",
+    "Can you contact the resort for me about the all-inclusive Mexico deal",
+    "what is the email policy",
+]
+
+
+def training_overlap(question, training):
+    text = f' {response_cache.normalize_query(question)} '
+    return next((example for example in training if f' {example} ' in text or text in f' {example} '), None)
+
+
+def main(path=LABELS_PATH):
+    with open(path, encoding='utf-8') as f:
+        rows = list(csv.DictReader(f, delimiter='\t'))
+
+    training = {response_cache.normalize_query(text) for _, text in router.SEED_EXAMPLES + router.qa_bank_examples()}
+    held_out = []
+    for row in rows:
+        example = training_overlap(row['question'], training)
+        if example is not None:
+            print(f'  excluded, training text {example!r}: {row["question"]}')
+        else:
+            held_out.append(row)
+    if not held_out:
+        sys.exit('no held-out questions left to evaluate')
+    excluded, rows = len(rows) - len(held_out), held_out
+
+    intent_router = router.get_router()
+    intent_router.route('warm up')
+
+    correct = routed = routed_correct = misrouted = 0
+    confusion = Counter()
+    latencies = []
+    for row in rows:
+        start = time.perf_counter()
+        intent, confidence = intent_router.route(row['question'])
+        latencies.append(time.perf_counter() - start)
+
+        confusion[(row['label'], intent)] += 1
+        correct += intent == row['label']
+        if confidence >= router.ROUTER_THRESHOLD:
+            routed += 1
+            routed_correct += intent == row['label']
+        elif intent != row['label']:
+            print(f'  fallback  {row["label"]:>8} -> {intent:<8} {confidence:.2f}  {row["question"]}')
+        if confidence >= router.ROUTER_THRESHOLD and intent != row['label']:
+            misrouted += 1
+            print(f'  MISROUTE  {row["label"]:>8} -> {intent:<8} {confidence:.2f}  {row["question"]}')
+
+    latencies.sort()
+    print(f'{len(rows)} held-out questions ({excluded} excluded as training text), '
+          f'threshold {router.ROUTER_THRESHOLD}')
+    print(f'top-1 accuracy:        {correct / len(rows):.1%}')
+    print(f'routed without agent:  {routed / len(rows):.1%}')
+    print(f'accuracy when routed:  {routed_correct / max(routed, 1):.1%}')
+    print(f'false-route rate:      {misrouted / len(rows):.1%}')
+    print(f'latency p50 {latencies[len(latencies) // 2] * 1e3:.3f} ms  '
+          f'p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.3f} ms')
+    print('confusion (label -> intent):')
+    for (label, intent), count in sorted(confusion.items()):
+        print(f'  {label:>8} -> {intent:<8} {count}')
+
+    regressions = 0
+    for question in NOT_CONTACT:
+        intent, confidence = intent_router.route(question)
+        if intent == router.CONTACT and confidence >= router.ROUTER_THRESHOLD:
+            regressions += 1
+            print(f'  REGRESSION routed to contact {confidence:.2f}  {question}')
+    print(f'contact regressions:   {regressions} of {len(NOT_CONTACT)}')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,226 @@
+"""Requests per second and memory per worker of the gunicorn serving mode, with stubbed OpenAI and Serper backends.
+
+    python -m bench.serve_bench
+    python -m bench.serve_bench --workers 1,4,8 --duration 20 --connections 64
+    python -m bench.serve_bench --no-preload          # every worker builds its own copy
+
+Memory is read from /proc/<pid>/smaps_rollup after the load: PSS splits shared pages between the processes
+that share them, private is what the worker owns alone, so preloading shows up as a lower private size.
+Writes go to a scratch directory, instance/ is left alone.
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+STUB_KEYS = ('OPENAI_API_KEY', 'SERPER_API_KEY', 'GOOGLE_API_KEY', 'GOOGLE_CSE_ID', 'OPENWEATHERMAP_API_KEY')
+
+
+def stub_application():
+    # gunicorn entry point: bench.serve_bench:stub_application(), loaded once in the master when preloading
+    import replay
+
+    latency = json.loads(os.environ.get('SERVE_BENCH_LATENCY', '{}'))
+    replay.install(replay.STUB, cassette=os.path.join(os.environ['SERVE_BENCH_DIR'], 'cassette.json'),
+                   latency=latency)
+    import wsgi
+
+    return wsgi.application
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def memory(pid):
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {'rss': fields.get('Rss', 0), 'pss': fields.get('Pss', 0),
+            'private': fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)}
+
+
+def children(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+
+def get(port, path, timeout=10):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def wait_ready(process, port, workers, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with {process.returncode}')
+        try:
+            status, _ = get(port, '/readyz', timeout=2)
+            if status == 200 and len(children(process.pid)) >= workers:
+                return time.monotonic()
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'not ready after {timeout}s')
+
+
+def load(port, questions, connections, duration):
+    latencies, errors = [], []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(number):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        sent = 0
+        local = []
+        while time.monotonic() < deadline:
+            # a unique question every time, a response cache hit would measure nothing
+            question = f'{questions[(number + sent) % len(questions)]} #{number}-{sent}'
+            sent += 1
+            start = time.perf_counter()
+            try:
+                connection.request('GET', f'/chat?message={quote(question)}')
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise http.client.HTTPException(f'status {response.status}')
+                local.append(time.perf_counter() - start)
+            except (OSError, http.client.HTTPException) as e:
+                with lock:
+                    errors.append(str(e))
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        connection.close()
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(connections)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.perf_counter() - start
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))] if ordered else 0.0
+
+
+def run(workers, args, questions, directory):
+    port = free_port()
+    env = dict(os.environ)
+    env.update({key: 'stub' for key in STUB_KEYS})
+    env.update({
+        'CHATGPT_MODEL': env.get('CHATGPT_MODEL', 'gpt-3.5-turbo'),
+        # every question comes from this one address, the token bucket would answer most of them with 429
+        'ADMISSION_ENABLED': 'false',
+        'GUNICORN_BIND': f'127.0.0.1:{port}',
+        'WEB_CONCURRENCY': str(workers),
+        'GUNICORN_THREADS': str(args.threads),
+        'GUNICORN_PRELOAD': 'true' if args.preload else 'false',
+        'SERVE_BENCH_DIR': directory,
+        'SERVE_BENCH_LATENCY': json.dumps({'chat': args.llm_latency, 'embedding': args.llm_latency,
+                                           'serper': args.search_latency, 'google': args.search_latency,
+                                           'weather': args.search_latency}),
+        'DATABASE_URL': f'sqlite:///{os.path.join(directory, f"db-{workers}.sqlite")}',
+        'RESPONSE_CACHE_DB': '',
+        'EMBEDDING_CACHE_DB': os.path.join(directory, 'embedding_cache.sqlite'),
+        'DEAL_CATALOG_DB': os.path.join(directory, 'deal_catalog.sqlite'),
+        'URL_INDEX_PATH': os.path.join(directory, 'url_index'),
+        'LOG_FILE': os.path.join(directory, f'app-{workers}.log'),
+        'LOG_LEVEL': 'INFO',
+    })
+
+    started = time.monotonic()
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+                                'bench.serve_bench:stub_application()'],
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE if not args.verbose else None)
+    try:
+        ready = wait_ready(process, port, workers, args.timeout) - started
+        latencies, errors, elapsed = load(port, questions, args.connections, args.duration)
+        worker_memory = [memory(pid) for pid in children(process.pid)]
+        master = memory(process.pid)
+    finally:
+        process.terminate()
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    return {
+        'workers': workers,
+        'ready_seconds': round(ready, 1),
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'master_rss_mb': round(master['rss'], 1),
+        'worker_rss_mb': round(sum(m['rss'] for m in worker_memory) / len(worker_memory), 1),
+        'worker_pss_mb': round(sum(m['pss'] for m in worker_memory) / len(worker_memory), 1),
+        'worker_private_mb': round(sum(m['private'] for m in worker_memory) / len(worker_memory), 1),
+        'total_pss_mb': round(master['pss'] + sum(m['pss'] for m in worker_memory), 1),
+        'first_error': errors[0] if errors else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='1,4,8')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--connections', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--llm-latency', type=float, default=0.05, help='seconds per stubbed OpenAI call')
+    parser.add_argument('--search-latency', type=float, default=0.02, help='seconds per stubbed search call')
+    parser.add_argument('--no-preload', dest='preload', action='store_false')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for the workers to be ready')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='show gunicorn output')
+    args = parser.parse_args()
+
+    import url_index
+
+    text, _ = url_index.read_qa_bank()
+    questions = [pair['question'] for pair in url_index.parse_qa_bank(text)]
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for workers in [int(n) for n in args.workers.split(',')]:
+            result = run(workers, args, questions, directory)
+            results.append(result)
+            print(f'{workers} workers{"" if args.preload else " (no preload)"}: ready in {result["ready_seconds"]}s, '
+                  f'{result["rps"]} req/s, p50 {result["p50_ms"]} ms, p99 {result["p99_ms"]} ms, '
+                  f'{result["errors"]} errors')
+            print(f'  per worker rss {result["worker_rss_mb"]} MB, pss {result["worker_pss_mb"]} MB, '
+                  f'private {result["worker_private_mb"]} MB; master rss {result["master_rss_mb"]} MB; '
+                  f'total pss {result["total_pss_mb"]} MB')
+            if result['first_error']:
+                print(f'  first error: {result["first_error"]}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
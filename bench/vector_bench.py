@@ -0,0 +1,90 @@
+"""Recall and latency of the local vector store: exact NumPy search versus IVF at several nprobe values.
+
+    python -m bench.vector_bench --vectors 100000 --dimensions 384
+    python -m bench.vector_bench --namespace tbb      # an imported namespace, sampled vectors as queries
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+import local_vectorstore
+
+
+def clustered_vectors(count, dimensions, clusters=200, seed=0):
+    # embeddings of real documents are clustered by topic, uniform random vectors would flatter nothing
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimensions)).astype(np.float32)
+    labels = rng.integers(clusters, size=count)
+    return local_vectorstore.normalize(centers[labels] + 0.6 * rng.standard_normal((count, dimensions)).astype(np.float32))
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def measure(namespace, queries, k, nprobe=None, exact=False):
+    centroids = namespace.centroids
+    if exact:
+        namespace.centroids = None
+    latencies, results = [], []
+    try:
+        for query in queries:
+            start = time.perf_counter()
+            results.append([row for row, _ in namespace.search(query, k, nprobe=nprobe)])
+            latencies.append(time.perf_counter() - start)
+    finally:
+        namespace.centroids = centroids
+    return results, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vectors', type=int, default=100000)
+    parser.add_argument('--dimensions', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=4)
+    parser.add_argument('--nprobe', default='1,4,8,16,32')
+    parser.add_argument('--namespace', help='benchmark an existing namespace under VECTOR_STORE_PATH')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    if args.namespace:
+        namespace = local_vectorstore.Namespace(local_vectorstore.VECTOR_STORE_PATH, args.namespace).load()
+        sample = rng.choice(len(namespace.records), min(args.queries, len(namespace.records)), replace=False)
+        queries = np.asarray(namespace.vectors[np.sort(sample)]) + 0.05 * rng.standard_normal(
+            (len(sample), namespace.vectors.shape[1])).astype(np.float32)
+    else:
+        vectors = clustered_vectors(args.vectors, args.dimensions)
+        queries = clustered_vectors(args.queries, args.dimensions, seed=2)
+        records = [{'id': str(i), 'metadata': {'text': ''}} for i in range(len(vectors))]
+        path = tempfile.mkdtemp()
+
+        start = time.perf_counter()
+        namespace = local_vectorstore.Namespace(path, 'bench').save(vectors, records, ivf_threshold=0)
+        print(f'built {len(vectors)} x {args.dimensions} IVF namespace with {len(namespace.centroids)} lists '
+              f'in {time.perf_counter() - start:.1f}s ({path})')
+
+        start = time.perf_counter()
+        local_vectorstore.Namespace(path, 'bench').load()
+        print(f'memory-mapped load took {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    truth, latencies = measure(namespace, queries, args.k, exact=True)
+    print(f'{"mode":<16}{"recall@" + str(args.k):>12}{"p50 ms":>10}{"p99 ms":>10}')
+    print(f'{"exact":<16}{1.0:>12.3f}{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 99) * 1000:>10.2f}')
+
+    if namespace.centroids is None:
+        print('namespace has no IVF index, only exact search was measured')
+        return
+
+    for nprobe in [int(value) for value in args.nprobe.split(',')]:
+        found, latencies = measure(namespace, queries, args.k, nprobe=nprobe)
+        recall = np.mean([len(set(a) & set(b)) / len(a) for a, b in zip(truth, found)])
+        print(f'{"ivf nprobe=" + str(nprobe):<16}{recall:>12.3f}'
+              f'{percentile(latencies, 50) * 1000:>10.2f}{percentile(latencies, 99) * 1000:>10.2f}')
+
+
+if __name__ == "__main__":
+    main()
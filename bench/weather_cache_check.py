@@ -0,0 +1,141 @@
+"""Check of the OpenWeatherMap report cache, against a stubbed OpenWeatherMap that takes --latency per call.
+
+    python -m bench.weather_cache_check
+    python -m bench.weather_cache_check --askers 100 --latency 0.5
+
+1. spellings of one place share an entry ("Cancun", "cancun, MX", "Cancún"), two countries with a city of
+   the same name do not (Paris, FR and Paris, US).
+2. entries expire after WEATHER_CACHE_TTL and the least recently used go once WEATHER_CACHE_SIZE is reached.
+3. --askers agent runs ask for the same city at once, in different spellings, through the chatter4 weather
+   tool: OpenWeatherMap is called once, and the time saved shows up in /metrics.
+"""
+import argparse
+import os
+import threading
+import time
+
+os.environ.setdefault("RESPONSE_CACHE_DB", "")
+os.environ.setdefault("KNOWLEDGE_POLL_INTERVAL", "0")
+
+from bench.loadtest import install_stubs  # noqa: E402 (sets the stub API keys first)
+
+from langchain.utilities import OpenWeatherMapAPIWrapper  # noqa: E402
+
+import metrics  # noqa: E402
+import weather_cache  # noqa: E402
+
+SAME = [('Cancun', 'cancun, MX'), ('Cancún', 'CANCUN'), ('cancun, Quintana Roo, MX', 'Cancun,mx'),
+        ('Paris, FR', 'paris'), ('Paris', 'Paris, fr')]
+DIFFERENT = [('Paris, FR', 'Paris, US'), ('Cancun', 'Cozumel'), ('Portland, US', 'Portland, GB')]
+SPELLINGS = ['Cancun', 'cancun, MX', 'Cancún', ' CANCUN ', 'Cancun, Quintana Roo, MX', 'cancún,mx']
+
+
+class Weather:
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, location):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        return f'In {location}, the current weather is as follows: Detailed status: clear sky #{self.calls}'
+
+
+def shared(first, second):
+    cache, weather = weather_cache.WeatherCache(), Weather(0)
+    return cache.get(first, weather) == cache.get(second, weather) and weather.calls == 1
+
+
+def counter(name, result=None):
+    labels = (('result', result),) if result else ()
+    return metrics.registry.counters.get((name, labels), 0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--askers', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.2)
+    args = parser.parse_args()
+    failures = []
+
+    # 1. normalization
+    for first, second in SAME:
+        ok = shared(first, second)
+        print(f'{first!r:>28} and {second!r:<16} share an entry: {ok}')
+        if not ok:
+            failures.append(f'{first!r} and {second!r} did not share an entry')
+    for first, second in DIFFERENT:
+        ok = not shared(first, second)
+        print(f'{first!r:>28} and {second!r:<16} kept apart: {ok}')
+        if not ok:
+            failures.append(f'{first!r} and {second!r} shared an entry')
+    cache, weather = weather_cache.WeatherCache(), Weather(0)
+    for location in ('Paris, FR', 'Paris, US', 'Paris'):
+        cache.get(location, weather)
+    print(f'Paris FR, Paris US, Paris: {weather.calls} calls')
+    if weather.calls != 3:
+        failures.append('a bare city name was answered from another country once the city was ambiguous')
+
+    # 2. TTL and LRU
+    cache, weather = weather_cache.WeatherCache(ttl=0.1, maxsize=2), Weather(0)
+    cache.get('Cancun', weather)
+    cache.get('Cancun', weather)
+    time.sleep(0.15)
+    cache.get('Cancun', weather)
+    cache.get('Lima', weather)
+    cache.get('Cancun', weather)
+    cache.get('Quito', weather)
+    cache.get('Cancun', weather)
+    cache.get('Lima', weather)
+    print(f'ttl and lru: {weather.calls} calls, {cache.stats()}')
+    if weather.calls != 5 or cache.stats()['size'] != 2:
+        failures.append(f'expected 5 calls and 2 entries, got {weather.calls} and {cache.stats()["size"]}')
+
+    # 3. concurrent agent runs through the chatter4 tool
+    chatter4 = install_stubs(0.01, 0.01)
+    weather = Weather(args.latency)
+    OpenWeatherMapAPIWrapper.run = lambda self, location: weather(location)
+    tool = next(tool for tool in chatter4.components.get('tools') if tool.name == 'OpenWeatherMap')
+    weather_cache.cache.clear()
+    saved = counter('chat_weather_cache_saved_seconds_total')
+    barrier = threading.Barrier(args.askers)
+    answers = [None] * args.askers
+
+    def ask(number):
+        barrier.wait()
+        answers[number] = tool.run(SPELLINGS[number % len(SPELLINGS)])
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=ask, args=(number,)) for number in range(args.askers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    later = [tool.run(spelling) for spelling in SPELLINGS]
+    hits = time.perf_counter() - start
+    saved = counter('chat_weather_cache_saved_seconds_total') - saved
+    print(f'{args.askers} concurrent askers: {weather.calls} OpenWeatherMap calls in {elapsed * 1000:.0f} ms, '
+          f'{len(later)} later asks in {hits * 1000:.1f} ms, {saved:.2f}s saved, {weather_cache.cache.stats()}')
+    print(f'lookups: {counter("chat_weather_cache_lookups_total", "hit"):.0f} hit, '
+          f'{counter("chat_weather_cache_lookups_total", "miss"):.0f} miss, '
+          f'{counter("chat_weather_cache_lookups_total", "coalesced"):.0f} coalesced')
+    if weather.calls != 1:
+        failures.append(f'{args.askers} concurrent askers made {weather.calls} OpenWeatherMap calls')
+    if len(set(answers + later)) != 1:
+        failures.append('askers did not all get the same report')
+    if saved < len(later) * args.latency * 0.9:
+        failures.append(f'{saved:.2f}s saved reported for {len(later)} hits')
+
+    for failure in failures:
+        print(f'FAIL {failure}')
+    print('OK' if not failures else f'{len(failures)} failures')
+    os._exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
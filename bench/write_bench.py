@@ -0,0 +1,100 @@
+"""Conversation insert throughput: one commit per request versus the batched write-behind queue.
+
+    python -m bench.write_bench --rows 20000 --threads 8 --batch-sizes 1,10,50,200
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, create_engine, text
+
+import history_index
+import persistence
+
+
+def make_table():
+    return Table(
+        'conversation', MetaData(),
+        Column('id', Integer, primary_key=True),
+        Column('date', DateTime),
+        Column('question', String(256)),
+        Column('answer', String(1000)),
+    )
+
+
+def make_engine(wal):
+    path = os.path.join(tempfile.mkdtemp(), 'write_bench.sqlite')
+    engine = create_engine(f'sqlite:///{path}')
+    if wal:
+        persistence.enable_wal(engine)
+    table = make_table()
+    table.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for statement in history_index.setup_statements():
+            connection.execute(text(statement))
+    return engine, table
+
+
+def row(i):
+    return {
+        'date': datetime.datetime.utcnow(),
+        'question': f'Do you have an all-inclusive deal to Mexico? #{i}',
+        'answer': 'Puerto Vallarta 7 nights from $1,299 <a href="https://travelbestbets.com/deals/">source</a>',
+    }
+
+
+def run(rows, threads, write):
+    latencies = []
+
+    def one(i):
+        start = time.perf_counter()
+        write(row(i))
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(one, range(rows)))
+    return start, latencies
+
+
+def report(label, rows, start, latencies):
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f'{label:<26}{rows / elapsed:>12.0f}{latencies[len(latencies) // 2] * 1e3:>12.3f}'
+          f'{latencies[int(len(latencies) * 0.99)] * 1e3:>12.3f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--batch-sizes', default='1,10,50,200')
+    args = parser.parse_args()
+
+    print(f'{"mode":<26}{"inserts/s":>12}{"p50 ms":>12}{"p99 ms":>12}   (latency seen by the request thread)')
+
+    for wal in (False, True):
+        engine, table = make_engine(wal)
+
+        def commit_per_row(values):
+            with engine.begin() as connection:
+                connection.execute(table.insert(), [values])
+
+        start, latencies = run(args.rows, args.threads, commit_per_row)
+        report(f'commit per row{" (WAL)" if wal else ""}', args.rows, start, latencies)
+
+    for batch_size in [int(size) for size in args.batch_sizes.split(',')]:
+        engine, table = make_engine(True)
+        writer = persistence.BatchWriter(engine, table, batch_size=batch_size, interval=0.05)
+
+        start, latencies = run(args.rows, args.threads, lambda values: writer.submit(**values))
+        writer.flush()
+        report(f'write-behind batch={batch_size}', args.rows, start, latencies)
+        writer.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,20 @@
 import os
-import pinecone
 from dotenv import load_dotenv
 from langchain.agents import AgentType
 from langchain.agents import initialize_agent, Tool, load_tools
 from langchain.chains import RetrievalQA, RetrievalQAWithSourcesChain
 from langchain.chat_models import ChatOpenAI
 from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.memory import ConversationBufferWindowMemory
 from langchain.prompts import PromptTemplate
+from langchain.retrievers import ContextualCompressionRetriever
 from langchain.utilities import OpenWeatherMapAPIWrapper
-from langchain.vectorstores import Pinecone
+import context_budget
+import deal_catalog
+import embedding_cache
+import local_vectorstore
+import metrics
+import session_memory
+import weather_cache
 
 load_dotenv()
 
@@ -22,13 +27,12 @@ RETURN_DOCS_COUNT_CORE = int(os.environ.get("RETURN_DOCS_COUNT_CORE"))
 RETURN_DOCS_COUNT_TBB = int(os.environ.get("RETURN_DOCS_COUNT_TBB"))
 CHAT_HISTORY_COUNT = int(os.environ.get("CHAT_HISTORY_COUNT"))
 CHATGPT_MODEL = os.environ.get("CHATGPT_MODEL")
+# local serves both namespaces from the files written by `python local_vectorstore.py import`
+VECTOR_STORE = os.environ.get("VECTOR_STORE", "pinecone" if PINECONE_API_KEY else "local")
 
 
 weather = OpenWeatherMapAPIWrapper()
-pinecone.init(api_key=PINECONE_API_KEY, environment=PINECONE_ENV)
-index = pinecone.Index(PINECONE_INDEX)
-embeddings = OpenAIEmbeddings()
-vectorstore = Pinecone(index, embeddings.embed_query, "text")
+embeddings = embedding_cache.CachedEmbeddings(OpenAIEmbeddings())
 
 prompt_template_tbb = """You are friendly helpful bot for travel company called travelbestbets.
 Your name is TravelBot
@@ -63,19 +67,35 @@ PROMPT_core = PromptTemplate(
     template=prompt_template_core, input_variables=["context", "chat_history", "question"]
 )
 
-docsearch_Travel = Pinecone.from_existing_index(PINECONE_INDEX, embeddings, namespace=NAMESPACE_CORE)
-docsearch_BestBets = Pinecone.from_existing_index(PINECONE_INDEX, embeddings, namespace=NAMESPACE_TBB)
-
-llm = ChatOpenAI(model=CHATGPT_MODEL)
-memory = ConversationBufferWindowMemory(
-    k=CHAT_HISTORY_COUNT,
+if VECTOR_STORE == "pinecone":
+    import pinecone
+    from langchain.vectorstores import Pinecone
+
+    pinecone.init(api_key=PINECONE_API_KEY, environment=PINECONE_ENV)
+    docsearch_Travel = Pinecone.from_existing_index(PINECONE_INDEX, embeddings, namespace=NAMESPACE_CORE)
+    docsearch_BestBets = Pinecone.from_existing_index(PINECONE_INDEX, embeddings, namespace=NAMESPACE_TBB)
+else:
+    docsearch_Travel = local_vectorstore.LocalVectorStore.from_existing_index(embeddings, namespace=NAMESPACE_CORE)
+    docsearch_BestBets = local_vectorstore.LocalVectorStore.from_existing_index(embeddings, namespace=NAMESPACE_TBB)
+
+# the QA chains, the agent and the history summarizer all share this model, their calls are traced as one stage
+llm = ChatOpenAI(model=CHATGPT_MODEL, callbacks=[metrics.LLMMetricsHandler('chatter')])
+# one history per session id instead of a single buffer shared by every user
+sessions = session_memory.SessionStore(
+    turns=CHAT_HISTORY_COUNT,
+    summarizer=session_memory.LLMSummarizer(llm) if session_memory.SESSION_SUMMARIZE else None)
+memory = session_memory.SessionMemory(
+    store=sessions,
     memory_key="chat_history",
     input_key="question")
 
 qa_travel = RetrievalQA.from_chain_type(
     llm=llm,
     chain_type="stuff",
-    retriever=docsearch_Travel.as_retriever(search_kwargs={"k": RETURN_DOCS_COUNT_CORE}),
+    # the k retrieved documents are deduplicated, ranked and trimmed to the chain's token budget before stuffing
+    retriever=ContextualCompressionRetriever(
+        base_compressor=context_budget.BudgetCompressor(chain='qa_travel', model=CHATGPT_MODEL),
+        base_retriever=docsearch_Travel.as_retriever(search_kwargs={"k": RETURN_DOCS_COUNT_CORE})),
 
     chain_type_kwargs={
         "verbose": True,
@@ -87,7 +107,10 @@ qa_travel = RetrievalQA.from_chain_type(
 qa_BestBets = RetrievalQAWithSourcesChain.from_chain_type(
     llm=llm,
     chain_type="stuff",
-    retriever=docsearch_BestBets.as_retriever(search_kwargs={"k": RETURN_DOCS_COUNT_TBB}),
+    retriever=ContextualCompressionRetriever(
+        base_compressor=context_budget.BudgetCompressor(chain='qa_BestBets', model=CHATGPT_MODEL,
+                                                        boost=deal_catalog.DETAIL_PATTERN),
+        base_retriever=docsearch_BestBets.as_retriever(search_kwargs={"k": RETURN_DOCS_COUNT_TBB})),
     chain_type_kwargs={
         "verbose": True,
         "prompt": PROMPT_tbb,
@@ -120,7 +143,7 @@ tools = [
 
 ]
 
-tools.extend(load_tools(["openweathermap-api"]))
+tools.extend(weather_cache.cached(tool) for tool in load_tools(["openweathermap-api"]))
 
 agent = initialize_agent(tools, llm, agent=AgentType.CHAT_ZERO_SHOT_REACT_DESCRIPTION, verbose=True)
 
@@ -148,24 +171,24 @@ def process_response(response):
         return response
 
 
-def get_response(query):
+def get_response(query, session_id=None):
     global agent
 
+    token = session_memory.current_session.set(session_id) if session_id else None
     try:
         response = agent(query)
 
     except Exception as e:
         print(e)
         return "Unable to complete request. Please retry."
+    finally:
+        if token is not None:
+            session_memory.current_session.reset(token)
 
     print(response)
 
     return process_response(response)
 
 
-def reset():
-    global memory
-    memory = ConversationBufferWindowMemory(
-        k=CHAT_HISTORY_COUNT,
-        memory_key="chat_history",
-        input_key="question")
+def reset(session_id=None):
+    sessions.clear(session_id or session_memory.current_session.get())
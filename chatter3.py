@@ -5,22 +5,23 @@ from langchain.agents import Tool, load_tools, initialize_agent, AgentType
 from langchain.chat_models import ChatOpenAI
 from langchain.memory import ConversationBufferWindowMemory
 from langchain.utilities import GoogleSearchAPIWrapper, OpenWeatherMapAPIWrapper
+import metrics
+import search_client
+import weather_cache
 
 load_dotenv()
 
 weather = OpenWeatherMapAPIWrapper()
 CHATGPT_MODEL = os.environ.get("CHATGPT_MODEL")
 search = GoogleSearchAPIWrapper()
+google_search = search_client.GoogleClient(search)
 
 
 def search_tbb(query):
     query = f'travelbestbets.com {query}'
-    result_text = search.run(query)
-    result_link = search.results(query, 3)[0]['link']
-    result_link2 = search.results(query, 3)[1]['link']
-    result_link3 = search.results(query, 3)[2]['link']
+    result = google_search.search(query)
 
-    return f'{result_text} source:{result_link} {result_link2} {result_link3}'
+    return f'{result.text} source:{" ".join(result.links[:3])}'
 
 
 def greeter(query):
@@ -44,7 +45,7 @@ tools = [
     ),
     Tool(
         name="Google",
-        func=search.run,
+        func=lambda query: google_search.search(query).text,
         description="useful when you need to answer any other question.Do not use for travel deal related questions",
         return_direct=True
 
@@ -52,9 +53,10 @@ tools = [
 
 ]
 
-tools.extend(load_tools(["openweathermap-api"]))
+tools.extend(weather_cache.cached(tool) for tool in load_tools(["openweathermap-api"]))
 
-llm = ChatOpenAI(model=CHATGPT_MODEL)
+# agent steps and the deal chain are traced together under this engine's name
+llm = ChatOpenAI(model=CHATGPT_MODEL, callbacks=[metrics.LLMMetricsHandler('chatter3')])
 
 agent = initialize_agent(tools, llm, agent=AgentType.CHAT_ZERO_SHOT_REACT_DESCRIPTION, verbose=True)
 
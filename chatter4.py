@@ -1,59 +1,171 @@
+import asyncio
+import contextvars
+import functools
+import logging
 import os
+import time
+
+import openai
+import requests
 from langchain.agents import Tool, load_tools, initialize_agent, AgentType
 from langchain.chains.question_answering import load_qa_chain, LLMChain
 from langchain.chat_models import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain.utilities import GoogleSearchAPIWrapper, OpenWeatherMapAPIWrapper, GoogleSerperAPIWrapper
-from llama_index import download_loader
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+import context_budget
+import deal_catalog
+import knowledge
+import metrics
+import registry
+import resilience
+import router
+import search_client
+import streaming
+import url_index
+import weather_cache
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 CHATGPT_MODEL = os.environ.get("CHATGPT_MODEL")
+TBB_DEAL_MODEL = 'gpt-4-0613'
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "20"))
 
-SimpleDirectoryReader = download_loader("SimpleDirectoryReader")
-loader = SimpleDirectoryReader('./data', recursive=True, exclude_hidden=True)
-documents = loader.load_langchain_documents()
+# LLM clients, chains, tools and documents are built on first use so importing this module stays cheap and offline
+components = registry.Registry()
+first_request_reported = False
 
-weather = OpenWeatherMapAPIWrapper()
-google = GoogleSearchAPIWrapper()
-serper = GoogleSerperAPIWrapper()
 
+def __getattr__(name):
+    if name in components:
+        return components.get(name)
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
 
-def search_google_with_source(url, query):
-    if url == 'travelbestbets.com':
-        result_link = google.results(f'{url} + {query}', 1)[0]['link']
-    else:
-        result_link = url
 
+@components.register('http_session')
+def build_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    # openai 0.27 otherwise opens one session per thread for every client
+    openai.requestssession = session
+    return session
+
+
+class StepChatOpenAI(ChatOpenAI):
+    # the agent's model: every step goes through the model's breaker and is retried on its own, a failed
+    # step doesn't rerun the steps and tool calls before it
+
+    def _generate(self, messages, stop=None, run_manager=None):
+        return resilience.call(llm_backend(self.model_name), super()._generate, messages, stop, run_manager,
+                               retries=llm_retries())
+
+    async def _agenerate(self, messages, stop=None, run_manager=None):
+        return await resilience.acall(llm_backend(self.model_name), super()._agenerate, messages, stop, run_manager,
+                                      retries=llm_retries())
+
+
+def chat_model(model_class=ChatOpenAI, **kwargs):
+    components.get('http_session')
+    # retries are resilience's, which knows the request deadline; the client's own would back off for up to a minute
+    kwargs.setdefault('request_timeout', resilience.LLM_TIMEOUT)
+    kwargs.setdefault('max_retries', 0)
+    return model_class(**kwargs)
+
+
+def llm_backend(model):
+    # one circuit breaker per model, a GPT-4 outage leaves CHATGPT_MODEL usable
+    return f'openai:{model}'
+
+
+def llm_retries():
+    # a streamed answer can't be taken back, only a request without a token handler is retried
+    return 0 if streaming.active() else resilience.CALL_RETRIES
+
+
+# data/ is re-scanned in the background, every request reads the snapshot that is current when it starts
+components.register('knowledge', knowledge.KnowledgeBase)
+components.register('deal_catalog', deal_catalog.DealCatalog)
+components.register('weather', OpenWeatherMapAPIWrapper)
+components.register('google', GoogleSearchAPIWrapper)
+components.register('serper', GoogleSerperAPIWrapper)
+components.register('google_search', lambda: search_client.GoogleClient(
+    components.get('google')))
+components.register('serper_search', lambda: search_client.SerperClient(
+    components.get('serper'), session=components.get('http_session')))
+
+
+def search_google_with_source(url, query):
     search_term = f'{url} + {query}'
-    print(search_term)
+    logger.debug('Searching Google:%s', search_term)
 
-    result_text = google.run(search_term)
-    # result_text = ddg.run(search_term)
+    result = resilience.call('google', components.get('google_search').search, search_term,
+                             timeout=resilience.SEARCH_TIMEOUT)
+    result_link = result.link if url == 'travelbestbets.com' else url
 
-    response = f'{result_text} source:{result_link}'
-    print(response)
+    response = f'{result.text} source:{result_link}'
+    logger.debug('search result: %s', response)
     return response
 
 
-def search_serper_with_source(url, query):
-    search_term = f'{url} + {query}'
+def fit_context(chain, query, text):
+    # deduplicated, ranked against the question and trimmed to the chain's token budget
+    with metrics.span('context_budget'):
+        if chain == 'chain_tbb_deal':
+            return context_budget.fit_text(text, query, chain, TBB_DEAL_MODEL, boost=deal_catalog.DETAIL_PATTERN)
+        return context_budget.fit_text(text, query, chain, CHATGPT_MODEL)
+
 
-    print(f'Searching Serper:{search_term}')
-    result_text = serper.run(search_term)
-    result_link = serper.results(search_term)['organic'][0]['link']
+def with_deal_source(result, query):
+    result_link = result.link or ''
 
     if 'travelbestbets.com' not in result_link:
         result_link = 'http://www.xyz.com'
 
-    response = f'{result_text} source:{result_link}'
+    response = f'{fit_context("chain_tbb_deal", query, result.text)} source:{result_link}'
 
-    print(response)
+    logger.debug('search result: %s', response)
     return response
 
 
-llm = ChatOpenAI(temperature=0, model=CHATGPT_MODEL)
+def search_serper_with_source(url, query):
+    search_term = f'{url} + {query}'
+
+    logger.debug('Searching Serper:%s', search_term)
+    result = resilience.call('serper', components.get('serper_search').search, search_term,
+                             timeout=resilience.SEARCH_TIMEOUT)
+    return with_deal_source(result, query)
+
+
+async def asearch_serper_with_source(url, query):
+    search_term = f'{url} + {query}'
+
+    logger.debug('Searching Serper:%s', search_term)
+    result = await resilience.acall('serper', components.get('serper_search').asearch, search_term,
+                                    timeout=resilience.SEARCH_TIMEOUT)
+    return with_deal_source(result, query)
+
+
+def catalog_deal(url, query):
+    # the crawled page when it is fresh, otherwise None and the caller searches live
+    with metrics.span('deal_catalog'):
+        catalog = components.get('deal_catalog')
+        deal = catalog.lookup(url)
+    result = 'hit' if deal is not None else 'stale' if catalog.get(url) is not None else 'miss'
+    metrics.registry.inc('chat_deal_catalog_lookups_total', (('result', result),))
+    logger.debug('deal catalog %s: %s', result, url)
+    if deal is None:
+        return None
+    context = fit_context('chain_tbb_deal', query, f'{deal.title}\n{deal.text}')
+    return f'{context} source:{deal.url}'
+
+
+components.register('llm', lambda: chat_model(temperature=0, model=CHATGPT_MODEL))
+components.register('agent_llm', lambda: chat_model(StepChatOpenAI, temperature=0, model=CHATGPT_MODEL))
 
 prompt_url_lookup = """Provide url for any trip , deal, package tour related question to any destination from context below only.
 Do not make up any answer.
@@ -73,7 +185,8 @@ Answer:
 PROMPT_LOOKUP = PromptTemplate(
     template=prompt_url_lookup, input_variables=["context", "question"]
 )
-chain_lookup = load_qa_chain(llm, chain_type="stuff", prompt=PROMPT_LOOKUP)
+components.register('chain_lookup', lambda: load_qa_chain(
+    components.get('llm'), chain_type="stuff", prompt=PROMPT_LOOKUP))
 
 prompt_tbb_deal = """You are a bot travel agents for travelbestbets called TravelBot.
 Always answer the questions regarding travel deals, flight deals and packages from only the context below with itinerary and pricing information. 
@@ -97,10 +210,15 @@ Answer:
 PROMPT_TBB_DEAL = PromptTemplate(
     template=prompt_tbb_deal, input_variables=["context", "question"]
 )
-chain_tbb_deal = LLMChain(
-    llm=ChatOpenAI(temperature=0, model='gpt-4-0613'),
+components.register('chain_tbb_deal', lambda: LLMChain(
+    llm=chat_model(temperature=0, model=TBB_DEAL_MODEL, streaming=True),
     prompt=PROMPT_TBB_DEAL
-)
+))
+# the same prompt on CHATGPT_MODEL, hedges a slow GPT-4 call and stands in while GPT-4 is failing
+components.register('chain_tbb_deal_fast', lambda: LLMChain(
+    llm=chat_model(temperature=0, model=CHATGPT_MODEL, streaming=True),
+    prompt=PROMPT_TBB_DEAL
+))
 
 prompt_search_google = """You are a bot travel agents for travelbestbets called TravelBot.
 Answer question from your knowledgebase and the context provided below
@@ -119,12 +237,12 @@ Answer:
 PROMPT_SEARCH_GOOGLE = PromptTemplate(
     template=prompt_search_google, input_variables=["context", "question"]
 )
-chain_search_google = LLMChain(
-    llm=llm,
+components.register('chain_search_google', lambda: LLMChain(
+    llm=chat_model(temperature=0, model=CHATGPT_MODEL, streaming=True),
     prompt=PROMPT_SEARCH_GOOGLE,
     verbose=True
 
-)
+))
 
 
 def check_words_in_string(string):
@@ -135,28 +253,116 @@ def check_words_in_string(string):
     return False
 
 
+def callbacks(stage):
+    return metrics.callbacks(stage) + (streaming.callbacks() or [])
+
+
+def tbb_deal_answer(chain, deal_info, query):
+    return components.get(chain)({"context": deal_info, "question": query}, callbacks=callbacks('chain_tbb_deal'))['text']
+
+
+async def atbb_deal_answer(chain, deal_info, query):
+    return (await components.get(chain).acall({"context": deal_info, "question": query},
+                                              callbacks=callbacks('chain_tbb_deal')))['text']
+
+
+@metrics.timed('tool.TravelBestBets')
 def search_tbb(query):
     if "mediterranean" in query.lower() and "cruise" in query.lower():
         query = f'{query} and greek isles'
 
-    url = chain_lookup({"input_documents": documents, "question": query}, return_only_outputs=True)['output_text']
+    with metrics.span('url_index'):
+        url, score = url_index.lookup(query)
+    logger.debug('index lookup: %s score:%.2f', url, score)
+
+    if url is None:
+        documents = components.get('knowledge').current().documents
+        with metrics.span('chain_lookup'):
+            url = resilience.call(llm_backend(CHATGPT_MODEL), components.get('chain_lookup'),
+                                  {"input_documents": documents, "question": query},
+                                  timeout=resilience.LLM_TIMEOUT, return_only_outputs=True,
+                                  callbacks=metrics.callbacks('chain_lookup'))['output_text']
+        logger.debug('lookup result: %s', url)
+
+    if check_words_in_string(url):
+        url = 'travelbestbets.com'
+
+    logger.debug('deal url: %s', url)
+
+    deal_info = catalog_deal(url, query)
+    if deal_info is None:
+        with metrics.span('serper'):
+            deal_info = search_serper_with_source(url, query)
+
+    with metrics.span('chain_tbb_deal'):
+        fa = resilience.hedged('chain_tbb_deal',
+                               (llm_backend(TBB_DEAL_MODEL), functools.partial(tbb_deal_answer, 'chain_tbb_deal')),
+                               (llm_backend(CHATGPT_MODEL), functools.partial(tbb_deal_answer, 'chain_tbb_deal_fast')),
+                               deal_info, query, hedge=not streaming.active())
+    return fa
+
+
+@metrics.timed('tool.TravelBestBets')
+async def asearch_tbb(query):
+    if "mediterranean" in query.lower() and "cruise" in query.lower():
+        query = f'{query} and greek isles'
+
+    with metrics.span('url_index'):
+        url, score = url_index.lookup(query)
+    logger.debug('index lookup: %s score:%.2f', url, score)
 
-    print(f'lookup result: {url}')
+    if url is None:
+        documents = components.get('knowledge').current().documents
+        with metrics.span('chain_lookup'):
+            url = (await resilience.acall(
+                llm_backend(CHATGPT_MODEL), components.get('chain_lookup').acall,
+                {"input_documents": documents, "question": query},
+                timeout=resilience.LLM_TIMEOUT, return_only_outputs=True,
+                callbacks=metrics.callbacks('chain_lookup')))['output_text']
+        logger.debug('lookup result: %s', url)
 
     if check_words_in_string(url):
         url = 'travelbestbets.com'
 
-    print(url)
+    logger.debug('deal url: %s', url)
 
-    deal_info = search_serper_with_source(url, query)
+    deal_info = catalog_deal(url, query)
+    if deal_info is None:
+        with metrics.span('serper'):
+            deal_info = await asearch_serper_with_source(url, query)
 
-    fa = chain_tbb_deal({"context": deal_info, "question": query})['text']
+    with metrics.span('chain_tbb_deal'):
+        fa = await resilience.ahedged(
+            'chain_tbb_deal',
+            (llm_backend(TBB_DEAL_MODEL), functools.partial(atbb_deal_answer, 'chain_tbb_deal')),
+            (llm_backend(CHATGPT_MODEL), functools.partial(atbb_deal_answer, 'chain_tbb_deal_fast')),
+            deal_info, query, hedge=not streaming.active())
     return fa
 
 
+@metrics.timed('tool.Google')
 def search_google(query):
-    result_text = serper.run(query)
-    fa = chain_search_google({"context": result_text, "question": query})['text']
+    with metrics.span('serper'):
+        result_text = resilience.call('serper', components.get('serper_search').search, query,
+                                      timeout=resilience.SEARCH_TIMEOUT).text
+    result_text = fit_context('chain_search_google', query, result_text)
+    with metrics.span('chain_search_google'):
+        fa = resilience.call(llm_backend(CHATGPT_MODEL), components.get('chain_search_google'),
+                             {"context": result_text, "question": query}, timeout=resilience.LLM_TIMEOUT,
+                             retries=llm_retries(), callbacks=callbacks('chain_search_google'))['text']
+    return fa
+
+
+@metrics.timed('tool.Google')
+async def asearch_google(query):
+    with metrics.span('serper'):
+        result_text = (await resilience.acall('serper', components.get('serper_search').asearch, query,
+                                              timeout=resilience.SEARCH_TIMEOUT)).text
+    result_text = fit_context('chain_search_google', query, result_text)
+    with metrics.span('chain_search_google'):
+        fa = (await resilience.acall(llm_backend(CHATGPT_MODEL), components.get('chain_search_google').acall,
+                                     {"context": result_text, "question": query}, timeout=resilience.LLM_TIMEOUT,
+                                     retries=llm_retries(), callbacks=callbacks('chain_search_google')))['text']
     return fa
 
 
@@ -186,43 +392,115 @@ PROMPT_GREETER = PromptTemplate(
 )
 
 
+components.register('chain_greeter', lambda: LLMChain(
+    llm=chat_model(temperature=0, model=TBB_DEAL_MODEL, streaming=True),
+    prompt=PROMPT_GREETER
+))
+components.register('chain_greeter_fast', lambda: LLMChain(
+    llm=chat_model(temperature=0, model=CHATGPT_MODEL, streaming=True),
+    prompt=PROMPT_GREETER
+))
+
+
+def greeter_answer(chain, query):
+    return components.get(chain).run(query, callbacks=callbacks('greeter'))
+
+
+async def agreeter_answer(chain, query):
+    return await components.get(chain).arun(query, callbacks=callbacks('greeter'))
+
+
+@metrics.timed('tool.Greeter')
 def greeter(query):
-    chain = LLMChain(llm=ChatOpenAI(temperature=0, model='gpt-4-0613'), prompt=PROMPT_GREETER)
-    return chain.run(query)
+    return resilience.hedged('greeter',
+                             (llm_backend(TBB_DEAL_MODEL), functools.partial(greeter_answer, 'chain_greeter')),
+                             (llm_backend(CHATGPT_MODEL), functools.partial(greeter_answer, 'chain_greeter_fast')),
+                             query, hedge=not streaming.active())
+
+
+@metrics.timed('tool.Greeter')
+async def agreeter(query):
+    return await resilience.ahedged(
+        'greeter',
+        (llm_backend(TBB_DEAL_MODEL), functools.partial(agreeter_answer, 'chain_greeter')),
+        (llm_backend(CHATGPT_MODEL), functools.partial(agreeter_answer, 'chain_greeter_fast')),
+        query, hedge=not streaming.active())
+
+
+def with_breaker(tool):
+    # one breaker per tool, an outage behind one tool fails that tool fast and leaves the others alone;
+    # the backends inside retry, the tool itself is not retried
+    backend = f'tool:{tool.name}'
+
+    def run(query):
+        return resilience.call(backend, tool.func, query, retries=0)
+
+    async def arun(query):
+        return await resilience.acall(backend, tool.coroutine, query, retries=0)
+
+    return Tool(name=tool.name, func=run, coroutine=arun, description=tool.description,
+                return_direct=tool.return_direct)
+
+
+def with_async_fallback(tool):
+    # tools from load_tools only implement the sync API, run them on the default executor
+    run = metrics.timed(f'tool.{tool.name}')(tool.run)
+
+    async def arun(query):
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(None, context.run, run, query)
+
+    return Tool(name=tool.name, func=run, coroutine=arun, description=tool.description,
+                return_direct=tool.return_direct)
+
+
+@components.register('tools')
+def build_tools():
+    tools = [
+        Tool(
+            name="Greeter",
+            func=greeter,
+            coroutine=agreeter,
+            description="useful when user greets or say hi or hello and non travel related queries and when user want to contact and agent or speak to human or user ask for email of phone number.Provide whole query as input to tool",
+            return_direct=True
+        ),
+        Tool(
+            name="TravelBestBets",
+            func=search_tbb,
+            coroutine=asearch_tbb,
+            description="useful for when you need to answer questions about travel packages and deals. Pass full query into the tool. Provide source link with answer.",
+            return_direct=True
+
+        ),
+        Tool(
+            name="Google",
+            func=search_google,
+            coroutine=asearch_google,
+            description="useful when you need to answer any other travel related question.Do not use for travel deal related questions",
+            return_direct=True
 
+        )
+    ]
 
-tools = [
-    Tool(
-        name="Greeter",
-        func=greeter,
-        description="useful when user greets or say hi or hello and non travel related queries and when user want to contact and agent or speak to human or user ask for email of phone number.Provide whole query as input to tool",
-        return_direct=True
-    ),
-    Tool(
-        name="TravelBestBets",
-        func=search_tbb,
-        description="useful for when you need to answer questions about travel packages and deals. Pass full query into the tool. Provide source link with answer.",
-        return_direct=True
+    tools = [with_breaker(tool) for tool in tools]
 
-    ),
-    Tool(
-        name="Google",
-        func=search_google,
-        description="useful when you need to answer any other travel related question.Do not use for travel deal related questions",
-        return_direct=True
+    # cache hits are answered before the breaker and the timeout pool, only misses call OpenWeatherMap
+    tools.extend(with_async_fallback(weather_cache.cached(
+        tool, functools.partial(resilience.call, f'tool:{tool.name}', tool.run, timeout=resilience.SEARCH_TIMEOUT)))
+        for tool in load_tools(["openweathermap-api"]))
+    return tools
 
-    )
-]
 
-tools.extend(load_tools(["openweathermap-api"]))
-agent = initialize_agent(tools, llm, agent=AgentType.CHAT_ZERO_SHOT_REACT_DESCRIPTION, verbose=True)
+components.register('agent', lambda: initialize_agent(
+    components.get('tools'), components.get('agent_llm'), agent=AgentType.CHAT_ZERO_SHOT_REACT_DESCRIPTION,
+    verbose=True))
 
 
 def process_response(response):
-    print(f'checking for response: {response}')
+    logger.debug('checking for response: %s', response)
 
     if check_words_in_string(response):
-        print('found i dont know')
+        logger.info('found i dont know')
         return '''I can't find a deal but one of our travel consultants would be happy to help you.<br> To get a 
         quote click here: <a href="https://travelbestbets.com/request-a-quote/" target="_blank">Request a quote</a> <br> Or feel free to contact our office: <br> ☎ 
         1-877-523-7823 <br> 📧 info@travelbestbets.com <br> And get our amazing deals sent right to your inbox. Sign 
@@ -241,19 +519,115 @@ def process_response(response):
         return response
 
 
+def contact_information(query):
+    return 'Contact Information'
+
+
+async def acontact_information(query):
+    return 'Contact Information'
+
+
+# intents the local router can answer without asking the agent to pick a tool
+direct_routes = {
+    router.GREETING: (greeter, agreeter),
+    router.CONTACT: (contact_information, acontact_information),
+    router.DEAL: (search_tbb, asearch_tbb),
+    router.GENERAL: (search_google, asearch_google),
+}
+
+
+@metrics.timed('route')
+def route(query):
+    intent, confidence = router.route(query)
+    logger.debug('intent: %s confidence:%.2f', intent, confidence)
+    if confidence >= router.ROUTER_THRESHOLD and intent in direct_routes:
+        return direct_routes[intent]
+    return None
+
+
+def warmup():
+    # everything a request needs, built once; under gunicorn --preload this runs in the master before the fork
+    # so the workers share it copy-on-write
+    start = time.perf_counter()
+    components.preload()
+    components.get('knowledge').refresh()
+    components.get('deal_catalog').stats()
+    url_index.get_index()
+    router.get_router()
+    elapsed = time.perf_counter() - start
+    logger.info('chatter4 warm-up took %.0f ms %s', elapsed * 1000, components.report())
+
+
+def ready():
+    return all(components.loaded(name) for name in ('llm', 'agent', 'knowledge')) and \
+        components.get('knowledge').snapshot is not None
+
+
+def report_first_request(start):
+    global first_request_reported
+    if not first_request_reported:
+        first_request_reported = True
+        logger.info('chatter4 first request took %.0f ms %s', (time.perf_counter() - start) * 1000,
+                    components.report())
+
+
+def agent_callbacks():
+    # the run as a whole isn't retried, its steps and tools are; the deadline stops it between steps
+    return metrics.callbacks('agent') + [resilience.DeadlineCallback()]
+
+
 def get_response(query):
-    global agent
+    start = time.perf_counter()
     try:
+        with resilience.deadline():
+            handlers = route(query)
+            if handlers:
+                agent_response = handlers[0](query)
+            else:
+                with metrics.span('agent'):
+                    agent_response = components.get('agent').run(query, callbacks=agent_callbacks())
+    except (resilience.DeadlineExceeded, resilience.CircuitOpen, TimeoutError) as e:
+        # the page offers a retry for this answer
+        logger.warning('Unable to complete request: %r', e)
+        return "Unable to complete request."
+    except Exception:
+        logger.exception('Unable to complete request')
+        return "Unable to complete request."
+    finally:
+        report_first_request(start)
+
+    logger.debug('agent response: %s', agent_response)
 
-        agent_response = agent.run(query)
-    except Exception as e:
-        print(e)
+    return process_response(agent_response)
+
+
+async def aget_response(query):
+    start = time.perf_counter()
+    try:
+        with resilience.deadline():
+            handlers = route(query)
+            if handlers:
+                agent_response = await handlers[1](query)
+            else:
+                with metrics.span('agent'):
+                    agent_response = await components.get('agent').arun(query, callbacks=agent_callbacks())
+    except (resilience.DeadlineExceeded, resilience.CircuitOpen, TimeoutError) as e:
+        logger.warning('Unable to complete request: %r', e)
         return "Unable to complete request."
+    except Exception:
+        logger.exception('Unable to complete request')
+        return "Unable to complete request."
+    finally:
+        report_first_request(start)
 
-    print(agent_response)
+    logger.debug('agent response: %s', agent_response)
 
     return process_response(agent_response)
 
 # def reset():
 # global memory
 # memory = ConversationBufferWindowMemory(memory_key="chat_history", k=2)
+
+
+if __name__ == "__main__":
+    warmup()
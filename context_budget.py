@@ -0,0 +1,167 @@
+import math
+import os
+import re
+from collections import Counter
+from typing import Any, Optional
+
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+from langchain.retrievers.document_compressors.base import BaseDocumentCompressor
+
+import metrics
+import url_index
+
+load_dotenv()
+
+# prompt tokens allowed for {context}/{summaries} per chain, 0 passes the context through untouched
+CONTEXT_BUDGET = int(os.environ.get("CONTEXT_BUDGET", "1500"))
+# per chain overrides, e.g. "chain_tbb_deal=1200,chain_search_google=600"
+CONTEXT_BUDGETS = os.environ.get("CONTEXT_BUDGETS", "")
+# snippets sharing at least this fraction of their words with a kept one are dropped as near duplicates
+CONTEXT_DUPLICATE_OVERLAP = float(os.environ.get("CONTEXT_DUPLICATE_OVERLAP", "0.8"))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+SENTENCE_END = re.compile(r'(?<=[.!?…])\s+(?=[A-Z0-9$"\'(])|\n+')
+
+
+def budget_for(chain):
+    budgets = {}
+    for item in CONTEXT_BUDGETS.split(','):
+        if '=' in item:
+            name, value = item.split('=', 1)
+            budgets[name.strip()] = int(value)
+    return budgets.get(chain, CONTEXT_BUDGET)
+
+
+def split_units(text):
+    # search snippets and crawled pages arrive as one string, sentences are the smallest piece that still reads
+    return [unit.strip() for unit in SENTENCE_END.split(text) if unit and unit.strip()]
+
+
+def normalized(text):
+    return ' '.join(re.findall(r'[a-z0-9$]+', text.lower()))
+
+
+def dedupe(units):
+    # exact duplicates after normalizing case and punctuation, then near duplicates by word overlap;
+    # a snippet with a price, date or duration the kept one lacks is never a duplicate of it
+    kept, seen, word_sets = [], set(), []
+    for index, unit in enumerate(units):
+        key = normalized(unit)
+        if not key or key in seen:
+            continue
+        words = set(key.split())
+        numbers = {word for word in words if any(c.isdigit() for c in word)}
+        if any(numbers <= other and len(words & other) >= CONTEXT_DUPLICATE_OVERLAP * min(len(words), len(other))
+               for other in word_sets):
+            continue
+        seen.add(key)
+        word_sets.append(words)
+        kept.append(index)
+    return kept
+
+
+def rank(units, question, boost=None):
+    # BM25 of each unit against the question, units as the corpus; earlier units win ties since search
+    # results and retrieved documents arrive best first, and units matching boost (pricing lines) get a lift
+    tokens = [url_index.tokenize(unit) for unit in units]
+    query = set(url_index.tokenize(question))
+    average = sum(len(unit_tokens) for unit_tokens in tokens) / len(tokens) if tokens else 0.0
+    frequency = Counter(token for unit_tokens in tokens for token in set(unit_tokens))
+
+    scores = []
+    for position, unit_tokens in enumerate(tokens):
+        counts = Counter(unit_tokens)
+        score = 0.0
+        for token in query:
+            tf = counts.get(token)
+            if not tf:
+                continue
+            idf = math.log(1 + (len(tokens) - frequency[token] + 0.5) / (frequency[token] + 0.5))
+            score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * len(unit_tokens) / (average or 1)))
+        if boost is not None and boost.search(units[position]):
+            score += 1.0
+        scores.append(score + 0.1 / (1 + position))
+    return scores
+
+
+def truncate(text, tokens, model):
+    encoding = metrics.token_encoding(model)
+    if encoding is None:
+        return ' '.join(text.split()[:tokens])
+    return encoding.decode(encoding.encode(text)[:tokens])
+
+
+def select(units, question, budget, model, boost=None):
+    # indexes of the units to keep, in their original order, and the token counts before and after
+    counts = [metrics.count_tokens(model, unit) for unit in units]
+    total = sum(counts)
+    if budget <= 0 or not units:
+        return list(range(len(units))), total, total, {}
+
+    unique = dedupe(units)
+    scores = rank([units[index] for index in unique], question, boost)
+    order = [unique[i] for i in sorted(range(len(unique)), key=lambda i: -scores[i])]
+
+    kept, used, truncated = [], 0, {}
+    for index in order:
+        if used + counts[index] <= budget:
+            kept.append(index)
+            used += counts[index]
+        elif not kept:
+            # the best unit alone is over budget, keep its beginning
+            truncated[index] = truncate(units[index], budget, model)
+            kept.append(index)
+            used = budget
+            break
+    return sorted(kept), total, used, truncated
+
+
+def record(chain, before, after):
+    metrics.registry.inc('chat_context_tokens_total', (('chain', chain), ('stage', 'raw')), before)
+    metrics.registry.inc('chat_context_tokens_total', (('chain', chain), ('stage', 'kept')), after)
+
+
+def fit_text(text, question, chain, model, budget=None, boost=None):
+    units = split_units(text)
+    kept, before, after, truncated = select(units, question, budget_for(chain) if budget is None else budget,
+                                            model, boost)
+    record(chain, before, after)
+    return ' '.join(truncated.get(index, units[index]) for index in kept)
+
+
+def fit_documents(documents, question, chain, model, budget=None, boost=None):
+    # the budget is shared by all documents, each keeps its metadata (and source) and its surviving sentences
+    units, owners = [], []
+    for number, document in enumerate(documents):
+        for unit in split_units(document.page_content):
+            units.append(unit)
+            owners.append(number)
+
+    kept, before, after, truncated = select(units, question, budget_for(chain) if budget is None else budget,
+                                            model, boost)
+    record(chain, before, after)
+
+    contents = {}
+    for index in kept:
+        contents.setdefault(owners[index], []).append(truncated.get(index, units[index]))
+    return [Document(page_content=' '.join(contents[number]), metadata=document.metadata)
+            for number, document in enumerate(documents) if number in contents]
+
+
+class BudgetCompressor(BaseDocumentCompressor):
+    # for ContextualCompressionRetriever: retrieved documents are deduplicated, ranked and trimmed to the
+    # chain's budget before being stuffed into the prompt
+
+    chain: str
+    model: Optional[str] = None
+    budget: Optional[int] = None
+    boost: Any = None
+
+    def compress_documents(self, documents, query):
+        with metrics.span('context_budget'):
+            return fit_documents(documents, query, self.chain, self.model or 'gpt-3.5-turbo', self.budget, self.boost)
+
+    async def acompress_documents(self, documents, query):
+        return self.compress_documents(documents, query)
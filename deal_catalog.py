@@ -0,0 +1,273 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from dotenv import load_dotenv
+
+import persistence
+import url_index
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DEAL_CATALOG_DB = os.environ.get("DEAL_CATALOG_DB", "./instance/deal_catalog.sqlite")
+# deals change weekly, a page older than this is treated as stale and search_tbb goes back to live search
+DEAL_CATALOG_MAX_AGE = int(os.environ.get("DEAL_CATALOG_MAX_AGE", str(8 * 24 * 3600)))
+DEAL_CATALOG_SECTIONS = [section for section in os.environ.get(
+    "DEAL_CATALOG_SECTIONS",
+    "https://travelbestbets.com/deals/,https://travelbestbets.com/special-interest-trips/"
+).split(",") if section]
+DEAL_CATALOG_WORKERS = int(os.environ.get("DEAL_CATALOG_WORKERS", "8"))
+DEAL_CATALOG_MAX_PAGES = int(os.environ.get("DEAL_CATALOG_MAX_PAGES", "500"))
+DEAL_TEXT_LIMIT = int(os.environ.get("DEAL_TEXT_LIMIT", "3000"))
+
+BLOCKS = {'p', 'div', 'li', 'tr', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'ul', 'ol', 'table', 'dd', 'dt'}
+NOISE = '//script|//style|//noscript|//nav|//header|//footer|//form|//aside|//iframe'
+DETAIL_PATTERN = re.compile(
+    r'\$\s?\d|\d+\s*(?:nights?|days?)\b|\bday\s*\d|itinerary|includ|depart|per person|price|from\s+\$|cabin|flight',
+    re.IGNORECASE)
+
+
+class Deal(namedtuple('Deal', ['url', 'title', 'text', 'fetched'])):
+    __slots__ = ()
+
+    def fresh(self, max_age=DEAL_CATALOG_MAX_AGE):
+        return time.time() - self.fetched <= max_age
+
+
+def normalize_url(url):
+    # chain_lookup answers with or without scheme, www and trailing slash, all of them name the same page
+    parts = urlsplit(url if '://' in url else f'https://{url}')
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    return f'{host}{parts.path.rstrip("/")}'.lower()
+
+
+def extract_deal(html):
+    # page title plus the body text, itinerary and pricing lines first, capped at DEAL_TEXT_LIMIT characters
+    import lxml.html
+
+    document = lxml.html.fromstring(html)
+    title = ' '.join((document.findtext('.//title') or '').split())
+    for element in document.xpath(NOISE):
+        element.drop_tree()
+    roots = document.xpath('//main') or document.xpath('//article') or document.xpath('//body') or [document]
+    for element in roots[0].iter():
+        if element.tag in BLOCKS:
+            element.tail = '\n' + (element.tail or '')
+
+    lines, seen = [], set()
+    for line in roots[0].text_content().splitlines():
+        line = ' '.join(line.split())
+        if line and line not in seen:
+            seen.add(line)
+            lines.append(line)
+    details = [line for line in lines if DETAIL_PATTERN.search(line)]
+    other = [line for line in lines if not DETAIL_PATTERN.search(line)]
+    return title, ' '.join(details + other)[:DEAL_TEXT_LIMIT]
+
+
+def extract_links(html, base_url, prefixes):
+    import lxml.html
+
+    document = lxml.html.fromstring(html)
+    links = []
+    for href in document.xpath('//a/@href'):
+        link = urljoin(base_url, href).split('#', 1)[0]
+        if any(normalize_url(link).startswith(normalize_url(prefix)) and normalize_url(link) != normalize_url(prefix)
+               for prefix in prefixes):
+            links.append(link)
+    return links
+
+
+class DealCatalog:
+    # deal pages crawled ahead of time, kept in SQLite and mirrored into a dict keyed by normalized URL
+
+    def __init__(self, db_path=DEAL_CATALOG_DB, max_age=DEAL_CATALOG_MAX_AGE):
+        self.db_path = db_path
+        self.max_age = max_age
+        self.hits = 0
+        self.stale = 0
+        self.misses = 0
+        self._deals = {}
+        self._data_version = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+        self._db = persistence.SQLiteConnection(db_path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS deal_catalog (key TEXT PRIMARY KEY, url TEXT NOT NULL, "
+                         "title TEXT, text TEXT NOT NULL, fetched REAL NOT NULL, etag TEXT, last_modified TEXT)")
+
+    def _refresh(self):
+        # at most once a second, reload the dict when another connection (the crawler) has committed
+        now = time.monotonic()
+        if now - self._checked < 1.0:
+            return
+        with self._lock:
+            self._checked = now
+            data_version = self._db.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version and self._deals:
+                return
+            rows = self._db.execute("SELECT key, url, title, text, fetched FROM deal_catalog").fetchall()
+            self._deals = {row[0]: Deal(*row[1:]) for row in rows}
+            self._data_version = data_version
+
+    def get(self, url):
+        self._refresh()
+        return self._deals.get(normalize_url(url))
+
+    def lookup(self, url):
+        # a fresh deal or None, stale pages count separately so the fallback rate is visible
+        deal = self.get(url)
+        if deal is None:
+            self.misses += 1
+            return None
+        if not deal.fresh(self.max_age):
+            self.stale += 1
+            return None
+        self.hits += 1
+        return deal
+
+    def validators(self, url):
+        row = self._db.execute("SELECT etag, last_modified FROM deal_catalog WHERE key = ?",
+                               (normalize_url(url),)).fetchone()
+        return row or (None, None)
+
+    # data_version only moves for commits from other connections, this one's writes go into the dict as well
+    def store(self, url, title, text, etag=None, last_modified=None):
+        key, fetched = normalize_url(url), time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO deal_catalog (key, url, title, text, fetched, etag, last_modified) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)", (key, url, title, text, fetched, etag, last_modified))
+            self._deals[key] = Deal(url, title, text, fetched)
+
+    def touch(self, url):
+        key, fetched = normalize_url(url), time.time()
+        with self._lock:
+            self._db.execute("UPDATE deal_catalog SET fetched = ? WHERE key = ?", (fetched, key))
+            if key in self._deals:
+                self._deals[key] = self._deals[key]._replace(fetched=fetched)
+
+    def stats(self):
+        self._refresh()
+        deals = list(self._deals.values())
+        fresh = sum(1 for deal in deals if deal.fresh(self.max_age))
+        return {
+            'deals': len(deals),
+            'fresh': fresh,
+            'stale': len(deals) - fresh,
+            'oldest_age_hours': round((time.time() - min(deal.fetched for deal in deals)) / 3600, 1) if deals else None,
+            'hits': self.hits,
+            'stale_lookups': self.stale,
+            'misses': self.misses,
+        }
+
+
+class Crawler:
+    # fetches the QA_Bank deal pages and every page linked from the deal sections, with conditional GETs
+    # base_url sends the requests to another host (a fixture server) while the catalog keeps the real URLs
+
+    def __init__(self, catalog, base_url=None, session=None, workers=DEAL_CATALOG_WORKERS, timeout=15):
+        self.catalog = catalog
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.session = session or requests.Session()
+        self.workers = workers
+        self.timeout = timeout
+
+    def fetch_url(self, url):
+        if self.base_url is None:
+            return url
+        parts = urlsplit(url if '://' in url else f'https://{url}')
+        return f'{self.base_url}{parts.path or "/"}' + (f'?{parts.query}' if parts.query else '')
+
+    def get(self, url, headers=None):
+        response = self.session.get(self.fetch_url(url), headers=headers or {}, timeout=self.timeout)
+        if response.status_code != 304:
+            response.raise_for_status()
+        return response
+
+    def seed_urls(self, sections=DEAL_CATALOG_SECTIONS, qa_bank_path=url_index.QA_BANK_PATH):
+        text, _ = url_index.read_qa_bank(qa_bank_path)
+        urls = [pair['url'] if '://' in pair['url'] else f'https://{pair["url"]}'
+                for pair in url_index.parse_qa_bank(text)]
+        for section in sections:
+            try:
+                urls.extend(extract_links(self.get(section).text, section, sections))
+            except requests.RequestException as e:
+                logger.warning('Unable to read deal section %s: %s', section, e)
+
+        unique, seen = [], set()
+        for url in urls:
+            key = normalize_url(url)
+            if key not in seen and key not in {normalize_url(section) for section in sections}:
+                seen.add(key)
+                unique.append(url)
+        return unique[:DEAL_CATALOG_MAX_PAGES]
+
+    def crawl_one(self, url):
+        etag, last_modified = self.catalog.validators(url)
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        try:
+            response = self.get(url, headers)
+        except requests.RequestException as e:
+            logger.warning('Unable to fetch %s: %s', url, e)
+            return 'failed'
+        if response.status_code == 304:
+            self.catalog.touch(url)
+            return 'unchanged'
+
+        title, text = extract_deal(response.content)
+        if not text:
+            return 'empty'
+        self.catalog.store(url, title, text, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return 'updated'
+
+    def crawl(self, urls=None):
+        start = time.perf_counter()
+        urls = urls if urls is not None else self.seed_urls()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            outcomes = list(executor.map(self.crawl_one, urls))
+        summary = {outcome: outcomes.count(outcome) for outcome in sorted(set(outcomes))}
+        logger.info('Crawled %d deal pages in %.1fs %s', len(urls), time.perf_counter() - start, summary)
+        return summary
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='build or inspect the offline deal catalog')
+    parser.add_argument('command', choices=['crawl', 'show', 'stats'])
+    parser.add_argument('urls', nargs='*')
+    parser.add_argument('--base-url', help='fetch from this host instead, e.g. a local fixture server')
+    parser.add_argument('--every', type=float, help='keep crawling, waiting this many hours between runs')
+    args = parser.parse_args()
+
+    deal_catalog = DealCatalog()
+    if args.command == 'crawl':
+        crawler = Crawler(deal_catalog, base_url=args.base_url)
+        while True:
+            print(f'Crawled {crawler.crawl(args.urls or None)}')
+            if not args.every:
+                break
+            time.sleep(args.every * 3600)
+    elif args.command == 'show':
+        for url in args.urls:
+            deal = deal_catalog.get(url)
+            print(f'{url}: not in catalog' if deal is None else
+                  f'{deal.url} ({"fresh" if deal.fresh() else "stale"})\n{deal.title}\n{deal.text}\n')
+    else:
+        print(deal_catalog.stats())
+    sys.exit(0)
@@ -0,0 +1,147 @@
+import functools
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain.embeddings.base import Embeddings
+
+import persistence
+
+load_dotenv()
+
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "4096"))
+EMBEDDING_CACHE_DB = os.environ.get("EMBEDDING_CACHE_DB", "./instance/embedding_cache.sqlite")
+
+
+def content_key(model, text):
+    return hashlib.sha256(f'{model}\0{text}'.encode('utf-8')).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    # wraps an embeddings object: vectors are keyed by model and text hash, kept in a bounded LRU
+    # and in SQLite, and only the texts missing from both are sent to the model, in one batch
+
+    def __init__(self, embeddings, maxsize=EMBEDDING_CACHE_SIZE, db_path=EMBEDDING_CACHE_DB):
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, 'model', type(embeddings).__name__)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.batches = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+        if db_path:
+            self._db = persistence.SQLiteConnection(db_path)
+            self._db.execute("CREATE TABLE IF NOT EXISTS embedding_cache (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+
+    def _put_memory(self, key, vector):
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, keys):
+        found = {}
+        with self._lock:
+            for key in keys:
+                vector = self._entries.get(key)
+                if vector is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = vector
+                    self.hits += 1
+
+            missing = [key for key in keys if key not in found]
+            if self._db is not None and missing:
+                for start in range(0, len(missing), 500):
+                    chunk = missing[start:start + 500]
+                    rows = self._db.execute(
+                        f"SELECT key, vector FROM embedding_cache WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                    ).fetchall()
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32)
+                        self._put_memory(key, vector)
+                        found[key] = vector
+                        self.hits += 1
+                        self.disk_hits += 1
+
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def _store(self, vectors):
+        with self._lock:
+            for key, vector in vectors.items():
+                self._put_memory(key, vector)
+            if self._db is not None:
+                self._db.executemany("INSERT OR REPLACE INTO embedding_cache (key, vector) VALUES (?, ?)",
+                                     [(key, vector.tobytes()) for key, vector in vectors.items()])
+
+    def embed_documents(self, texts):
+        keys = [content_key(self.model, text) for text in texts]
+        found = self._lookup(list(dict.fromkeys(keys)))
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            embedded = self.embeddings.embed_documents(list(missing.values()))
+            computed = {key: np.asarray(vector, dtype=np.float32) for key, vector in zip(missing, embedded)}
+            with self._lock:
+                self.batches += 1
+            self._store(computed)
+            found.update(computed)
+
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text):
+        key = content_key(self.model, text)
+        vector = self._lookup([key]).get(key)
+        if vector is None:
+            vector = np.asarray(self.embeddings.embed_query(text), dtype=np.float32)
+            self._store({key: vector})
+        return vector.tolist()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM embedding_cache")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            stored = self._db.execute("SELECT count(*) FROM embedding_cache").fetchone()[0] if self._db else None
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'batches': self.batches,
+                'size': len(self._entries),
+                'stored': stored,
+            }
+
+
+@functools.lru_cache(maxsize=None)
+def openai_embeddings():
+    from langchain.embeddings.openai import OpenAIEmbeddings
+    return CachedEmbeddings(OpenAIEmbeddings())
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "clear":
+        os.makedirs(os.path.dirname(EMBEDDING_CACHE_DB) or ".", exist_ok=True)
+        with sqlite3.connect(EMBEDDING_CACHE_DB) as connection:
+            connection.execute("DROP TABLE IF EXISTS embedding_cache")
+        print('Embedding cache cleared')
+    elif os.path.exists(EMBEDDING_CACHE_DB):
+        with sqlite3.connect(EMBEDDING_CACHE_DB) as connection:
+            count = connection.execute("SELECT count(*) FROM embedding_cache").fetchone()[0]
+        print(f'{count} embeddings stored in {EMBEDDING_CACHE_DB}')
+    else:
+        print(f'no embedding cache at {EMBEDDING_CACHE_DB}')
@@ -0,0 +1,254 @@
+import asyncio
+import contextvars
+import hashlib
+import importlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+import logging_setup
+import metrics
+import registry
+import response_cache
+import session_memory
+
+load_dotenv()
+
+# chatter: Pinecone RetrievalQA, chatter3: agent then an LLMChain pass, chatter4: agent, lookup, Serper and GPT-4
+ENGINES = ('chatter', 'chatter3', 'chatter4')
+CHAT_ENGINE = os.environ.get("CHAT_ENGINE", "chatter4")
+# A/B: share of sessions answered by another engine, CHAT_AB=chatter3=0.1,chatter=0.05
+CHAT_AB = os.environ.get("CHAT_AB", "")
+# shadow: engines that are also asked, off the request, and only measured, CHAT_SHADOW=chatter3,chatter
+CHAT_SHADOW = os.environ.get("CHAT_SHADOW", "")
+CHAT_SHADOW_SAMPLE = float(os.environ.get("CHAT_SHADOW_SAMPLE", "1.0"))
+CHAT_SHADOW_WORKERS = int(os.environ.get("CHAT_SHADOW_WORKERS", "2"))
+# shadow runs waiting for a worker beyond this are dropped, the shadows never queue up behind live traffic
+CHAT_SHADOW_PENDING = int(os.environ.get("CHAT_SHADOW_PENDING", "16"))
+# answers at or above this agreement count as the same answer
+AGREEMENT_THRESHOLD = float(os.environ.get("AGREEMENT_THRESHOLD", "0.5"))
+
+PRIMARY = 'primary'
+AB = 'ab'
+SHADOW = 'shadow'
+
+LINK = re.compile(r'https?://[^\s"\'<>]+')
+TAG = re.compile(r'<[^>]+>')
+
+logger = logging.getLogger(__name__)
+
+
+class Engine:
+    # one chat pipeline behind the interface app.py and asgi.py use
+
+    def __init__(self, name, module):
+        self.name = name
+        self.module = module
+        # chatter keeps a history per session, its answers depend on the session asking
+        self.remembers = isinstance(getattr(module, 'sessions', None), session_memory.SessionStore)
+
+    def get_response(self, query):
+        return self.module.get_response(query)
+
+    async def aget_response(self, query):
+        if hasattr(self.module, 'aget_response'):
+            return await self.module.aget_response(query)
+        # sync only pipelines run on the default executor, with the request's trace and session
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(None, context.run, self.module.get_response, query)
+
+    def warmup(self):
+        # chatter and chatter3 build everything at import
+        if hasattr(self.module, 'warmup'):
+            self.module.warmup()
+
+    def ready(self):
+        return self.module.ready() if hasattr(self.module, 'ready') else True
+
+
+catalog = registry.Registry()
+for _name in ENGINES:
+    catalog.register(_name, lambda name=_name: Engine(name, importlib.import_module(name)))
+
+
+def parse_split(text):
+    split = logging_setup.parse_pairs(text, float)
+    unknown = set(split) - set(ENGINES)
+    if unknown:
+        raise ValueError(f'CHAT_AB names unknown engines {", ".join(sorted(unknown))}')
+    if sum(split.values()) > 1:
+        raise ValueError('CHAT_AB shares add up to more than 1')
+    return split
+
+
+def parse_shadows(text):
+    shadows = [name.strip() for name in text.split(',') if name.strip()]
+    unknown = set(shadows) - set(ENGINES)
+    if unknown:
+        raise ValueError(f'CHAT_SHADOW names unknown engines {", ".join(sorted(unknown))}')
+    return [name for name in shadows if name != CHAT_ENGINE]
+
+
+if CHAT_ENGINE not in ENGINES:
+    raise ValueError(f'CHAT_ENGINE must be one of {", ".join(ENGINES)}')
+split = parse_split(CHAT_AB)
+shadows = parse_shadows(CHAT_SHADOW)
+
+
+def get(name):
+    return catalog.get(name)
+
+
+def primary():
+    return catalog.get(CHAT_ENGINE)
+
+
+def configured():
+    return list(dict.fromkeys([CHAT_ENGINE, *split, *shadows]))
+
+
+def warmup():
+    for name in configured():
+        catalog.get(name).warmup()
+
+
+def ready():
+    return all(catalog.loaded(name) and catalog.get(name).ready() for name in configured())
+
+
+def bucket(session_id):
+    # a stable point in [0, 1) per session, so a visitor stays with one engine for the whole conversation
+    digest = hashlib.sha256(session_id.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+
+def choose(session_id=None):
+    # the engine that answers this session and its role, primary unless the session falls in an A/B share
+    if session_id and split:
+        point = bucket(session_id)
+        for name, share in split.items():
+            if point < share:
+                return catalog.get(name), AB
+            point -= share
+    return primary(), PRIMARY
+
+
+def cacheable(engine):
+    # the response cache holds primary answers only, an A/B arm answers, and is measured, on every request;
+    # nor an engine with memory, a cached answer would skip the session's history and never add the turn
+    return engine.name == CHAT_ENGINE and not engine.remembers
+
+
+def flight_key(engine, query, session_id=None):
+    # identical questions asked at once share one run, per session when the engine remembers
+    key = (engine.name, response_cache.cache_key(query))
+    return key + (session_id,) if engine.remembers else key
+
+
+def answer(engine, query):
+    if cacheable(engine):
+        return response_cache.cache.get_or_compute(query, engine.get_response)
+    return engine.get_response(query)
+
+
+async def aanswer(engine, query):
+    loop = asyncio.get_running_loop()
+    if cacheable(engine):
+        response = await loop.run_in_executor(None, response_cache.cache.get, query)
+        if response is None:
+            response = await engine.aget_response(query)
+            await loop.run_in_executor(None, response_cache.cache.set, query, response)
+        return response
+    return await engine.aget_response(query)
+
+
+def record(name, role, request_trace, response=None):
+    # the engine's counters, and the trace as stored with the conversation row, naming the engine that answered
+    labels = (('engine', name), ('role', role))
+    usage = request_trace.to_dict()
+    metrics.registry.inc('chat_engine_requests_total', labels)
+    metrics.registry.observe('chat_engine_seconds', labels, usage['total_ms'] / 1000)
+    metrics.registry.inc('chat_engine_llm_calls_total', labels, len(usage['llm_calls']))
+    metrics.registry.inc('chat_engine_prompt_tokens_total', labels, usage['prompt_tokens'])
+    metrics.registry.inc('chat_engine_completion_tokens_total', labels, usage['completion_tokens'])
+    metrics.registry.inc('chat_engine_cost_usd_total', labels, usage['cost_usd'])
+    if response is not None and response in response_cache.UNCACHEABLE_RESPONSES:
+        metrics.registry.inc('chat_engine_failures_total', labels)
+    return json.dumps(dict(usage, engine=name, role=role))
+
+
+def text_of(response):
+    return response_cache.normalize_query(LINK.sub(' ', TAG.sub(' ', response or ''))).split()
+
+
+def links_of(response):
+    return {link.rstrip('/.,;)') for link in LINK.findall(response or '')}
+
+
+def overlap(first, second):
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
+
+
+def agreement(first, second):
+    # 0..1, how far two answers say the same: overlap of their words, and of the links they cite when they cite any
+    words = overlap(set(text_of(first)), set(text_of(second)))
+    first_links, second_links = links_of(first), links_of(second)
+    if not first_links and not second_links:
+        return words
+    return (words + overlap(first_links, second_links)) / 2
+
+
+_executor = None
+_executor_pid = None
+_pending = threading.BoundedSemaphore(CHAT_SHADOW_PENDING)
+_lock = threading.Lock()
+
+
+def executor():
+    # per process, the pool of a forked parent has no threads in the child
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=CHAT_SHADOW_WORKERS, thread_name_prefix='shadow')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def run_shadow(name, query, response, session_id, request_id):
+    # a context of its own: its own trace and session history, so nothing leaks into the live request or memory
+    try:
+        session_memory.current_session.set(f'shadow-{name}-{session_id or session_memory.DEFAULT_SESSION}')
+        logging_setup.request_id.set(request_id)
+        request_trace = metrics.Trace()
+        metrics.current_trace.set(request_trace)
+        shadow_response = catalog.get(name).get_response(query)
+        record(name, SHADOW, request_trace, shadow_response)
+        score = agreement(response, shadow_response)
+        metrics.registry.inc('chat_shadow_agreement_total',
+                             (('engine', name), ('result', 'agree' if score >= AGREEMENT_THRESHOLD else 'disagree')))
+        logger.info('shadow %s agreement %.2f in %.0f ms', name, score, request_trace.to_dict()['total_ms'],
+                    extra={'engine': name, 'question': query, 'answer': response, 'shadow_answer': shadow_response})
+    except Exception:
+        logger.exception('shadow %s failed', name)
+    finally:
+        _pending.release()
+
+
+def shadow(query, response, session_id=None):
+    # after the primary has answered: the same question to every shadow engine, on the shadow pool
+    if not shadows or random.random() >= CHAT_SHADOW_SAMPLE:
+        return
+    for name in shadows:
+        if not _pending.acquire(blocking=False):
+            metrics.registry.inc('chat_shadow_dropped_total', (('engine', name),))
+            continue
+        executor().submit(contextvars.Context().run, run_shadow, name, query, response, session_id,
+                          logging_setup.request_id.get())
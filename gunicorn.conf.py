@@ -0,0 +1,51 @@
+# gunicorn -c gunicorn.conf.py wsgi:application
+# every setting can be overridden from the environment, WEB_CONCURRENCY being the usual one
+import gc
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "4"))
+# a request mostly waits on OpenAI and Serper, threads keep a worker busy while it waits
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+
+# workers that each rotate the same app.log lose records to each other's renames, with several the file is
+# only appended to and rotated by logrotate (no copytruncate needed, every worker reopens a moved file)
+log_rotate_overridden = workers > 1 and os.environ.get("LOG_ROTATE", "size").lower() != "external"
+if log_rotate_overridden:
+    os.environ["LOG_ROTATE"] = "external"
+
+# the app, models and knowledge base are loaded once in the master and shared copy-on-write
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true").lower() == "true"
+
+# workers are recycled after this many requests, jittered so they don't all restart at once
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", "100"))
+# an agent run can take a minute, in-flight requests get graceful_timeout to finish on restart
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG") or None
+
+
+def when_ready(server):
+    if log_rotate_overridden:
+        server.log.warning(f'{workers} workers share the app log, LOG_ROTATE=external: rotate it with logrotate')
+    # objects built during preload are moved out of the collector's generations, so a collection in a
+    # worker doesn't write to their headers and copy the shared pages
+    if preload_app:
+        gc.freeze()
+        server.log.info(f'{gc.get_freeze_count()} objects frozen before forking workers')
+
+
+def post_fork(server, worker):
+    # without preload the worker imports, and warms up, the app itself after this
+    if preload_app:
+        import wsgi
+
+        wsgi.after_fork()
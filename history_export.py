@@ -0,0 +1,141 @@
+import csv
+import importlib.util
+import io
+import json
+import os
+
+from dotenv import load_dotenv
+from sqlalchemy import select, tuple_
+
+import metrics
+
+load_dotenv()
+
+# rows read per query while exporting, memory use is one chunk however large the table is
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", "1000"))
+# rows per Parquet row group, the writer holds one row group before it is flushed to the response
+EXPORT_ROW_GROUP = int(os.environ.get("EXPORT_ROW_GROUP", "10000"))
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+COLUMNS = ['id', 'date', 'question', 'answer']
+
+
+def parquet_available():
+    # pyarrow is optional, only the Parquet export needs it
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def chunks(engine, table, since=None, until=None, columns=COLUMNS, size=EXPORT_CHUNK_SIZE):
+    # keyset pagination over the (date, id) index: every chunk is its own short read, a long export
+    # never holds one transaction (and the WAL checkpoint) open for its whole duration
+    position = tuple_(table.c.date, table.c.id)
+    query = select(*[table.c[name] for name in columns]).order_by(table.c.date, table.c.id).limit(size)
+    if since is not None:
+        query = query.where(table.c.date >= since)
+    if until is not None:
+        query = query.where(table.c.date < until)
+
+    key = None
+    while True:
+        with engine.connect() as connection:
+            rows = connection.execute(query if key is None else query.where(position > tuple_(*key))).all()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < size:
+            return
+        last = rows[-1]._mapping
+        key = (last['date'], last['id'])
+
+
+def counted(chunks, export_format):
+    for rows in chunks:
+        metrics.registry.inc('chat_export_rows_total', (('format', export_format),), len(rows))
+        yield rows
+
+
+def value(item):
+    return item.isoformat() if hasattr(item, 'isoformat') else item
+
+
+def to_ndjson(chunks, columns=COLUMNS):
+    for rows in chunks:
+        yield ''.join(json.dumps(dict(zip(columns, map(value, row)))) + '\n' for row in rows)
+
+
+def to_csv(chunks, columns=COLUMNS):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in chunks:
+        writer.writerows([value(item) for item in row] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+class Sink:
+    # a write-only file for ParquetWriter, whatever it has written so far is taken out by drain()
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts.clear()
+        return data
+
+
+def to_parquet(chunks, columns=COLUMNS, row_group=EXPORT_ROW_GROUP):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {'id': pa.int64(), 'date': pa.timestamp('us')}
+    schema = pa.schema([(name, types.get(name, pa.string())) for name in columns])
+    sink = Sink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    pending = []
+
+    def write():
+        writer.write_table(pa.Table.from_pylist(pending, schema=schema))
+        pending.clear()
+        return sink.drain()
+
+    for rows in chunks:
+        pending.extend(dict(zip(columns, row)) for row in rows)
+        if len(pending) >= row_group:
+            yield write()
+    if pending:
+        yield write()
+    writer.close()
+    yield sink.drain()
+
+
+SERIALIZERS = {'ndjson': to_ndjson, 'csv': to_csv, 'parquet': to_parquet}
+
+
+def export(engine, table, export_format, since=None, until=None, columns=COLUMNS):
+    rows = counted(chunks(engine, table, since, until, columns), export_format)
+    return SERIALIZERS[export_format](rows, columns)
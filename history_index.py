@@ -0,0 +1,109 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+load_dotenv()
+
+HISTORY_TOTAL_TTL = 60
+# every search typed into the public grid gets a total, the least recently used beyond this are dropped
+HISTORY_TOTAL_SIZE = int(os.environ.get("HISTORY_TOTAL_SIZE", "256"))
+# rows per /api/data page at most, whole-table reads go through the streaming /api/export
+HISTORY_MAX_PAGE = int(os.environ.get("HISTORY_MAX_PAGE", "500"))
+
+DATE_INDEX = "CREATE INDEX IF NOT EXISTS ix_conversation_date ON conversation (date, id)"
+
+FTS_TABLE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS conversation_fts "
+    "USING fts5(question, answer, content='conversation', content_rowid='id')"
+)
+
+FTS_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS conversation_fts_insert AFTER INSERT ON conversation BEGIN
+        INSERT INTO conversation_fts (rowid, question, answer) VALUES (new.id, new.question, new.answer);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS conversation_fts_delete AFTER DELETE ON conversation BEGIN
+        INSERT INTO conversation_fts (conversation_fts, rowid, question, answer)
+        VALUES ('delete', old.id, old.question, old.answer);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS conversation_fts_update AFTER UPDATE ON conversation BEGIN
+        INSERT INTO conversation_fts (conversation_fts, rowid, question, answer)
+        VALUES ('delete', old.id, old.question, old.answer);
+        INSERT INTO conversation_fts (rowid, question, answer) VALUES (new.id, new.question, new.answer);
+    END""",
+]
+
+FTS_REBUILD = "INSERT INTO conversation_fts (conversation_fts) VALUES ('rebuild')"
+
+MATCH_FILTER = "conversation.id IN (SELECT rowid FROM conversation_fts WHERE conversation_fts MATCH :match)"
+
+
+def setup_statements():
+    return [DATE_INDEX, FTS_TABLE] + FTS_TRIGGERS
+
+
+def init_index(session):
+    exists = session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversation_fts'"
+    )).first()
+    for statement in setup_statements():
+        session.execute(text(statement))
+    if not exists:
+        # the index is created empty, backfill it from the rows that predate it
+        session.execute(text(FTS_REBUILD))
+    session.commit()
+
+
+def match_expression(search):
+    # every word must appear, as a prefix, in the question or the answer
+    words = re.findall(r"\w+", search)
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def encode_cursor(values):
+    return ",".join(str(value) for value in values)
+
+
+def decode_cursor(cursor, count):
+    parts = cursor.rsplit(",", count - 1)
+    if len(parts) != count:
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return parts
+
+
+class TotalCache:
+    # the grid only needs an approximate page count, so totals are reused for a short while
+
+    def __init__(self, ttl=HISTORY_TOTAL_TTL, maxsize=HISTORY_TOTAL_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._totals = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._totals.get(key)
+            if entry and now - entry[1] < self.ttl:
+                self._totals.move_to_end(key)
+                return entry[0]
+        total = compute()
+        with self._lock:
+            for expired in [other for other, (_, created) in self._totals.items() if now - created >= self.ttl]:
+                del self._totals[expired]
+            self._totals[key] = (total, now)
+            self._totals.move_to_end(key)
+            while len(self._totals) > self.maxsize:
+                self._totals.popitem(last=False)
+        return total
+
+    def clear(self):
+        with self._lock:
+            self._totals.clear()
+
+
+totals = TotalCache()
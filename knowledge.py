@@ -0,0 +1,181 @@
+import datetime
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+
+import router
+import url_index
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DATA_DIRECTORY = os.environ.get("DATA_DIRECTORY", "./data")
+# seconds between scans of DATA_DIRECTORY, 0 only reloads on demand
+KNOWLEDGE_POLL_INTERVAL = float(os.environ.get("KNOWLEDGE_POLL_INTERVAL", "10"))
+# read as text; anything else (a PDF or docx deal sheet) would reach the prompt as binary noise, it is skipped
+KNOWLEDGE_EXTENSIONS = {'.txt', '.md'}
+
+
+class Snapshot:
+    # an immutable document set: requests keep using the snapshot they started with while a reload swaps in the next
+
+    def __init__(self, version, documents, hashes, changed, reload_seconds):
+        self.version = version
+        self.documents = documents
+        self.hashes = hashes
+        self.changed = changed
+        self.reload_seconds = reload_seconds
+        self.loaded_at = datetime.datetime.utcnow()
+        self.fingerprint = hashlib.sha256(
+            ''.join(f'{path}\0{digest}\n' for path, digest in sorted(hashes.items())).encode('utf-8')
+        ).hexdigest()[:12]
+
+    def to_dict(self):
+        return {
+            'version': self.version,
+            'fingerprint': self.fingerprint,
+            'documents': len(self.documents),
+            'files': self.hashes,
+            'changed': self.changed,
+            'loaded_at': self.loaded_at.isoformat(timespec='seconds') + 'Z',
+            'reload_ms': round(self.reload_seconds * 1000, 1),
+        }
+
+
+class KnowledgeBase:
+
+    def __init__(self, directory=DATA_DIRECTORY, qa_bank_path=url_index.QA_BANK_PATH, interval=KNOWLEDGE_POLL_INTERVAL):
+        self.directory = directory
+        self.qa_bank_path = os.path.abspath(qa_bank_path)
+        self.interval = interval
+        self.snapshot = None
+        self.reloads = 0
+        self.errors = 0
+        self.last_error = None
+        # called with the new snapshot after every reload that follows the first load
+        self.on_reload = []
+        self._files = {}
+        self._documents = {}
+        self._skipped = set()
+        self._refresh_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def scan(self):
+        root = Path(self.directory)
+        files = {}
+        for path in sorted(root.rglob('*')):
+            if path.is_file() and not any(part.startswith('.') for part in path.relative_to(root).parts):
+                if path.suffix.lower() not in KNOWLEDGE_EXTENSIONS:
+                    if str(path) not in self._skipped:
+                        self._skipped.add(str(path))
+                        logger.warning('knowledge skips %s, only %s files are loaded', path,
+                                       ', '.join(sorted(KNOWLEDGE_EXTENSIONS)))
+                    continue
+                stat = path.stat()
+                files[str(path)] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def refresh(self, force=False):
+        # only files whose size or mtime moved are read and hashed, and only those whose hash changed are re-parsed
+        with self._refresh_lock:
+            start = time.perf_counter()
+            changed, hashes = [], {}
+            # staged, and only kept once the new snapshot is built: a failed reload is retried in full next time
+            files, documents = dict(self._files), dict(self._documents)
+            for path, stat in self.scan().items():
+                known = files.get(path)
+                if known is not None and known[0] == stat and not force:
+                    hashes[path] = known[1]
+                    continue
+
+                raw = Path(path).read_bytes()
+                digest = hashlib.sha256(raw).hexdigest()
+                hashes[path] = digest
+                files[path] = (stat, digest)
+                if known is None or known[1] != digest or force:
+                    changed.append(path)
+                    documents[path] = Document(page_content=raw.decode('utf-8', errors='ignore'),
+                                               metadata={'source': path})
+
+            removed = [path for path in documents if path not in hashes]
+            for path in removed:
+                del documents[path]
+                del files[path]
+
+            if self.snapshot is not None and not changed and not removed:
+                self._files = files
+                return self.snapshot
+
+            if self.snapshot is not None and any(os.path.abspath(path) == self.qa_bank_path
+                                                 for path in changed + removed):
+                # both are built in full before being swapped in, lookups in flight finish on the old ones
+                new_index = url_index.load_index()
+                new_router = router.IntentRouter()
+                url_index.set_index(new_index)
+                router.set_router(new_router)
+
+            previous = self.snapshot
+            version = previous.version + 1 if previous is not None else 1
+            self.snapshot = Snapshot(version, tuple(documents[path] for path in sorted(documents)),
+                                     hashes, sorted(changed + removed), time.perf_counter() - start)
+            self._files, self._documents = files, documents
+            self.reloads += 1
+            logger.info('knowledge v%d loaded %d documents, %d changed, %d removed in %.0f ms', version,
+                        len(self.snapshot.documents), len(changed), len(removed), self.snapshot.reload_seconds * 1000)
+
+        if previous is not None:
+            for listener in self.on_reload:
+                listener(self.snapshot)
+        return self.snapshot
+
+    def current(self):
+        self._ensure_watching()
+        return self.snapshot or self.refresh()
+
+    def _ensure_watching(self):
+        # started lazily and per process, so a knowledge base created before a fork still watches in every worker
+        if self.interval <= 0 or (self._thread is not None and self._pid == os.getpid()):
+            return
+        with self._start_lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._watch, name='knowledge-watcher', daemon=True)
+                self._thread.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                logger.exception('knowledge reload failed, keeping v%d', self.snapshot.version if self.snapshot else 0)
+
+    def status(self):
+        snapshot = self.snapshot
+        return {
+            **(snapshot.to_dict() if snapshot is not None else {'version': 0}),
+            'directory': self.directory,
+            'poll_interval': self.interval,
+            'reloads': self.reloads,
+            'errors': self.errors,
+            'last_error': self.last_error,
+        }
+
+
+if __name__ == "__main__":
+    base = KnowledgeBase(sys.argv[1] if len(sys.argv) > 1 else DATA_DIRECTORY, interval=0)
+    base.refresh()
+    for path, digest in base.snapshot.hashes.items():
+        print(f'{digest[:12]} {path}')
@@ -0,0 +1,280 @@
+import json
+import os
+import sys
+import threading
+import uuid
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain.docstore.document import Document
+from langchain.vectorstores.base import VectorStore
+
+load_dotenv()
+
+VECTOR_STORE_PATH = os.environ.get("VECTOR_STORE_PATH", "./instance/vectors")
+# namespaces with at least this many vectors get an IVF index, smaller ones are searched exhaustively
+VECTOR_IVF_THRESHOLD = int(os.environ.get("VECTOR_IVF_THRESHOLD", "20000"))
+VECTOR_NPROBE = int(os.environ.get("VECTOR_NPROBE", "16"))
+
+DEFAULT_NAMESPACE = 'default'
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k(scores, k):
+    if k >= len(scores):
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, k)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def train_ivf(vectors, nlist, iterations=10, sample_size=100000, seed=0):
+    # spherical k-means on a sample, then every vector is assigned to its nearest centroid
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        for list_id in range(nlist):
+            members = sample[assignments == list_id]
+            if len(members):
+                centroids[list_id] = members.mean(axis=0)
+            else:
+                centroids[list_id] = sample[rng.integers(len(sample))]
+        centroids = normalize(centroids)
+
+    assignments = np.concatenate([np.argmax(vectors[start:start + 8192] @ centroids.T, axis=1)
+                                  for start in range(0, len(vectors), 8192)])
+    return centroids, assignments
+
+
+class Namespace:
+    # one collection on disk: <name>.npy holds unit vectors (memory-mapped, so every worker shares
+    # the page cache), <name>.json the documents in the same row order, <name>.ivf.npz the optional IVF lists
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name or DEFAULT_NAMESPACE
+        self.vectors = None
+        self.records = []
+        self.centroids = None
+        self.offsets = None
+
+    def file(self, suffix):
+        return os.path.join(self.path, f'{self.name}{suffix}')
+
+    def exists(self):
+        return os.path.exists(self.file('.json'))
+
+    def load(self):
+        if not self.exists():
+            raise FileNotFoundError(f'vector namespace {self.name!r} not found in {self.path}, '
+                                    f'run python local_vectorstore.py import --namespace {self.name}')
+        with open(self.file('.json'), encoding='utf-8') as f:
+            self.records = json.load(f)['records']
+        self.vectors = np.load(self.file('.npy'), mmap_mode='r')
+        if len(self.vectors) != len(self.records):
+            raise ValueError(f'vector namespace {self.name!r} is inconsistent: '
+                             f'{len(self.vectors)} vectors for {len(self.records)} documents')
+        self.centroids = self.offsets = None
+        if os.path.exists(self.file('.ivf.npz')):
+            ivf = np.load(self.file('.ivf.npz'))
+            self.centroids, self.offsets = ivf['centroids'], ivf['offsets']
+        return self
+
+    def save(self, vectors, records, ivf_threshold=VECTOR_IVF_THRESHOLD):
+        vectors = normalize(vectors)
+        centroids = offsets = None
+        if len(vectors) >= ivf_threshold:
+            centroids, assignments = train_ivf(vectors, nlist=int(np.sqrt(len(vectors))))
+            # rows are stored grouped by list so each probe reads one contiguous slice of the file
+            order = np.argsort(assignments, kind='stable')
+            vectors = vectors[order]
+            records = [records[i] for i in order]
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=len(centroids)))])
+
+        os.makedirs(self.path, exist_ok=True)
+        np.save(self.file('.npy.tmp.npy'), vectors)
+        os.replace(self.file('.npy.tmp.npy'), self.file('.npy'))
+        if centroids is not None:
+            np.savez(self.file('.ivf.tmp.npz'), centroids=centroids, offsets=offsets)
+            os.replace(self.file('.ivf.tmp.npz'), self.file('.ivf.npz'))
+        elif os.path.exists(self.file('.ivf.npz')):
+            os.remove(self.file('.ivf.npz'))
+        with open(self.file('.json.tmp'), 'w', encoding='utf-8') as f:
+            json.dump({'dimensions': int(vectors.shape[1]), 'records': records}, f, ensure_ascii=False)
+        os.replace(self.file('.json.tmp'), self.file('.json'))
+        return self.load()
+
+    def search(self, query_vector, k, nprobe=VECTOR_NPROBE, rows=None):
+        query_vector = normalize(query_vector)
+        if rows is not None:
+            scores = self.vectors[rows] @ query_vector
+            best = top_k(scores, k)
+            return [(int(rows[i]), float(scores[i])) for i in best]
+
+        if self.centroids is None:
+            scores = self.vectors @ query_vector
+            return [(int(i), float(scores[i])) for i in top_k(scores, k)]
+
+        probes = top_k(self.centroids @ query_vector, nprobe)
+        candidates = np.concatenate([np.arange(self.offsets[p], self.offsets[p + 1]) for p in probes])
+        scores = np.concatenate([self.vectors[self.offsets[p]:self.offsets[p + 1]] @ query_vector for p in probes])
+        return [(int(candidates[i]), float(scores[i])) for i in top_k(scores, k)]
+
+
+class LocalVectorStore(VectorStore):
+    # same constructor and search arguments as langchain's Pinecone store, backed by files under VECTOR_STORE_PATH
+
+    def __init__(self, embedding_function, namespace=None, path=VECTOR_STORE_PATH, text_key='text',
+                 nprobe=VECTOR_NPROBE):
+        self._embedding_function = embedding_function
+        self._namespace = namespace or DEFAULT_NAMESPACE
+        self._path = path
+        self._text_key = text_key
+        self._nprobe = nprobe
+        self._namespaces = {}
+        self._lock = threading.Lock()
+
+    def namespace(self, name=None):
+        name = name or self._namespace
+        loaded = self._namespaces.get(name)
+        if loaded is None:
+            with self._lock:
+                if name not in self._namespaces:
+                    self._namespaces[name] = Namespace(self._path, name).load()
+                loaded = self._namespaces[name]
+        return loaded
+
+    def reload(self):
+        with self._lock:
+            self._namespaces.clear()
+
+    def add_texts(self, texts, metadatas=None, ids=None, namespace=None, embeddings=None, **kwargs):
+        texts = list(texts)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        if embeddings is None:
+            embeddings = [self._embedding_function(text) for text in texts]
+
+        records = [{'id': id_, 'metadata': {**metadata, self._text_key: text}}
+                   for id_, text, metadata in zip(ids, texts, metadatas)]
+        target = Namespace(self._path, namespace or self._namespace)
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if target.exists():
+            target.load()
+            replaced = set(ids)
+            keep = [i for i, record in enumerate(target.records) if record['id'] not in replaced]
+            records = [target.records[i] for i in keep] + records
+            vectors = np.concatenate([np.asarray(target.vectors[keep]), vectors])
+
+        with self._lock:
+            self._namespaces[target.name] = target.save(vectors, records)
+        return ids
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, filter=None, namespace=None, **kwargs):
+        loaded = self.namespace(namespace)
+        rows = None
+        if filter:
+            rows = np.array([i for i, record in enumerate(loaded.records)
+                             if all(record['metadata'].get(key) == value for key, value in filter.items())],
+                            dtype=np.int64)
+            if not len(rows):
+                return []
+
+        results = []
+        for row, score in loaded.search(embedding, k, nprobe=self._nprobe, rows=rows):
+            metadata = dict(loaded.records[row]['metadata'])
+            text = metadata.pop(self._text_key, '')
+            results.append((Document(page_content=text, metadata=metadata), score))
+        return results
+
+    def similarity_search_with_score(self, query, k=4, filter=None, namespace=None, **kwargs):
+        return self.similarity_search_by_vector_with_score(self._embedding_function(query), k, filter, namespace)
+
+    def similarity_search(self, query, k=4, filter=None, namespace=None, **kwargs):
+        return [document for document, _ in self.similarity_search_with_score(query, k, filter, namespace)]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, namespace=None, **kwargs):
+        return [document for document, _ in
+                self.similarity_search_by_vector_with_score(embedding, k, filter, namespace)]
+
+    def _similarity_search_with_relevance_scores(self, query, k=4, **kwargs):
+        return self.similarity_search_with_score(query, k, **kwargs)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, namespace=None, path=VECTOR_STORE_PATH,
+                   text_key='text', **kwargs):
+        texts = list(texts)
+        store = cls(embedding.embed_query, namespace, path, text_key)
+        store.add_texts(texts, metadatas, ids, embeddings=embedding.embed_documents(texts))
+        return store
+
+    @classmethod
+    def from_existing_index(cls, embedding, namespace=None, path=VECTOR_STORE_PATH, text_key='text'):
+        store = cls(embedding.embed_query, namespace, path, text_key)
+        store.namespace()
+        return store
+
+
+def import_pinecone(namespace, index_name=None, path=VECTOR_STORE_PATH, batch_size=100, max_rounds=200):
+    # the pinecone client cannot list ids, so the namespace is swept with random queries until every
+    # vector has been seen, then fetched in batches with values and metadata
+    import pinecone
+
+    pinecone.init(api_key=os.environ.get("PINECONE_API_KEY"), environment=os.environ.get("PINECONE_ENV"))
+    index = pinecone.Index(index_name or os.environ.get("PINECONE_INDEX"))
+    stats = index.describe_index_stats()
+    expected = stats['namespaces'].get(namespace or '', {}).get('vector_count', 0)
+    dimensions = stats['dimension']
+
+    rng = np.random.default_rng(0)
+    ids = set()
+    rounds_without_progress = 0
+    while len(ids) < expected and rounds_without_progress < max_rounds:
+        probe = normalize(rng.standard_normal(dimensions)).tolist()
+        matches = index.query(vector=probe, top_k=1000, namespace=namespace)['matches']
+        found = len(ids)
+        ids.update(match['id'] for match in matches)
+        rounds_without_progress = 0 if len(ids) > found else rounds_without_progress + 1
+        print(f'{namespace}: found {len(ids)} of {expected} ids')
+    if len(ids) < expected:
+        print(f'{namespace}: only {len(ids)} of {expected} vectors could be reached, importing those')
+
+    vectors, records = [], []
+    ordered_ids = sorted(ids)
+    for start in range(0, len(ordered_ids), batch_size):
+        fetched = index.fetch(ids=ordered_ids[start:start + batch_size], namespace=namespace)['vectors']
+        for id_, vector in fetched.items():
+            vectors.append(vector['values'])
+            records.append({'id': id_, 'metadata': dict(vector.get('metadata') or {})})
+
+    Namespace(path, namespace).save(np.asarray(vectors, dtype=np.float32), records)
+    print(f'{namespace}: imported {len(records)} vectors into {path}')
+    return len(records)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'import':
+        import argparse
+
+        parser = argparse.ArgumentParser(prog='local_vectorstore.py import',
+                                         description='copy a Pinecone namespace into the local vector store')
+        parser.add_argument('--namespace', action='append', required=True)
+        parser.add_argument('--index', default=os.environ.get("PINECONE_INDEX"))
+        parser.add_argument('--path', default=VECTOR_STORE_PATH)
+        args = parser.parse_args(sys.argv[2:])
+        for name in args.namespace:
+            import_pinecone(name, args.index, args.path)
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'info':
+        for file_name in sorted(os.listdir(VECTOR_STORE_PATH)):
+            if file_name.endswith('.json'):
+                loaded = Namespace(VECTOR_STORE_PATH, file_name[:-len('.json')]).load()
+                mode = f'ivf ({len(loaded.centroids)} lists)' if loaded.centroids is not None else 'exact'
+                print(f'{loaded.name}: {len(loaded.records)} vectors, {loaded.vectors.shape[1]} dimensions, {mode}')
+    else:
+        print('usage: python local_vectorstore.py import --namespace NAME [--namespace NAME] | info')
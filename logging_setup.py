@@ -0,0 +1,238 @@
+import atexit
+import contextvars
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import uuid
+import zlib
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LOG_FILE = os.environ.get("LOG_FILE", "app.log")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG").upper()
+# json or text, text keeps the old "asctime level message" lines
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+# size rotates at LOG_MAX_BYTES, time rotates at LOG_WHEN (see TimedRotatingFileHandler), external leaves it to
+# logrotate and reopens the file once it has been moved: the only one safe with several processes on one file
+LOG_ROTATE = os.environ.get("LOG_ROTATE", "size").lower()
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_WHEN = os.environ.get("LOG_WHEN", "midnight")
+LOG_BACKUPS = int(os.environ.get("LOG_BACKUPS", "7"))
+LOG_STDERR = os.environ.get("LOG_STDERR", "false").lower() == "true"
+# per logger levels, e.g. "chatter4=INFO,werkzeug=WARNING"
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+# fraction of requests whose records below WARNING are kept, per logger, e.g. "app.conversation=0.1,chatter4=0.5"
+LOG_SAMPLE = os.environ.get("LOG_SAMPLE", "")
+
+REQUEST_ID = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+request_id = contextvars.ContextVar('request_id', default=None)
+
+# attributes every LogRecord has, anything else on a record came in through extra= and goes into the JSON
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id'}
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+def valid_request_id(value):
+    # an id set by the proxy in X-Request-ID is kept so its logs and ours line up
+    return bool(value) and REQUEST_ID.match(value) is not None
+
+
+def parse_pairs(text, convert):
+    pairs = {}
+    for item in text.split(','):
+        if '=' in item:
+            name, value = item.split('=', 1)
+            pairs[name.strip()] = convert(value.strip())
+    return pairs
+
+
+class RequestContextFilter(logging.Filter):
+    # runs on the request thread, before the record is queued, while the request's context is still current
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    # keeps a fraction of the debug and info records of the configured loggers, warnings and errors always pass;
+    # the decision hashes the request id so a request is either logged in full or not at all
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = sorted(rates.items(), key=lambda item: -len(item[0]))
+        self.dropped = 0
+
+    def rate(self, name):
+        for prefix, rate in self.rates:
+            if name == prefix or name.startswith(prefix + '.'):
+                return rate
+        return 1.0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self.rate(record.name)
+        if rate >= 1.0:
+            return True
+        rid = getattr(record, 'request_id', None)
+        keep = (zlib.crc32(rid.encode()) % 10000) < rate * 10000 if rid else random.random() < rate
+        if not keep:
+            self.dropped += 1
+        return keep
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if getattr(record, 'request_id', None):
+            entry['request_id'] = record.request_id
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        rid = getattr(record, 'request_id', None)
+        return f'{line} [{rid}]' if rid else line
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    # the request thread only formats the message and enqueues it, the listener thread writes the file;
+    # the listener is started lazily and per process so workers forked after setup() each get their own
+
+    def __init__(self, handlers):
+        super().__init__(queue.SimpleQueue())
+        self.handlers = handlers
+        self.listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self.listener is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self.listener is None or self._pid != os.getpid():
+                self.queue = queue.SimpleQueue()
+                self.listener = logging.handlers.QueueListener(self.queue, *self.handlers,
+                                                               respect_handler_level=True)
+                self.listener.start()
+                self._pid = os.getpid()
+
+    def prepare(self, record):
+        # the message and traceback are rendered here, later changes to args or the exception can't leak in,
+        # the JSON encoding and the write happen on the listener thread
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        self.queue.put_nowait(record)
+
+    def flush(self):
+        # drains the queue, used at exit and by the benchmark
+        if self.listener is not None and self._pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+        for handler in self.handlers:
+            handler.flush()
+
+
+def file_handler(path=LOG_FILE, rotate=LOG_ROTATE):
+    if rotate == 'external':
+        return logging.handlers.WatchedFileHandler(path, encoding='utf-8', delay=True)
+    if rotate == 'time':
+        return logging.handlers.TimedRotatingFileHandler(path, when=LOG_WHEN, backupCount=LOG_BACKUPS,
+                                                         encoding='utf-8', delay=True)
+    return logging.handlers.RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS,
+                                                encoding='utf-8', delay=True)
+
+
+_handler = None
+
+
+def setup(path=LOG_FILE, level=LOG_LEVEL, fmt=LOG_FORMAT, rotate=LOG_ROTATE, levels=LOG_LEVELS, sample=LOG_SAMPLE,
+          stderr=LOG_STDERR):
+    # replaces the root handlers once per process, calling it again returns the handler already installed
+    global _handler
+    if _handler is not None:
+        return _handler
+
+    formatter = JsonFormatter() if fmt == 'json' else TextFormatter()
+    handlers = []
+    if path:
+        handlers.append(file_handler(path, rotate))
+    if stderr or not path:
+        handlers.append(logging.StreamHandler(sys.stderr))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    _handler = QueueHandler(handlers)
+    _handler.addFilter(RequestContextFilter())
+    _handler.addFilter(SamplingFilter(parse_pairs(sample, float)))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    root.setLevel(level)
+    for name, name_level in parse_pairs(levels, str.upper).items():
+        logging.getLogger(name).setLevel(name_level)
+
+    atexit.unregister(shutdown)
+    atexit.register(shutdown)
+    return _handler
+
+
+def shutdown():
+    # writes out what is still queued and removes the handler, setup() can then install a new one
+    global _handler
+    if _handler is None:
+        return
+    _handler.flush()
+    logging.getLogger().removeHandler(_handler)
+    for handler in _handler.handlers:
+        handler.close()
+    _handler = None
+
+
+def sampling_filter():
+    if _handler is None:
+        return None
+    return next((f for f in _handler.filters if isinstance(f, SamplingFilter)), None)
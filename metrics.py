@@ -0,0 +1,242 @@
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60]
+
+# USD per 1K prompt / completion tokens
+MODEL_PRICES = {
+    'gpt-4': (0.03, 0.06),
+    'gpt-4-32k': (0.06, 0.12),
+    'gpt-3.5-turbo-16k': (0.003, 0.004),
+    'gpt-3.5-turbo': (0.0015, 0.002),
+}
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+def model_price(model):
+    for prefix in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model and model.startswith(prefix):
+            return MODEL_PRICES[prefix]
+    return 0.0, 0.0
+
+
+@functools.lru_cache(maxsize=None)
+def token_encoding(model):
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        # the encoding files are downloaded on first use, offline hosts fall back to word counts
+        logger.warning('tiktoken unavailable, counting words instead: %s', e)
+        return None
+
+
+def count_tokens(model, text):
+    encoding = token_encoding(model)
+    if encoding is None:
+        return len(text.split())
+    return len(encoding.encode(text))
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+
+    def __init__(self):
+        self.histograms = defaultdict(Histogram)
+        self.counters = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            self.histograms[(name, labels)].observe(value)
+
+    def inc(self, name, labels, value=1.0):
+        with self._lock:
+            self.counters[(name, labels)] += value
+
+    def render(self, gauges=()):
+        lines = []
+        with self._lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'{name}{format_labels(labels)} {value}')
+        for name, labels, value in gauges:
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+registry = Registry()
+
+
+class Trace:
+    # per-request record of stage timings and LLM usage, stored with the Conversation row
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+        self.llm_calls = []
+        self._lock = threading.Lock()
+
+    def add_span(self, stage, seconds):
+        with self._lock:
+            self.spans.append({'stage': stage, 'ms': round(seconds * 1000, 1)})
+
+    def add_llm_call(self, call):
+        with self._lock:
+            self.llm_calls.append(call)
+
+    def to_dict(self):
+        return {
+            'total_ms': round((time.perf_counter() - self.start) * 1000, 1),
+            'spans': self.spans,
+            'llm_calls': self.llm_calls,
+            'prompt_tokens': sum(call['prompt_tokens'] for call in self.llm_calls),
+            'completion_tokens': sum(call['completion_tokens'] for call in self.llm_calls),
+            'cost_usd': round(sum(call['cost_usd'] for call in self.llm_calls), 6),
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+
+@contextlib.contextmanager
+def trace():
+    request_trace = Trace()
+    token = current_trace.set(request_trace)
+    try:
+        yield request_trace
+    finally:
+        current_trace.reset(token)
+        registry.observe('chat_request_seconds', (), time.perf_counter() - request_trace.start)
+
+
+@contextlib.contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe('chat_stage_seconds', (('stage', stage),), elapsed)
+        request_trace = current_trace.get()
+        if request_trace is not None:
+            request_trace.add_span(stage, elapsed)
+
+
+def timed(stage):
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def callbacks(stage):
+    return [LLMMetricsHandler(stage, current_trace.get())]
+
+
+class LLMMetricsHandler(BaseCallbackHandler):
+    # created per call and bound to the request trace, because LangChain runs sync handlers
+    # for async chains on an executor thread where the trace context variable is not set.
+    # Without a trace it reports to the caller's, for handlers attached to a sync-only model once
+
+    def __init__(self, stage, request_trace=None):
+        self.stage = stage
+        self.trace = request_trace
+        self._runs = {}
+
+    def on_llm_start(self, serialized, prompts, *, run_id=None, **kwargs):
+        self._runs[run_id] = (time.perf_counter(), prompts)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id=None, **kwargs):
+        prompts = ['\n'.join(message.content for message in batch) for batch in messages]
+        self._runs[run_id] = (time.perf_counter(), prompts)
+
+    def on_llm_error(self, error, *, run_id=None, **kwargs):
+        self._runs.pop(run_id, None)
+
+    def on_llm_end(self, response, *, run_id=None, **kwargs):
+        start, prompts = self._runs.pop(run_id, (None, []))
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+
+        output = response.llm_output or {}
+        model = output.get('model_name', '')
+        usage = output.get('token_usage') or {}
+        prompt_tokens = usage.get('prompt_tokens')
+        completion_tokens = usage.get('completion_tokens')
+        if prompt_tokens is None:
+            # streaming responses carry no usage block, count with the model's tokenizer instead
+            completion = ''.join(generation.text for batch in response.generations for generation in batch)
+            prompt_tokens = sum(count_tokens(model, prompt) for prompt in prompts)
+            completion_tokens = count_tokens(model, completion)
+
+        prompt_price, completion_price = model_price(model)
+        cost = prompt_tokens / 1000 * prompt_price + completion_tokens / 1000 * completion_price
+
+        labels = (('stage', self.stage), ('model', model))
+        registry.observe('chat_llm_seconds', labels, elapsed)
+        registry.inc('chat_llm_prompt_tokens_total', labels, prompt_tokens)
+        registry.inc('chat_llm_completion_tokens_total', labels, completion_tokens)
+        registry.inc('chat_llm_cost_usd_total', labels, cost)
+
+        request_trace = self.trace if self.trace is not None else current_trace.get()
+        if request_trace is not None:
+            request_trace.add_llm_call({
+                'stage': self.stage,
+                'model': model,
+                'ms': round(elapsed * 1000, 1),
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'cost_usd': round(cost, 6),
+            })
@@ -0,0 +1,187 @@
+import atexit
+import contextlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+from sqlalchemy import event
+
+load_dotenv()
+
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", "50"))
+WRITE_INTERVAL = float(os.environ.get("WRITE_INTERVAL", "1.0"))
+
+logger = logging.getLogger(__name__)
+
+STOP = object()
+
+
+def enable_wal(engine):
+    # readers no longer block the writer, and commits skip the fsync of the rollback journal
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    engine.dispose()
+
+
+def add_missing_columns(engine, table):
+    # create_all never alters an existing table, so columns added to the model later are added here
+    with engine.begin() as connection:
+        existing = {row[1] for row in connection.exec_driver_sql(f'PRAGMA table_info({table.name})')}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(engine.dialect)
+                connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+
+
+class SQLiteConnection:
+    # a sqlite3 connection per process: one opened before a fork (gunicorn --preload) is reopened in the
+    # worker on first use, a connection must never be used on both sides of a fork
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._connect()
+
+    def _connect(self):
+        with self._lock:
+            if self._connection is None or self._pid != os.getpid():
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None,
+                                                   timeout=self.timeout)
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._pid = os.getpid()
+            return self._connection
+
+    def execute(self, *args):
+        connection = self._connection if self._pid == os.getpid() else self._connect()
+        return connection.execute(*args)
+
+    def executemany(self, *args):
+        connection = self._connection if self._pid == os.getpid() else self._connect()
+        return connection.executemany(*args)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, a read-modify-write inside is atomic across
+        # processes; the caller keeps its own other threads off the connection meanwhile
+        connection = self._connection if self._pid == os.getpid() else self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+
+def after_fork(engine):
+    # pooled SQLAlchemy connections belong to the parent, close=False leaves them open there
+    engine.dispose(close=False)
+
+
+class BatchWriter:
+    # write-behind queue: request threads enqueue rows, one background thread inserts them in batches
+
+    def __init__(self, engine, table, batch_size=WRITE_BATCH_SIZE, interval=WRITE_INTERVAL):
+        self.engine = engine
+        self.table = table
+        self.batch_size = batch_size
+        self.interval = interval
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # started lazily so a writer created before a fork gets its own thread in every worker
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, name='batch-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def submit(self, **row):
+        self._ensure_started()
+        self._queue.put(row)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout=self.interval)
+            except queue.Empty:
+                continue
+
+            rows = []
+            while True:
+                if item is STOP:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    self._write(rows)
+                    rows = []
+                    item.set()
+                else:
+                    rows.append(item)
+                if stopping or len(rows) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._write(rows)
+
+    def _insert(self, rows):
+        with self.engine.begin() as connection:
+            connection.execute(self.table.insert(), rows)
+        self.written += len(rows)
+        self.batches += 1
+
+    def _write(self, rows):
+        if not rows:
+            return
+        try:
+            self._insert(rows)
+        except Exception as e:
+            # most often a transient "database is locked", the batch gets one more try before it is dropped
+            logger.warning('Unable to write %d rows to %s, retrying: %r', len(rows), self.table.name, e)
+            time.sleep(self.interval)
+            try:
+                self._insert(rows)
+            except Exception:
+                self.dropped += len(rows)
+                logger.exception('Unable to write %d rows to %s', len(rows), self.table.name)
+
+    def flush(self, timeout=None):
+        if self._thread is None or self._pid != os.getpid():
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def stop(self, timeout=10):
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        self._queue.put(STOP)
+        self._thread.join(timeout)
+
+    def pending(self):
+        return self._queue.qsize()
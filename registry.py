@@ -0,0 +1,59 @@
+import threading
+import time
+
+
+class Registry:
+    # builds each component on first use, once per process, and remembers how long it took
+
+    def __init__(self):
+        self._factories = {}
+        self._instances = {}
+        self._lock = threading.RLock()
+        self.timings = {}
+
+    def register(self, name, factory=None):
+        if factory is None:
+            return lambda f: self.register(name, f)
+        self._factories[name] = factory
+        return factory
+
+    def get(self, name):
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+
+        with self._lock:
+            if name not in self._instances:
+                start = time.perf_counter()
+                self._instances[name] = self._factories[name]()
+                self.timings[name] = time.perf_counter() - start
+            return self._instances[name]
+
+    def override(self, name, instance):
+        with self._lock:
+            self._instances[name] = instance
+            self.timings.pop(name, None)
+
+    def reset(self, name=None):
+        with self._lock:
+            if name is None:
+                self._instances.clear()
+                self.timings.clear()
+            else:
+                self._instances.pop(name, None)
+                self.timings.pop(name, None)
+
+    def preload(self, *names):
+        start = time.perf_counter()
+        for name in names or list(self._factories):
+            self.get(name)
+        return time.perf_counter() - start
+
+    def loaded(self, name):
+        return name in self._instances
+
+    def __contains__(self, name):
+        return name in self._factories
+
+    def report(self):
+        return {name: round(seconds * 1000, 1) for name, seconds in self.timings.items()}
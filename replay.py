@@ -0,0 +1,358 @@
+import asyncio
+import atexit
+import copy
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+import openai
+from dotenv import load_dotenv
+from langchain.utilities import OpenWeatherMapAPIWrapper
+
+import search_client
+
+load_dotenv()
+
+REPLAY_MODE = os.environ.get("REPLAY_MODE", "replay")
+REPLAY_CASSETTE = os.environ.get("REPLAY_CASSETTE", "./bench/cassettes/chat.json")
+
+# record: call the live backend on a miss and store the response
+# replay: serve only from the cassette, a miss raises CassetteMiss
+# stub: serve from the cassette when possible, otherwise answer with a deterministic stub
+RECORD = 'record'
+REPLAY = 'replay'
+STUB = 'stub'
+MODES = (RECORD, REPLAY, STUB)
+
+KINDS = ('chat', 'embedding', 'serper', 'google', 'weather')
+CHAT_REQUEST_FIELDS = ('model', 'messages', 'temperature', 'stop', 'n', 'max_tokens', 'functions')
+EMBEDDING_DIMENSIONS = 1536
+
+active = None
+
+
+class CassetteMiss(KeyError):
+    pass
+
+
+def request_key(kind, request):
+    payload = json.dumps([kind, request], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class Cassette:
+    # recorded backend responses keyed by the hash of the request that produced them
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.entries = json.load(f)['entries']
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, kind, request, response, elapsed):
+        with self._lock:
+            self.entries[key] = {'kind': kind, 'request': request, 'response': response,
+                                 'elapsed': round(elapsed, 4)}
+            self.dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self.dirty or not self.path:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': 1, 'entries': self.entries}, f, indent=1, sort_keys=True, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+
+class Recorder:
+
+    def __init__(self, cassette, mode=REPLAY, latency=None):
+        if mode not in MODES:
+            raise ValueError(f'unknown replay mode {mode!r}, expected one of {MODES}')
+        self.cassette = cassette
+        self.mode = mode
+        # seconds to wait per backend kind, None replays the latency measured when the call was recorded
+        self.latency = latency or {}
+        self.calls = Counter()
+        self.misses = Counter()
+        self._lock = threading.Lock()
+        self._patches = []
+
+    def _find(self, kind, request):
+        key = request_key(kind, request)
+        entry = self.cassette.get(key)
+        with self._lock:
+            self.calls[kind] += 1
+            if entry is None:
+                self.misses[kind] += 1
+
+        if entry is not None:
+            return key, copy.deepcopy(entry['response']), self._delay(kind, entry['elapsed'])
+        if self.mode == RECORD:
+            return key, None, 0
+        if self.mode == REPLAY:
+            raise CassetteMiss(f'no {kind} recording for request {key[:12]} in {self.cassette.path}')
+        return key, STUBS[kind](request), self._delay(kind, 0.0)
+
+    def _delay(self, kind, recorded):
+        latency = self.latency.get(kind)
+        return recorded if latency is None else latency
+
+    def call(self, kind, request, live):
+        key, response, delay = self._find(kind, request)
+        if response is None:
+            start = time.perf_counter()
+            response = live()
+            self.cassette.put(key, kind, request, response, time.perf_counter() - start)
+            return copy.deepcopy(response)
+        if delay:
+            time.sleep(delay)
+        return response
+
+    async def acall(self, kind, request, live):
+        key, response, delay = self._find(kind, request)
+        if response is None:
+            start = time.perf_counter()
+            response = await live()
+            self.cassette.put(key, kind, request, response, time.perf_counter() - start)
+            return copy.deepcopy(response)
+        if delay:
+            await asyncio.sleep(delay)
+        return response
+
+    def patch(self, owner, name, replacement):
+        self._patches.append((owner, name, owner.__dict__.get(name)))
+        setattr(owner, name, replacement)
+
+    def unpatch(self):
+        for owner, name, original in reversed(self._patches):
+            if original is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+        self._patches = []
+
+    def stats(self):
+        with self._lock:
+            return {'calls': dict(self.calls), 'misses': dict(self.misses)}
+
+
+def chat_request(kwargs):
+    return {field: kwargs[field] for field in CHAT_REQUEST_FIELDS if kwargs.get(field) is not None}
+
+
+def chat_record(response, stream):
+    # streamed and plain completions are stored the same way so either can be replayed as the other
+    if stream:
+        role, content = 'assistant', ''
+        for chunk in response:
+            delta = chunk['choices'][0]['delta']
+            role = delta.get('role', role)
+            content += delta.get('content', '')
+        return {'message': {'role': role, 'content': content}, 'usage': None}
+    message = response['choices'][0]['message']
+    return {'message': {'role': message['role'], 'content': message['content']}, 'usage': dict(response['usage'])}
+
+
+async def achat_record(response, stream):
+    if not stream:
+        return chat_record(response, False)
+    chunks = [chunk async for chunk in response]
+    return chat_record(chunks, True)
+
+
+def estimate_usage(request, content):
+    # word counts, so replayed non-streaming calls report usage without a tokenizer download
+    prompt_tokens = sum(len(message.get('content', '').split()) for message in request['messages'])
+    completion_tokens = len(content.split())
+    return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens}
+
+
+def chat_response(request, stored):
+    message = stored['message']
+    return {
+        'object': 'chat.completion',
+        'model': request.get('model'),
+        'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop'}],
+        'usage': stored.get('usage') or estimate_usage(request, message['content']),
+    }
+
+
+def chat_chunks(stored):
+    message = stored['message']
+    chunks = [{'choices': [{'index': 0, 'delta': {'role': message['role']}, 'finish_reason': None}]}]
+    for piece in re.findall(r'\s*\S+|\s+$', message['content']):
+        chunks.append({'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]})
+    chunks.append({'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+    return chunks
+
+
+async def achat_chunks(stored):
+    for chunk in chat_chunks(stored):
+        yield chunk
+
+
+def stub_agent_step(content):
+    # enough of the chat ReAct format for the agent to pick a tool and finish after one observation
+    if 'Observation:' in content:
+        observation = content.rsplit('Observation:', 1)[1].split('\nThought:')[0].strip()
+        return f'Final Answer: {observation}'
+
+    import router
+    question = content.split('\n\n')[0].strip()
+    intent, _ = router.route(question)
+    tool = {
+        router.GREETING: 'Greeter',
+        router.CONTACT: 'Greeter',
+        router.WEATHER: 'OpenWeatherMap',
+        router.GENERAL: 'Google',
+    }.get(intent, 'TravelBestBets')
+    action = json.dumps({'action': tool, 'action_input': question})
+    return f'Thought: I should use {tool}\nAction:\n```\n{action}\n```'
+
+
+def stub_chat(request):
+    messages = request['messages']
+    if 'action_input' in messages[0]['content']:
+        content = stub_agent_step(messages[-1]['content'])
+    else:
+        content = f'Stub answer {request_key("chat", request)[:8]}: no recording for this prompt.'
+    return {'message': {'role': 'assistant', 'content': content}, 'usage': None}
+
+
+def stub_vector(text):
+    rng = random.Random(hashlib.sha256(json.dumps(text).encode('utf-8')).digest())
+    vector = [rng.gauss(0, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+    norm = sum(value * value for value in vector) ** 0.5
+    return [value / norm for value in vector]
+
+
+def stub_embedding(request):
+    inputs = request['input'] if isinstance(request['input'], list) else [request['input']]
+    return {
+        'object': 'list',
+        'data': [{'object': 'embedding', 'index': i, 'embedding': stub_vector(text)} for i, text in enumerate(inputs)],
+        'usage': {'prompt_tokens': 0, 'total_tokens': 0},
+    }
+
+
+def stub_serper(request):
+    return {'organic': [{'title': 'Travel Best Bets', 'link': 'https://travelbestbets.com/deals/',
+                         'snippet': f'Stub search result for {request["q"]}'}]}
+
+
+def stub_google(request):
+    return [{'title': 'Travel Best Bets', 'link': 'https://travelbestbets.com/deals/',
+             'snippet': f'Stub search result for {request["q"]}'}]
+
+
+def stub_weather(request):
+    return (f'In {request["location"]}, the current weather is as follows:\nDetailed status: clear sky\n'
+            f'Temperature: \n  - Current: 21.0°C\n  - High: 24.0°C\n  - Low: 17.0°C')
+
+
+STUBS = {
+    'chat': stub_chat,
+    'embedding': stub_embedding,
+    'serper': stub_serper,
+    'google': stub_google,
+    'weather': stub_weather,
+}
+
+
+def serper_request(client, term):
+    wrapper = client.wrapper
+    return {'q': term, 'type': getattr(wrapper, 'type', 'search'), 'gl': getattr(wrapper, 'gl', None),
+            'hl': getattr(wrapper, 'hl', None), 'num': getattr(wrapper, 'k', None)}
+
+
+def install(mode=REPLAY_MODE, cassette=REPLAY_CASSETTE, latency=None):
+    # routes every OpenAI, Serper, Google and OpenWeatherMap call in this process through the cassette
+    global active
+    uninstall()
+    recorder = Recorder(Cassette(cassette), mode, latency)
+
+    create = openai.ChatCompletion.create
+    acreate = openai.ChatCompletion.acreate
+    embedding_create = openai.Embedding.create
+    embedding_acreate = openai.Embedding.acreate
+    serper_fetch = search_client.SerperClient._fetch
+    serper_afetch = search_client.SerperClient._afetch
+    google_fetch = search_client.GoogleClient._fetch
+    weather_run = OpenWeatherMapAPIWrapper.run
+
+    def chat_create(*args, **kwargs):
+        request, stream = chat_request(kwargs), kwargs.get('stream', False)
+        stored = recorder.call('chat', request, lambda: chat_record(create(*args, **kwargs), stream))
+        return iter(chat_chunks(stored)) if stream else chat_response(request, stored)
+
+    async def chat_acreate(*args, **kwargs):
+        request, stream = chat_request(kwargs), kwargs.get('stream', False)
+
+        async def live():
+            return await achat_record(await acreate(*args, **kwargs), stream)
+
+        stored = await recorder.acall('chat', request, live)
+        return achat_chunks(stored) if stream else chat_response(request, stored)
+
+    def embedding_request(kwargs):
+        return {'model': kwargs.get('model') or kwargs.get('engine'), 'input': kwargs['input']}
+
+    def embeddings(*args, **kwargs):
+        return recorder.call('embedding', embedding_request(kwargs),
+                             lambda: json.loads(json.dumps(embedding_create(*args, **kwargs))))
+
+    async def aembeddings(*args, **kwargs):
+        async def live():
+            return json.loads(json.dumps(await embedding_acreate(*args, **kwargs)))
+
+        return await recorder.acall('embedding', embedding_request(kwargs), live)
+
+    def fetch_serper(self, term):
+        return recorder.call('serper', serper_request(self, term), lambda: serper_fetch(self, term))
+
+    async def afetch_serper(self, term):
+        return await recorder.acall('serper', serper_request(self, term), lambda: serper_afetch(self, term))
+
+    def fetch_google(self, term):
+        return recorder.call('google', {'q': term, 'num': self.num_results}, lambda: google_fetch(self, term))
+
+    def weather(self, location):
+        return recorder.call('weather', {'location': location}, lambda: weather_run(self, location))
+
+    recorder.patch(openai.ChatCompletion, 'create', staticmethod(chat_create))
+    recorder.patch(openai.ChatCompletion, 'acreate', staticmethod(chat_acreate))
+    recorder.patch(openai.Embedding, 'create', staticmethod(embeddings))
+    recorder.patch(openai.Embedding, 'acreate', staticmethod(aembeddings))
+    recorder.patch(search_client.SerperClient, '_fetch', fetch_serper)
+    recorder.patch(search_client.SerperClient, '_afetch', afetch_serper)
+    recorder.patch(search_client.GoogleClient, '_fetch', fetch_google)
+    recorder.patch(OpenWeatherMapAPIWrapper, 'run', weather)
+
+    if mode == RECORD:
+        atexit.register(recorder.cassette.save)
+    active = recorder
+    return recorder
+
+
+def uninstall():
+    global active
+    if active is not None:
+        active.unpatch()
+        active.cassette.save()
+        active = None
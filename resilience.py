@@ -0,0 +1,486 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import aiohttp
+import openai
+import requests
+from dotenv import load_dotenv
+from langchain.callbacks.base import BaseCallbackHandler
+
+import metrics
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# seconds a whole /chat request may take, every stage gets what is left of it
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE", "45"))
+# seconds per attempt, before the deadline cuts it shorter
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "30"))
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT", "8"))
+# extra attempts after a timeout, connection error, 429 or 5xx, with full jitter backoff
+CALL_RETRIES = int(os.environ.get("CALL_RETRIES", "2"))
+RETRY_BASE = float(os.environ.get("RETRY_BASE", "0.25"))
+RETRY_CAP = float(os.environ.get("RETRY_CAP", "2"))
+# the backup model starts once the primary has taken longer than this percentile of its recent calls,
+# HEDGE_DELAY seconds until HEDGE_MIN_SAMPLES calls have been seen
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "true").lower() == "true"
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "90"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_DELAY = float(os.environ.get("HEDGE_DELAY", "10"))
+# consecutive failures that open a backend's breaker, and seconds before one trial call is let through
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.environ.get("BREAKER_RESET", "30"))
+# threads running sync backend calls under a timeout, an abandoned call keeps its thread until it returns
+RESILIENCE_WORKERS = int(os.environ.get("RESILIENCE_WORKERS", "64"))
+
+current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+
+    def __init__(self, backend, retry_in):
+        super().__init__(f'{backend} circuit open, retry in {retry_in:.1f}s')
+        self.backend = backend
+        self.retry_in = retry_in
+
+
+@contextlib.contextmanager
+def deadline(seconds=REQUEST_DEADLINE):
+    # a nested deadline can only shorten the one around it
+    expires = time.monotonic() + seconds
+    outer = current_deadline.get()
+    if outer is not None:
+        expires = min(expires, outer)
+    token = current_deadline.set(expires)
+    try:
+        yield expires
+    finally:
+        current_deadline.reset(token)
+
+
+def remaining():
+    expires = current_deadline.get()
+    return None if expires is None else expires - time.monotonic()
+
+
+def budget(timeout):
+    # the attempt's timeout cut to what is left of the request, None when neither applies
+    left = remaining()
+    if left is not None and left <= 0:
+        metrics.registry.inc('chat_deadline_exceeded_total', ())
+        raise DeadlineExceeded('request deadline exceeded')
+    if left is None:
+        return timeout
+    return left if timeout is None else min(timeout, left)
+
+
+class DeadlineCallback(BaseCallbackHandler):
+    # stops a multi-step agent between steps once the request is out of time
+    raise_error = True
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        budget(None)
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        budget(None)
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        budget(None)
+
+
+def transient(error):
+    # worth retrying, and a sign the backend is unwell: timeouts, dropped connections, 429 and 5xx
+    if isinstance(error, (TimeoutError, ConnectionError, requests.ConnectionError, requests.Timeout,
+                          openai.error.Timeout, openai.error.APIConnectionError, openai.error.RateLimitError,
+                          openai.error.ServiceUnavailableError, openai.error.TryAgain, aiohttp.ClientConnectionError)):
+        return True
+    status = getattr(error, 'http_status', None) or getattr(error, 'status', None)
+    response = getattr(error, 'response', None)
+    if status is None and response is not None:
+        status = getattr(response, 'status_code', None)
+    if isinstance(error, openai.error.APIError) and status is None:
+        return True
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+
+def backoff(attempt):
+    return random.uniform(0, min(RETRY_CAP, RETRY_BASE * 2 ** attempt))
+
+
+class CircuitBreaker:
+    # closed: calls go through. BREAKER_FAILURES transient failures in a row open it and calls fail at once
+    # for BREAKER_RESET seconds, then one trial call is let through (half open) that closes or reopens it
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, failures=BREAKER_FAILURES, reset=BREAKER_RESET):
+        self.name = name
+        self.threshold = failures
+        self.reset = reset
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def before(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                waited = time.monotonic() - self.opened
+                if waited < self.reset:
+                    metrics.registry.inc('chat_backend_calls_total', (('backend', self.name), ('outcome', 'rejected')))
+                    raise CircuitOpen(self.name, self.reset - waited)
+                self._transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._trial:
+                    metrics.registry.inc('chat_backend_calls_total', (('backend', self.name), ('outcome', 'rejected')))
+                    raise CircuitOpen(self.name, 0.0)
+                self._trial = True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial = False
+            if self.state != self.CLOSED:
+                self._transition(self.CLOSED)
+
+    def failure(self, error):
+        with self._lock:
+            self._trial = False
+            if not transient(error):
+                # the backend answered, the request was at fault
+                if self.state == self.HALF_OPEN:
+                    self._transition(self.CLOSED)
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.opened = time.monotonic()
+                if self.state != self.OPEN:
+                    self._transition(self.OPEN)
+
+    def release(self):
+        # the trial call ended without telling anything about the backend
+        with self._lock:
+            self._trial = False
+
+    def _transition(self, state):
+        logger.warning('circuit %s %s -> %s', self.name, self.state, state)
+        self.state = state
+        metrics.registry.inc('chat_breaker_transitions_total', (('backend', self.name), ('state', state)))
+
+
+class Latency:
+    # the most recent call durations of one stage, for the hedge delay
+
+    def __init__(self, size=200):
+        self._values = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._values.append(seconds)
+
+    def percentile(self, pct):
+        with self._lock:
+            ordered = sorted(self._values)
+        if len(ordered) < HEDGE_MIN_SAMPLES:
+            return None
+        return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+breakers = {}
+latencies = {}
+_registry_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+
+
+def breaker(backend):
+    with _registry_lock:
+        if backend not in breakers:
+            breakers[backend] = CircuitBreaker(backend)
+        return breakers[backend]
+
+
+def latency(stage):
+    with _registry_lock:
+        if stage not in latencies:
+            latencies[stage] = Latency()
+        return latencies[stage]
+
+
+def hedge_delay(stage):
+    return latency(stage).percentile(HEDGE_PERCENTILE) or HEDGE_DELAY
+
+
+def executor():
+    # per process, the pool of a forked parent has no threads in the child
+    global _executor, _executor_pid
+    with _registry_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=RESILIENCE_WORKERS, thread_name_prefix='backend')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def submit(fn, *args, **kwargs):
+    # the request's context (trace, deadline, streaming handler) goes along to the worker thread
+    context = contextvars.copy_context()
+    return executor().submit(context.run, fn, *args, **kwargs)
+
+
+def record(backend, error):
+    if isinstance(error, (DeadlineExceeded, asyncio.CancelledError)):
+        # stopped because the request ran out of time or no longer needs it, not the backend's doing
+        metrics.registry.inc('chat_backend_calls_total', (('backend', backend), ('outcome', 'abandoned')))
+        breaker(backend).release()
+        return
+    outcome = 'ok' if error is None else 'timeout' if isinstance(error, TimeoutError) else 'error'
+    metrics.registry.inc('chat_backend_calls_total', (('backend', backend), ('outcome', outcome)))
+    if error is None:
+        breaker(backend).success()
+    else:
+        breaker(backend).failure(error)
+
+
+def attempt(backend, fn, args, kwargs, timeout):
+    # one call under the breaker; with a timeout it runs on the pool and is abandoned when it runs over,
+    # without one it runs on the calling thread and only the deadline checks apply
+    limit = budget(timeout)
+    breaker(backend).before()
+    try:
+        if timeout is None:
+            result = fn(*args, **kwargs)
+        else:
+            future = submit(fn, *args, **kwargs)
+            try:
+                result = future.result(timeout=limit)
+            except TimeoutError:
+                future.cancel()
+                if limit < timeout:
+                    raise DeadlineExceeded('request deadline exceeded') from None
+                raise TimeoutError(f'{backend} call timed out after {limit:.1f}s') from None
+    except Exception as e:
+        record(backend, e)
+        raise
+    record(backend, None)
+    return result
+
+
+def retrieve(task):
+    # a task nobody awaits any more, its failure is already recorded; retrieved so asyncio doesn't report it
+    if not task.cancelled():
+        task.exception()
+
+
+async def aattempt(backend, fn, args, kwargs, timeout):
+    limit = budget(timeout)
+    breaker(backend).before()
+    try:
+        if limit is None:
+            result = await fn(*args, **kwargs)
+        else:
+            # wait_for cancels the call when it runs over but never retrieves how it ended
+            running = asyncio.ensure_future(fn(*args, **kwargs))
+            running.add_done_callback(retrieve)
+            try:
+                result = await asyncio.wait_for(running, limit)
+            except asyncio.TimeoutError:
+                if timeout is None or limit < timeout:
+                    raise DeadlineExceeded('request deadline exceeded') from None
+                raise TimeoutError(f'{backend} call timed out after {limit:.1f}s') from None
+    except BaseException as e:
+        record(backend, e)
+        raise
+    record(backend, None)
+    return result
+
+
+def retry_pause(backend, error, number, retries):
+    # seconds to wait before the next attempt, None to give up
+    if isinstance(error, (DeadlineExceeded, CircuitOpen)) or number >= retries or not transient(error):
+        return None
+    pause = backoff(number)
+    left = remaining()
+    if left is not None and pause >= left:
+        return None
+    metrics.registry.inc('chat_backend_retries_total', (('backend', backend),))
+    logger.info('retrying %s in %.2fs after %r', backend, pause, error)
+    return pause
+
+
+def call(backend, fn, *args, timeout=None, retries=None, **kwargs):
+    # fn(*args, **kwargs) under the backend's breaker and the request deadline, each attempt limited to
+    # timeout seconds, transient failures retried (CALL_RETRIES times by default) with jittered backoff
+    retries = CALL_RETRIES if retries is None else retries
+    number = 0
+    while True:
+        try:
+            return attempt(backend, fn, args, kwargs, timeout)
+        except Exception as e:
+            pause = retry_pause(backend, e, number, retries)
+            if pause is None:
+                raise
+        time.sleep(pause)
+        number += 1
+
+
+async def acall(backend, fn, *args, timeout=None, retries=None, **kwargs):
+    retries = CALL_RETRIES if retries is None else retries
+    number = 0
+    while True:
+        try:
+            return await aattempt(backend, fn, args, kwargs, timeout)
+        except Exception as e:
+            pause = retry_pause(backend, e, number, retries)
+            if pause is None:
+                raise
+        await asyncio.sleep(pause)
+        number += 1
+
+
+def launch(backend, fn, *args):
+    # fn on the pool under the backend's breaker, its outcome recorded whenever it finishes, even
+    # after the request has stopped waiting for it
+    breaker(backend).before()
+    future = submit(fn, *args)
+    future.add_done_callback(lambda done: record(backend, done.exception()))
+    return future
+
+
+def hedged(stage, primary, backup, *args, timeout=LLM_TIMEOUT, hedge=True):
+    # primary and backup are (backend, fn). The backup is asked too once the primary runs past its usual
+    # latency and the first answer wins; it takes over alone when the primary fails or its breaker is open
+    primary_backend, primary_fn = primary
+    backup_backend, backup_fn = backup
+
+    def timed_primary(*args):
+        start = time.monotonic()
+        result = primary_fn(*args)
+        latency(stage).observe(time.monotonic() - start)
+        return result
+
+    def fallback(error):
+        if isinstance(error, DeadlineExceeded):
+            raise error
+        logger.warning('%s failed, falling back to %s: %r', primary_backend, backup_backend, error)
+        metrics.registry.inc('chat_hedge_total', (('stage', stage), ('outcome', 'fallback')))
+        return call(backup_backend, backup_fn, *args, timeout=timeout, retries=0)
+
+    if not hedge or not HEDGE_ENABLED:
+        try:
+            return call(primary_backend, timed_primary, *args, timeout=timeout, retries=0)
+        except Exception as e:
+            return fallback(e)
+
+    expires = time.monotonic() + budget(timeout)
+    try:
+        first = launch(primary_backend, timed_primary, *args)
+    except CircuitOpen as e:
+        return fallback(e)
+    wait([first], timeout=max(0.0, min(budget(hedge_delay(stage)), expires - time.monotonic())))
+    if first.done():
+        if first.exception() is not None:
+            return fallback(first.exception())
+        metrics.registry.inc('chat_hedge_total', (('stage', stage), ('outcome', 'primary')))
+        return first.result()
+
+    try:
+        second = launch(backup_backend, backup_fn, *args)
+    except CircuitOpen:
+        second = None
+    pending, failed = {first, second} - {None}, None
+    while pending:
+        done, pending = wait(pending, timeout=max(0.0, expires - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            # the loser keeps its thread until the provider answers, its outcome is still recorded
+            budget(None)
+            raise TimeoutError(f'{stage} timed out after {timeout:.1f}s')
+        for future in done:
+            if future.exception() is None:
+                winner = 'primary' if future is first else 'backup'
+                metrics.registry.inc('chat_hedge_total', (('stage', stage), ('outcome', winner)))
+                return future.result()
+            failed = failed or future.exception()
+    raise failed
+
+
+async def ahedged(stage, primary, backup, *args, timeout=LLM_TIMEOUT, hedge=True):
+    primary_backend, primary_fn = primary
+    backup_backend, backup_fn = backup
+
+    async def timed_primary(*args):
+        start = time.monotonic()
+        result = await primary_fn(*args)
+        latency(stage).observe(time.monotonic() - start)
+        return result
+
+    async def fallback(error):
+        if isinstance(error, DeadlineExceeded):
+            raise error
+        logger.warning('%s failed, falling back to %s: %r', primary_backend, backup_backend, error)
+        metrics.registry.inc('chat_hedge_total', (('stage', stage), ('outcome', 'fallback')))
+        return await acall(backup_backend, backup_fn, *args, timeout=timeout, retries=0)
+
+    if not hedge or not HEDGE_ENABLED:
+        try:
+            return await acall(primary_backend, timed_primary, *args, timeout=timeout, retries=0)
+        except Exception as e:
+            return await fallback(e)
+
+    started = time.monotonic()
+    first = asyncio.ensure_future(aattempt(primary_backend, timed_primary, args, {}, timeout))
+    second = None
+    try:
+        await asyncio.wait([first], timeout=budget(hedge_delay(stage)))
+        if first.done():
+            if first.exception() is not None:
+                return await fallback(first.exception())
+            metrics.registry.inc('chat_hedge_total', (('stage', stage), ('outcome', 'primary')))
+            return first.result()
+
+        second = asyncio.ensure_future(aattempt(backup_backend, backup_fn, args, {}, timeout))
+        pending, failed = {first, second}, None
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=budget(None), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded('request deadline exceeded')
+            for future in done:
+                if future.exception() is None:
+                    winner = 'primary' if future is first else 'backup'
+                    metrics.registry.inc('chat_hedge_total', (('stage', stage), ('outcome', winner)))
+                    return future.result()
+                failed = failed or future.exception()
+        raise failed
+    finally:
+        # unlike a thread the loser can be stopped; a cancelled primary still counts as at least that slow,
+        # or the percentile would only ever see the fast calls and hedge more and more
+        if not first.done():
+            first.cancel()
+            latency(stage).observe(time.monotonic() - started)
+        if second is not None and not second.done():
+            second.cancel()
+        for task in (first, second):
+            if task is not None:
+                task.add_done_callback(retrieve)
+
+
+def states():
+    # 0 closed, 1 half open, 2 open, for the /metrics gauge
+    with _registry_lock:
+        current = list(breakers.values())
+    return {item.name: {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}[item.state]
+            for item in current}
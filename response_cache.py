@@ -0,0 +1,246 @@
+import hashlib
+import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+import persistence
+
+load_dotenv()
+
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_DB = os.environ.get("RESPONSE_CACHE_DB", "./instance/response_cache.sqlite")
+RESPONSE_CACHE_EMBEDDINGS = os.environ.get("RESPONSE_CACHE_EMBEDDINGS", "false").lower() == "true"
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get("RESPONSE_CACHE_SIMILARITY", "0.95"))
+# how often a process checks the database for an invalidation made by another one, in seconds
+RESPONSE_CACHE_SYNC_INTERVAL = float(os.environ.get("RESPONSE_CACHE_SYNC_INTERVAL", "1.0"))
+
+UNCACHEABLE_RESPONSES = {"Unable to complete request.", "Unable to complete request. Please retry."}
+# normalized keys are words and spaces only, so this prefix never collides with one
+HASHED_KEY = "sha256:"
+
+
+def normalize_query(query):
+    kept = []
+    for char in unicodedata.normalize("NFKD", query):
+        # accents on latin letters fold away, "Cancún" is "cancun", other scripts keep their marks
+        if unicodedata.combining(char) and kept and kept[-1].isascii():
+            continue
+        kept.append(char)
+    query = unicodedata.normalize("NFC", "".join(kept)).casefold()
+    query = re.sub(r"[^\w\s]", " ", query)
+    return " ".join(query.split())
+
+
+def cache_key(query):
+    # a query with nothing left once normalized ("???") gets a key of its own instead of sharing ''
+    return normalize_query(query) or HASHED_KEY + hashlib.sha256(query.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, db_path=RESPONSE_CACHE_DB,
+                 use_embeddings=RESPONSE_CACHE_EMBEDDINGS, similarity=RESPONSE_CACHE_SIMILARITY,
+                 sync_interval=RESPONSE_CACHE_SYNC_INTERVAL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+        self.use_embeddings = use_embeddings
+        self.similarity = similarity
+        self.hits = 0
+        self.disk_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._vectors = OrderedDict()
+        self._embeddings = None
+        self._lock = threading.Lock()
+        self._db = None
+        self._generation = None
+        self._synced = 0.0
+
+        if db_path:
+            self._db = persistence.SQLiteConnection(db_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache "
+                "(key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            # written when every non-latin query normalized to '', one answer shared by all of them
+            self._db.execute("DELETE FROM response_cache WHERE key = ''")
+            # bumped by every invalidation, so the workers sharing the file drop their memory tier too
+            self._db.execute("CREATE TABLE IF NOT EXISTS response_cache_generation "
+                             "(id INTEGER PRIMARY KEY CHECK (id = 0), generation INTEGER NOT NULL)")
+            self._db.execute("INSERT OR IGNORE INTO response_cache_generation (id, generation) VALUES (0, 0)")
+            self._generation = self._read_generation()
+            self._synced = time.monotonic()
+
+    def _read_generation(self):
+        return self._db.execute("SELECT generation FROM response_cache_generation WHERE id = 0").fetchone()[0]
+
+    def _sync(self):
+        # at most once per sync_interval, memory hits in between may be that much behind an invalidation
+        if self._db is None or time.monotonic() - self._synced < self.sync_interval:
+            return
+        self._synced = time.monotonic()
+        generation = self._read_generation()
+        if generation != self._generation:
+            self._entries.clear()
+            self._vectors.clear()
+            self._generation = generation
+
+    def _bump_generation(self):
+        self._db.execute("UPDATE response_cache_generation SET generation = generation + 1 WHERE id = 0")
+        self._generation = self._read_generation()
+        self._synced = time.monotonic()
+
+    def _get_memory(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        response, created = entry
+        if now - created > self.ttl:
+            del self._entries[key]
+            self._vectors.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    def _put_memory(self, key, response, created):
+        self._entries[key] = (response, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            evicted, _ = self._entries.popitem(last=False)
+            self._vectors.pop(evicted, None)
+
+    def _get_disk(self, key, now):
+        if self._db is None:
+            return None
+        row = self._db.execute(
+            "SELECT response, created FROM response_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if now - row[1] > self.ttl:
+            self._db.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+            return None
+        return row
+
+    def _embed(self, text):
+        import numpy as np
+        if self._embeddings is None:
+            import embedding_cache
+            self._embeddings = embedding_cache.openai_embeddings()
+        vector = np.asarray(self._embeddings.embed_query(text), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _find_similar(self, vector):
+        best_key, best_score = None, self.similarity
+        for key, other in self._vectors.items():
+            score = float(vector @ other)
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    def get(self, query):
+        key = cache_key(query)
+        now = time.time()
+        with self._lock:
+            self._sync()
+            response = self._get_memory(key, now)
+            if response is not None:
+                self.hits += 1
+                return response
+
+            row = self._get_disk(key, now)
+            if row is not None:
+                self._put_memory(key, row[0], row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                return row[0]
+
+        if self.use_embeddings and not key.startswith(HASHED_KEY):
+            vector = self._embed(key)
+            with self._lock:
+                similar = self._find_similar(vector)
+                response = self._get_memory(similar, now) if similar else None
+                if response is not None:
+                    self.hits += 1
+                    self.similar_hits += 1
+                    return response
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, query, response):
+        if not response or response in UNCACHEABLE_RESPONSES:
+            return
+        key = cache_key(query)
+        now = time.time()
+        vector = self._embed(key) if self.use_embeddings and not key.startswith(HASHED_KEY) else None
+        with self._lock:
+            self._put_memory(key, response, now)
+            if vector is not None and key in self._entries:
+                self._vectors[key] = vector
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, response, created) VALUES (?, ?, ?)",
+                    (key, response, now)
+                )
+
+    def get_or_compute(self, query, compute):
+        response = self.get(query)
+        if response is None:
+            response = compute(query)
+            self.set(query, response)
+        return response
+
+    def invalidate(self, query=None):
+        with self._lock:
+            if query is None:
+                self._entries.clear()
+                self._vectors.clear()
+                if self._db is not None:
+                    self._db.execute("DELETE FROM response_cache")
+                    self._bump_generation()
+                return
+            key = cache_key(query)
+            self._entries.pop(key, None)
+            self._vectors.pop(key, None)
+            if self._db is not None:
+                self._db.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                # the other processes can't drop one key from their memory, they reload it from disk
+                self._bump_generation()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'similar_hits': self.similar_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self._entries),
+            }
+
+
+cache = ResponseCache()
+
+
+def invalidate(query=None):
+    cache.invalidate(query)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "invalidate":
+        invalidate(" ".join(sys.argv[2:]) or None)
+        print('Response cache invalidated')
+    else:
+        print(cache.stats())
@@ -0,0 +1,172 @@
+import math
+import os
+import re
+import sys
+from collections import Counter, defaultdict
+
+from dotenv import load_dotenv
+
+import url_index
+
+load_dotenv()
+
+ROUTER_THRESHOLD = float(os.environ.get("ROUTER_THRESHOLD", "0.35"))
+CENTROID_MIN_SIMILARITY = 0.3
+
+GREETING = 'greeting'
+CONTACT = 'contact'
+DEAL = 'deal'
+WEATHER = 'weather'
+GENERAL = 'general'
+
+GREETING_WORDS = {
+    "hi", "hii", "hello", "hey", "hiya", "howdy", "yo", "greetings", "good", "morning", "afternoon", "evening",
+    "day", "there", "thanks", "thank", "you", "thx", "ok", "okay", "bye", "goodbye", "travelbot", "bot",
+}
+
+# a request for a person or contact details and nothing else, matched against the whole question: a contact word
+# inside a longer question ("cruise deals that include a phone plan") is left to the classifier
+CONTACT_REQUEST = re.compile(
+    r"(?:(?:please|can|could|may|would|will|i|i'd|id|rather|want|wanna|need|like|to|let|me|have|get|someone|somebody|"
+    r"you|a|an|the|agent|consultant|representative|advisor) )*"
+    r"(?:(?:speak|talk|chat) (?:to|with) (?:an? |the |a real |some )?(?:travel )?"
+    r"(?:agent|human|person|representative|rep|consultant|advisor|someone|somebody)"
+    r"|(?:call|phone|email|e mail) me(?: back)?"
+    r"|(?:contact|reach) (?:you|an? (?:agent|human|consultant|representative))"
+    r"|how (?:can|do) i (?:contact|reach|call|email) you"
+    r"|(?:(?:what is|what's|whats|provide|give me|send me) )?(?:your )?"
+    r"(?:phone number|number|email|email address|e mail address|email or phone number|phone number or email|"
+    r"contact details|contact info|contact information|office hours))"
+    r"(?: please| now| today| tomorrow)?"
+)
+WEATHER_PATTERN = re.compile(r"\b(weather|forecast|temperature|raining|snowing|humidity|degrees)\b")
+DEAL_PATTERN = re.compile(
+    r"\b(deals?|packages?|all[- ]inclusive|cruises?|cheap(est)?|price|pricing|cost|how much|tours?|"
+    r"vacations?|getaways?|trips?|holidays?|longstay|resorts?)\b"
+)
+
+SEED_EXAMPLES = [
+    (GREETING, "hi"), (GREETING, "hello there"), (GREETING, "hey how are you"), (GREETING, "good morning"),
+    (GREETING, "thanks for your help"), (GREETING, "who are you"),
+    (CONTACT, "I want to talk to an agent"), (CONTACT, "I want to talk to human"),
+    (CONTACT, "provide email or phone number"), (CONTACT, "how can I contact you"),
+    (CONTACT, "can someone call me"), (CONTACT, "what is your phone number"),
+    (WEATHER, "what is the weather in cancun"), (WEATHER, "weather forecast for rome this week"),
+    (WEATHER, "is it raining in vancouver"), (WEATHER, "temperature in las vegas today"),
+    (GENERAL, "do I need a visa to travel to japan"), (GENERAL, "what is the best time to visit peru"),
+    (GENERAL, "what currency do they use in costa rica"), (GENERAL, "tell me about arenal volcano"),
+    (GENERAL, "what restaurants are within walking distance"), (GENERAL, "what is buttermilk at aspen"),
+    (GENERAL, "are there any landmarks nearby worth visiting"), (GENERAL, "how long is the flight to london"),
+    (GENERAL, "what should I pack for iceland"), (GENERAL, "is it safe to travel to mexico"),
+]
+
+
+def qa_bank_examples():
+    text, _ = url_index.read_qa_bank()
+    return [(DEAL, pair["question"]) for pair in url_index.parse_qa_bank(text)]
+
+
+class NearestCentroid:
+
+    def __init__(self, examples):
+        df = Counter()
+        documents = []
+        for label, text in examples:
+            tokens = self.features(text)
+            documents.append((label, Counter(tokens)))
+            df.update(set(tokens))
+        self.idf = {term: math.log((1 + len(documents)) / (1 + freq)) + 1 for term, freq in df.items()}
+
+        sums = defaultdict(Counter)
+        for label, counts in documents:
+            for term, weight in self._vector(counts).items():
+                sums[label][term] += weight
+        self.centroids = {label: self._normalize(vector) for label, vector in sums.items()}
+
+    @staticmethod
+    def features(text):
+        tokens = url_index.tokenize(text) or re.findall(r"[a-z]+", text.lower())
+        return tokens + [f'{a}_{b}' for a, b in zip(tokens, tokens[1:])]
+
+    @staticmethod
+    def _normalize(vector):
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {term: weight / norm for term, weight in vector.items()}
+
+    def _vector(self, counts):
+        return self._normalize({term: count * self.idf[term] for term, count in counts.items() if term in self.idf})
+
+    def coverage(self, text):
+        # share of the query's words seen in training
+        tokens = url_index.tokenize(text) or re.findall(r"[a-z]+", text.lower())
+        return sum(token in self.idf for token in tokens) / len(tokens) if tokens else 0.0
+
+    def scores(self, text):
+        vector = self._vector(Counter(self.features(text)))
+        return sorted(
+            ((label, sum(weight * centroid.get(term, 0.0) for term, weight in vector.items()))
+             for label, centroid in self.centroids.items()),
+            key=lambda item: item[1], reverse=True
+        )
+
+
+class IntentRouter:
+
+    def __init__(self, examples=None):
+        self.classifier = NearestCentroid(examples if examples is not None else SEED_EXAMPLES + qa_bank_examples())
+
+    def route(self, query):
+        text = query.lower().strip()
+        words = re.findall(r"[a-z']+", text)
+
+        if CONTACT_REQUEST.fullmatch(' '.join(words)):
+            return CONTACT, 1.0
+        if words and len(words) <= 5 and all(word in GREETING_WORDS for word in words):
+            return GREETING, 1.0
+        if WEATHER_PATTERN.search(text):
+            return WEATHER, 1.0
+
+        url, score = url_index.lookup(query)
+        deal = DEAL_PATTERN.search(text)
+        if url is not None and deal:
+            return DEAL, score
+
+        ranked = self.classifier.scores(query)
+        if not ranked or ranked[0][1] <= 0:
+            return GENERAL, 0.0
+        best_label, best_score = ranked[0]
+        if deal and best_label != DEAL:
+            # a deal question the index has no page for is the agent's to answer, not another route's
+            return best_label, 0.0
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+        # a clear margin only counts when the query is actually close to the winning centroid
+        confidence = (best_score - runner_up) / best_score * min(best_score / CENTROID_MIN_SIMILARITY, 1.0)
+        if best_label in (GREETING, CONTACT, WEATHER):
+            # these answer from their own small vocabulary, unlike a deal or general question about a place
+            # the examples never named, so words outside it count against them
+            confidence *= self.classifier.coverage(query)
+        return best_label, confidence
+
+
+_router = None
+
+
+def get_router():
+    global _router
+    if _router is None:
+        _router = IntentRouter()
+    return _router
+
+
+def set_router(intent_router):
+    global _router
+    _router = intent_router
+
+
+def route(query):
+    return get_router().route(query)
+
+
+if __name__ == "__main__":
+    for question in sys.argv[1:]:
+        print(question, route(question))
@@ -0,0 +1,192 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from dotenv import load_dotenv
+
+import resilience
+
+load_dotenv()
+
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", "900"))
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", "1024"))
+SEARCH_MAX_WORKERS = int(os.environ.get("SEARCH_MAX_WORKERS", "4"))
+# the services' own hosts unless overridden, bench/mock_api.py serves both locally for load tests
+SERPER_URL = os.environ.get("SERPER_API_BASE", "https://google.serper.dev").rstrip('/')
+GOOGLE_API_BASE = os.environ.get("GOOGLE_API_BASE")
+
+NO_RESULT = 'No good search result found'
+
+# event loop -> aiohttp session, a session and its connection pool belong to the loop that opened them
+_async_sessions = weakref.WeakKeyDictionary()
+_async_sessions_lock = threading.Lock()
+
+
+def async_session():
+    loop = asyncio.get_running_loop()
+    with _async_sessions_lock:
+        session = _async_sessions.get(loop)
+        if session is None or session.closed:
+            session = _async_sessions[loop] = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=resilience.SEARCH_TIMEOUT))
+        return session
+
+
+async def aclose():
+    # on shutdown of the running loop, an open session would be reported as unclosed
+    with _async_sessions_lock:
+        session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+class SearchResult(namedtuple('SearchResult', ['text', 'links', 'raw'])):
+    __slots__ = ()
+
+    @property
+    def link(self):
+        return self.links[0] if self.links else None
+
+
+class SearchClient:
+    # one request per term: snippet text and result links are both derived from the same response
+
+    def __init__(self, ttl=SEARCH_CACHE_TTL, maxsize=SEARCH_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.requests = 0
+        self.hits = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _fetch(self, term):
+        raise NotImplementedError
+
+    async def _afetch(self, term):
+        return await asyncio.get_running_loop().run_in_executor(None, self._fetch, term)
+
+    def _parse(self, raw):
+        raise NotImplementedError
+
+    def _cached(self, term):
+        with self._lock:
+            entry = self._cache.get(term)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[1] > self.ttl:
+                del self._cache[term]
+                return None
+            self._cache.move_to_end(term)
+            self.hits += 1
+            return entry[0]
+
+    def _store(self, term, result):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._cache[term] = (result, time.monotonic())
+            self._cache.move_to_end(term)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def search(self, term):
+        result = self._cached(term)
+        if result is None:
+            self.requests += 1
+            result = self._parse(self._fetch(term))
+            self._store(term, result)
+        return result
+
+    async def asearch(self, term):
+        result = self._cached(term)
+        if result is None:
+            self.requests += 1
+            result = self._parse(await self._afetch(term))
+            self._store(term, result)
+        return result
+
+    def search_many(self, terms):
+        with ThreadPoolExecutor(max_workers=min(SEARCH_MAX_WORKERS, max(len(terms), 1))) as executor:
+            return list(executor.map(self.search, terms))
+
+    async def asearch_many(self, terms):
+        return await asyncio.gather(*(self.asearch(term) for term in terms))
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+class SerperClient(SearchClient):
+
+    def __init__(self, wrapper, session=None, **kwargs):
+        super().__init__(**kwargs)
+        self.wrapper = wrapper
+        self.session = session
+
+    def _request(self, term):
+        # same request as GoogleSerperAPIWrapper.results, but to SERPER_URL
+        params = {
+            'q': term,
+            'gl': getattr(self.wrapper, 'gl', None),
+            'hl': getattr(self.wrapper, 'hl', None),
+            'num': getattr(self.wrapper, 'k', None),
+            'tbs': getattr(self.wrapper, 'tbs', None),
+        }
+        return (f'{SERPER_URL}/{getattr(self.wrapper, "type", "search")}',
+                {'X-API-KEY': self.wrapper.serper_api_key or '', 'Content-Type': 'application/json'},
+                {key: value for key, value in params.items() if value is not None})
+
+    def _fetch(self, term):
+        if self.session is None:
+            return self.wrapper.results(term)
+
+        # over a pooled keep-alive session
+        url, headers, params = self._request(term)
+        response = self.session.post(
+            url, headers=headers, params=params,
+            # a hung connection gives the pooled thread back instead of holding it after the caller gave up
+            timeout=resilience.SEARCH_TIMEOUT,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def _afetch(self, term):
+        if self.session is None:
+            return await self.wrapper.aresults(term)
+
+        url, headers, params = self._request(term)
+        async with async_session().post(url, headers=headers, params=params, raise_for_status=True) as response:
+            return await response.json()
+
+    def _parse(self, raw):
+        # the text serper.run would have given the chains, from the wrapper's own parser
+        links = [result['link'] for result in raw.get('organic') or [] if result.get('link')]
+        return SearchResult(self.wrapper._parse_results(raw), links, raw)
+
+
+class GoogleClient(SearchClient):
+
+    def __init__(self, wrapper, num_results=10, **kwargs):
+        super().__init__(**kwargs)
+        self.wrapper = wrapper
+        self.num_results = num_results
+        if GOOGLE_API_BASE:
+            # the wrapper builds its Custom Search client for googleapis.com, rebuilt here for the other host
+            from googleapiclient.discovery import build
+            wrapper.search_engine = build('customsearch', 'v1', developerKey=wrapper.google_api_key,
+                                          client_options={'api_endpoint': GOOGLE_API_BASE})
+
+    def _fetch(self, term):
+        return self.wrapper.results(term, self.num_results)
+
+    def _parse(self, raw):
+        items = [item for item in raw if 'link' in item]
+        links = [item['link'] for item in items]
+        text = ' '.join(item['snippet'] for item in items if item.get('snippet'))
+        return SearchResult(text or NO_RESULT, links, raw)
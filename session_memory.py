@@ -0,0 +1,199 @@
+import contextlib
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+from dotenv import load_dotenv
+from langchain.schema import BaseMemory
+
+import persistence
+
+load_dotenv()
+
+SESSION_MAX = int(os.environ.get("SESSION_MAX", "1000"))
+SESSION_TTL = int(os.environ.get("SESSION_TTL", "1800"))
+SESSION_TURNS = int(os.environ.get("SESSION_TURNS", "3"))
+# empty keeps sessions in this process only, a path lets every worker serve every session
+SESSION_DB = os.environ.get("SESSION_DB", "")
+SESSION_COOKIE = os.environ.get("SESSION_COOKIE", "sid")
+SESSION_SUMMARIZE = os.environ.get("SESSION_SUMMARIZE", "false").lower() == "true"
+
+SESSION_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+DEFAULT_SESSION = 'default'
+
+current_session = contextvars.ContextVar('current_session', default=DEFAULT_SESSION)
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+def valid_session_id(session_id):
+    return bool(session_id) and SESSION_ID.match(session_id) is not None
+
+
+class Session:
+
+    def __init__(self, summary='', turns=None, updated=None):
+        self.summary = summary
+        self.turns = turns or []
+        self.updated = updated or time.time()
+
+
+class SessionStore:
+    # bounded per-session history: at most max_sessions sessions (LRU), idle ones expire after ttl,
+    # and each keeps its last `turns` exchanges, older ones are folded into a summary when a summarizer is set
+
+    def __init__(self, max_sessions=SESSION_MAX, ttl=SESSION_TTL, turns=SESSION_TURNS, db_path=SESSION_DB,
+                 summarizer=None):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.turns = turns
+        self.summarizer = summarizer
+        self.evictions = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.RLock()
+        self._writes = 0
+        self._db = None
+
+        if db_path:
+            self._db = persistence.SQLiteConnection(db_path, timeout=10)
+            self._db.execute("CREATE TABLE IF NOT EXISTS session_memory "
+                             "(sid TEXT PRIMARY KEY, summary TEXT NOT NULL, turns TEXT NOT NULL, updated REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS ix_session_memory_updated ON session_memory (updated)")
+
+    def _load(self, session_id, now):
+        if self._db is not None:
+            row = self._db.execute("SELECT summary, turns, updated FROM session_memory WHERE sid = ?",
+                                   (session_id,)).fetchone()
+            if row is None or now - row[2] > self.ttl:
+                return None
+            return Session(row[0], json.loads(row[1]), row[2])
+
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        if now - session.updated > self.ttl:
+            del self._sessions[session_id]
+            self.evictions += 1
+            return None
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def _save(self, session_id, session):
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO session_memory (sid, summary, turns, updated) VALUES (?, ?, ?, ?)",
+                             (session_id, session.summary, json.dumps(session.turns), session.updated))
+            # least recently updated beyond max_sessions, as the in-process LRU does
+            evicted = self._db.execute("DELETE FROM session_memory WHERE sid IN (SELECT sid FROM session_memory "
+                                       "ORDER BY updated DESC LIMIT -1 OFFSET ?)", (self.max_sessions,))
+            self.evictions += evicted.rowcount
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._db.execute("DELETE FROM session_memory WHERE updated < ?", (time.time() - self.ttl,))
+            return
+
+        self._sessions[session_id] = session
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, session_id):
+        with self._lock:
+            return self._load(session_id, time.time()) or Session()
+
+    def _update(self, session_id, change):
+        # load, change and save as one step; with a database in one BEGIN IMMEDIATE transaction, so workers
+        # sharing the file never overwrite each other's turns
+        with self._lock:
+            transaction = self._db.transaction() if self._db is not None else contextlib.nullcontext()
+            with transaction:
+                session = self._load(session_id, time.time()) or Session()
+                change(session)
+                self._save(session_id, session)
+            return session
+
+    def append(self, session_id, human, ai):
+        overflow = []
+
+        def add_turn(session):
+            session.turns.append([human, ai])
+            overflow[:] = session.turns[:-self.turns] if self.turns else session.turns[:]
+            session.turns = session.turns[len(overflow):]
+            session.updated = time.time()
+
+        session = self._update(session_id, add_turn)
+
+        if overflow and self.summarizer is not None:
+            # summarized outside the lock, a concurrent turn in the same session only delays the summary
+            summary = self.summarizer(session.summary, overflow)
+            self._update(session_id, lambda latest: setattr(latest, 'summary', summary))
+
+    def clear(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+            if self._db is not None:
+                self._db.execute("DELETE FROM session_memory WHERE sid = ?", (session_id,))
+
+    def stats(self):
+        with self._lock:
+            if self._db is not None:
+                count = self._db.execute("SELECT count(*) FROM session_memory WHERE updated >= ?",
+                                         (time.time() - self.ttl,)).fetchone()[0]
+                return {'sessions': count, 'evictions': self.evictions}
+            return {'sessions': len(self._sessions), 'evictions': self.evictions}
+
+
+def format_turns(turns, human_prefix='Human', ai_prefix='AI'):
+    return '\n'.join(f'{human_prefix}: {human}\n{ai_prefix}: {ai}' for human, ai in turns)
+
+
+class LLMSummarizer:
+    # progressive summary with langchain's ConversationSummaryMemory prompt, one call per overflowing turn
+
+    def __init__(self, llm):
+        from langchain.chains import LLMChain
+        from langchain.memory.prompt import SUMMARY_PROMPT
+
+        self.chain = LLMChain(llm=llm, prompt=SUMMARY_PROMPT)
+
+    def __call__(self, summary, turns):
+        return self.chain.predict(summary=summary, new_lines=format_turns(turns))
+
+
+class SessionMemory(BaseMemory):
+    # drop-in for ConversationBufferWindowMemory: one instance is shared by the chains, and every call
+    # reads and writes the history of the session bound to current_session for this request
+
+    store: Any
+    memory_key: str = 'chat_history'
+    input_key: Optional[str] = None
+    output_key: Optional[str] = None
+    human_prefix: str = 'Human'
+    ai_prefix: str = 'AI'
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    def load_memory_variables(self, inputs):
+        session = self.store.get(current_session.get())
+        history = format_turns(session.turns, self.human_prefix, self.ai_prefix)
+        if session.summary:
+            history = f'{session.summary}\n{history}' if history else session.summary
+        return {self.memory_key: history}
+
+    def save_context(self, inputs, outputs):
+        input_key = self.input_key or next(key for key in inputs if key != self.memory_key)
+        output_key = self.output_key or next(iter(outputs))
+        self.store.append(current_session.get(), inputs[input_key], outputs[output_key])
+
+    def clear(self):
+        self.store.clear(current_session.get())
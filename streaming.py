@@ -0,0 +1,87 @@
+import contextvars
+import json
+import queue
+import threading
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+token_handler = contextvars.ContextVar('token_handler', default=None)
+
+DONE = object()
+RESTART = object()
+
+
+class QueueCallbackHandler:
+    # one per streamed request. Every attempt at the answer streams through its own AttemptHandler and only
+    # the latest attempt's tokens are queued, so a primary abandoned mid-answer can't interleave with its backup
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.generation = 0
+        self._sent = False
+        self._lock = threading.Lock()
+
+    def attempt(self):
+        with self._lock:
+            self.generation += 1
+            if self._sent:
+                # the browser throws away what the abandoned attempt already sent
+                self.queue.put(RESTART)
+                self._sent = False
+            return AttemptHandler(self, self.generation)
+
+    def put(self, generation, token):
+        with self._lock:
+            if generation == self.generation:
+                self._sent = True
+                self.queue.put(token)
+
+
+class AttemptHandler(BaseCallbackHandler):
+
+    def __init__(self, stream, generation):
+        self.stream = stream
+        self.generation = generation
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.stream.put(self.generation, token)
+
+
+def active():
+    return token_handler.get() is not None
+
+
+def callbacks():
+    # only the final answer chains attach this, so the agent's routing tokens never reach the browser.
+    # Each call starts a new attempt, call it once per model call
+    handler = token_handler.get()
+    return [handler.attempt()] if handler else None
+
+
+def stream_response(get_response, query):
+    handler = QueueCallbackHandler()
+    result = {}
+
+    def run():
+        token_handler.set(handler)
+        try:
+            result['response'] = get_response(query)
+        finally:
+            handler.queue.put(DONE)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+
+    while True:
+        token = handler.queue.get()
+        if token is DONE:
+            break
+        if token is RESTART:
+            yield 'restart', ''
+            continue
+        yield 'token', token
+
+    yield 'done', result.get('response', "Unable to complete request.")
+
+
+def sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import sys
+from collections import Counter
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+QA_BANK_PATH = os.environ.get("QA_BANK_PATH", "./data/QA_Bank.txt")
+URL_INDEX_PATH = os.environ.get("URL_INDEX_PATH", "./instance/url_index")
+URL_LOOKUP_THRESHOLD = float(os.environ.get("URL_LOOKUP_THRESHOLD", "0.5"))
+URL_INDEX_EMBEDDINGS = os.environ.get("URL_INDEX_EMBEDDINGS", "false").lower() == "true"
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+STOP_WORDS = {
+    "a", "an", "the", "to", "in", "on", "for", "of", "and", "or", "is", "are", "do", "does", "you", "your",
+    "i", "im", "i'm", "we", "me", "my", "what", "which", "some", "any", "that", "with", "want", "looking",
+    "right", "now", "be", "it", "can", "how", "there", "have", "has", "go", "get",
+}
+
+URL_PATTERN = re.compile(r'(?:https?://)?(?:www\.)?travelbestbets\.com\S*', re.IGNORECASE)
+
+
+def tokenize(text):
+    tokens = []
+    for token in re.findall(r"[a-z0-9]+", text.lower().replace("’", "'").replace("'", "")):
+        if token in STOP_WORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+def parse_qa_bank(text):
+    pairs = []
+    question = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.lower().startswith("question"):
+            question = line.split(":", 1)[1].strip() if ":" in line else line[len("question"):].strip()
+            continue
+        match = URL_PATTERN.search(line)
+        if question and match:
+            pairs.append({"question": question, "url": match.group(0).rstrip(".,")})
+            question = None
+    return pairs
+
+
+class URLIndex:
+
+    def __init__(self, pairs, source_hash=None, vectors=None):
+        self.pairs = pairs
+        self.source_hash = source_hash
+        self.vectors = vectors
+        self.doc_tokens = [tokenize(pair["question"]) for pair in pairs]
+        self.doc_freqs = [Counter(tokens) for tokens in self.doc_tokens]
+        self.avg_len = sum(len(tokens) for tokens in self.doc_tokens) / max(len(self.doc_tokens), 1)
+
+        df = Counter()
+        for tokens in self.doc_tokens:
+            df.update(set(tokens))
+        n = len(self.doc_tokens)
+        self.idf = {term: math.log(1 + (n - freq + 0.5) / (freq + 0.5)) for term, freq in df.items()}
+
+        # best achievable score per document, used to turn raw BM25 into a 0..1 confidence
+        self.self_scores = [self._bm25(tokens, i) for i, tokens in enumerate(self.doc_tokens)]
+
+    def _bm25(self, query_tokens, i):
+        freqs = self.doc_freqs[i]
+        length = len(self.doc_tokens[i])
+        score = 0.0
+        for term in query_tokens:
+            tf = freqs.get(term)
+            if not tf:
+                continue
+            norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / self.avg_len)
+            score += self.idf[term] * tf * (BM25_K1 + 1) / norm
+        return score
+
+    def lexical_scores(self, query):
+        query_tokens = tokenize(query)
+        scores = []
+        for i in range(len(self.pairs)):
+            raw = self._bm25(query_tokens, i)
+            scores.append(min(raw / self.self_scores[i], 1.0) if self.self_scores[i] else 0.0)
+        return scores
+
+    def search(self, query, k=3, query_vector=None):
+        scores = self.lexical_scores(query)
+        if self.vectors is not None and query_vector is not None:
+            import numpy as np
+            q = np.asarray(query_vector, dtype=np.float32)
+            cosine = self.vectors @ (q / (np.linalg.norm(q) or 1.0))
+            scores = [0.5 * lexical + 0.5 * float(max(cos, 0.0)) for lexical, cos in zip(scores, cosine)]
+
+        ranked = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:k]
+        return [(self.pairs[i]["url"], scores[i], self.pairs[i]["question"]) for i in ranked]
+
+    def save(self, path=URL_INDEX_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(f'{path}.json', 'w', encoding='utf-8') as f:
+            json.dump({"source_hash": self.source_hash, "pairs": self.pairs}, f)
+        if self.vectors is not None:
+            import numpy as np
+            np.save(f'{path}.npy', self.vectors)
+
+    @classmethod
+    def load(cls, path=URL_INDEX_PATH):
+        with open(f'{path}.json', encoding='utf-8') as f:
+            data = json.load(f)
+        vectors = None
+        if os.path.exists(f'{path}.npy'):
+            import numpy as np
+            vectors = np.load(f'{path}.npy', mmap_mode='r')
+        return cls(data["pairs"], data["source_hash"], vectors)
+
+
+def _embed(texts):
+    import numpy as np
+    import embedding_cache
+
+    vectors = np.asarray(embedding_cache.openai_embeddings().embed_documents(texts), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def read_qa_bank(path=QA_BANK_PATH):
+    with open(path, 'rb') as f:
+        raw = f.read()
+    return raw.decode('utf-8', errors='replace'), hashlib.sha256(raw).hexdigest()
+
+
+def build_index(path=QA_BANK_PATH, embeddings=URL_INDEX_EMBEDDINGS):
+    text, source_hash = read_qa_bank(path)
+    pairs = parse_qa_bank(text)
+    vectors = _embed([pair["question"] for pair in pairs]) if embeddings else None
+    return URLIndex(pairs, source_hash, vectors)
+
+
+def load_index(path=QA_BANK_PATH, index_path=URL_INDEX_PATH):
+    _, source_hash = read_qa_bank(path)
+    try:
+        index = URLIndex.load(index_path)
+        if index.source_hash == source_hash and (index.vectors is not None or not URL_INDEX_EMBEDDINGS):
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+
+    index = build_index(path)
+    try:
+        index.save(index_path)
+    except OSError as e:
+        logger.warning('Unable to persist url index: %s', e)
+    return index
+
+
+_index = None
+
+
+def get_index():
+    global _index
+    if _index is None:
+        _index = load_index()
+    return _index
+
+
+def set_index(index):
+    global _index
+    _index = index
+
+
+def lookup(query, threshold=URL_LOOKUP_THRESHOLD):
+    index = get_index()
+    query_vector = None
+    if index.vectors is not None:
+        import embedding_cache
+        query_vector = embedding_cache.openai_embeddings().embed_query(query)
+
+    results = index.search(query, k=1, query_vector=query_vector)
+    if not results:
+        return None, 0.0
+
+    url, score, _ = results[0]
+    if score < threshold:
+        return None, score
+    return url, score
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        built = build_index()
+        built.save()
+        print(f'Indexed {len(built.pairs)} questions into {URL_INDEX_PATH}')
+    else:
+        for question in sys.argv[1:]:
+            for url, score, matched in get_index().search(question):
+                print(f'{score:.2f} {url} ({matched})')
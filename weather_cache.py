@@ -0,0 +1,179 @@
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+from langchain.agents import Tool
+
+import admission
+import metrics
+
+load_dotenv()
+
+# current weather changes over minutes, not seconds
+WEATHER_CACHE_TTL = int(os.environ.get("WEATHER_CACHE_TTL", "600"))
+WEATHER_CACHE_SIZE = int(os.environ.get("WEATHER_CACHE_SIZE", "512"))
+# api.openweathermap.org unless overridden, bench/mock_api.py serves it locally for load tests
+OPENWEATHERMAP_API_BASE = os.environ.get("OPENWEATHERMAP_API_BASE")
+
+
+def normalize_location(location):
+    # "Cancún", "cancun, MX" and " CANCUN " -> ('cancun', None) / ('cancun', 'mx'); a state or region between
+    # the city and a two letter country code is dropped, a spelled out country is ignored
+    folded = unicodedata.normalize("NFKD", location).encode("ascii", "ignore").decode("ascii").lower()
+    parts = [' '.join(re.findall(r'[a-z0-9]+', part)) for part in folded.split(',')]
+    parts = [part for part in parts if part]
+    if not parts:
+        return '', None
+    country = parts[-1] if len(parts) > 1 and re.fullmatch(r'[a-z]{2}', parts[-1]) else None
+    return parts[0], country
+
+
+class WeatherCache:
+    # weather reports by (city, country). A bare city name and the same city with a country code share their
+    # entries, unless the city has been asked for with two different countries (Paris, FR and Paris, US)
+
+    def __init__(self, ttl=WEATHER_CACHE_TTL, maxsize=WEATHER_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.fetch_seconds = None
+        self._entries = OrderedDict()
+        self._countries = {}
+        self._flights = admission.SingleFlight()
+        self._lock = threading.Lock()
+
+    def _lookup(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if now - entry[1] > self.ttl:
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _drop(self, key):
+        del self._entries[key]
+        self._forget(key[0])
+
+    def _forget(self, city):
+        # the countries a city was asked with are kept while one of its reports is cached, not forever
+        countries = self._countries.get(city, set())
+        if not any((city, country) in self._entries for country in countries | {None}):
+            self._countries.pop(city, None)
+
+    def _find(self, city, country, now):
+        countries = self._countries.get(city, set())
+        report = self._lookup((city, country), now)
+        if report is not None or len(countries) > 1:
+            return report
+        if country is not None:
+            return self._lookup((city, None), now)
+        if countries:
+            return self._lookup((city, next(iter(countries))), now)
+        return None
+
+    def _store(self, key, report):
+        with self._lock:
+            self._entries[key] = (report, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+
+    def _fetch(self, key, location, fetch):
+        # one remote call per key at a time, concurrent askers wait for it
+        start = time.perf_counter()
+        try:
+            report = fetch(location)
+        except Exception:
+            with self._lock:
+                self._forget(key[0])
+            raise
+        elapsed = time.perf_counter() - start
+        metrics.registry.observe('chat_weather_fetch_seconds', (), elapsed)
+        with self._lock:
+            self.fetch_seconds = elapsed if self.fetch_seconds is None else 0.9 * self.fetch_seconds + 0.1 * elapsed
+        self._store(key, report)
+        return report
+
+    def get(self, location, fetch):
+        city, country = normalize_location(location)
+        if not city:
+            return fetch(location)
+        key = (city, country)
+        with self._lock:
+            if country is not None:
+                self._countries.setdefault(city, set()).add(country)
+            report = self._find(city, country, time.monotonic())
+            # spellings that would share the entry also share the fetch
+            flight = (city, country) if len(self._countries.get(city, ())) > 1 else city
+            if report is not None:
+                self.hits += 1
+                saved = self.fetch_seconds or 0.0
+        if report is not None:
+            metrics.registry.inc('chat_weather_cache_lookups_total', (('result', 'hit'),))
+            # what the remote call would have cost, from the recent average
+            metrics.registry.inc('chat_weather_cache_saved_seconds_total', (), saved)
+            return report
+
+        led = []
+
+        def lead():
+            led.append(True)
+            return self._fetch(key, location, fetch)
+
+        report = self._flights.do(flight, lead)
+        with self._lock:
+            if led:
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        metrics.registry.inc('chat_weather_cache_lookups_total', (('result', 'miss' if led else 'coalesced'),))
+        return report
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'size': len(self._entries),
+                    'fetch_ms': round((self.fetch_seconds or 0.0) * 1000, 1)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._countries.clear()
+
+
+cache = WeatherCache()
+
+
+def redirect(wrapper, base):
+    # pyowm builds every request URL from its own host name, its weather manager gets a client for base instead
+    from pyowm.commons.http_client import HttpClient
+
+    scheme, _, host = base.partition('://')
+    owm = wrapper.owm
+    owm.config = dict(owm.config, connection=dict(owm.config['connection'], use_ssl=scheme == 'https'))
+    weather_manager = owm.weather_manager
+
+    def redirected():
+        manager = weather_manager()
+        manager.http_client = HttpClient(owm.api_key, owm.config, f'{host.rstrip("/")}/data/2.5',
+                                         admits_subdomains=False)
+        return manager
+
+    owm.weather_manager = redirected
+    return wrapper
+
+
+def cached(tool, fetch=None):
+    # the same tool answering from the cache, fetch (tool.run by default) is only called on a miss
+    if OPENWEATHERMAP_API_BASE and hasattr(tool, 'api_wrapper'):
+        redirect(tool.api_wrapper, OPENWEATHERMAP_API_BASE)
+    fetch = fetch or tool.run
+    return Tool(name=tool.name, func=lambda location: cache.get(location, fetch), description=tool.description,
+                return_direct=tool.return_direct)
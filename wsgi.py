@@ -0,0 +1,24 @@
+import os
+
+from dotenv import load_dotenv
+
+import engines
+import persistence
+from app import app, db
+
+load_dotenv()
+
+# build the models, chains, indexes and knowledge base at import, before gunicorn forks its workers
+SERVE_WARMUP = os.environ.get("SERVE_WARMUP", "true").lower() == "true"
+
+if SERVE_WARMUP:
+    engines.warmup()
+
+
+def after_fork():
+    # SQLite connections held by the caches reopen themselves by pid, the background threads restart the same way
+    with app.app_context():
+        persistence.after_fork(db.engine)
+
+
+application = app